@@ -0,0 +1,128 @@
+import argparse
+import asyncio
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from .utils import setup_django, test_database, timer, report
+
+"""
+Compare how many concurrent slow clients WSGI and ASGI serve
+
+Every client requests the usage list or export and reads the response
+slowly, sleeping --client-delay-ms after each part, as a client on a slow
+network would. Under WSGI each request holds one of --workers threads
+until its client has read it all. Under ASGI the application runs on one
+event loop, the reads on the read pool, and a slow client only holds its
+own coroutine.
+
+`python -m benchmarks.asgi_capacity --clients 200 --workers 16`
+"""
+
+PATHS = {
+    'list': ('/carbon_usage/usage/', 'paginate=cursor'),
+    'export': ('/carbon_usage/usage/export/', 'format=ndjson'),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--usages', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--workers', type=int, default=16,
+                        help='WSGI threads, and ASGI read pool threads')
+    parser.add_argument('--client-delay-ms', type=float, default=200)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.contrib.auth.models import User
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.test import RequestFactory, override_settings
+    from django.utils import timezone
+    from rest_framework.authtoken.models import Token
+    from carbon_usage.models import UsageType, Usage
+    from carbon_usage.async_views import ReadPoolASGIHandler
+
+    delay = args.client_delay_ms / 1000
+
+    with test_database(), override_settings(ASYNC_READS=dict(
+            settings.ASYNC_READS, THREADS=args.workers)):
+        user = User.objects.create_user(username='bench', password='bench')
+        token = Token.objects.get(user=user).key
+        usage_type = UsageType.objects.create(name='driving',
+                                              unit='kilometers')
+        start = timezone.now() - timedelta(days=365)
+        Usage.objects.bulk_create(
+            [Usage(user=user, usage_type=usage_type,
+                   usage_at=start + timedelta(minutes=i))
+             for i in range(args.usages)], batch_size=5000)
+
+        wsgi = WSGIHandler()
+        asgi = ReadPoolASGIHandler(urlconf='planetly_challenge.asgi_urls')
+        environ = RequestFactory()._base_environ
+
+        def wsgi_request(path, query):
+            def start_response(status, headers):
+                assert status.startswith('200'), status
+            body = wsgi(environ(PATH_INFO=path, QUERY_STRING=query,
+                                HTTP_AUTHORIZATION='Token ' + token),
+                        start_response)
+            try:
+                for _ in body:
+                    time.sleep(delay)
+            finally:
+                body.close()
+
+        async def asgi_request(path, query):
+            scope = {
+                'type': 'http', 'method': 'GET', 'path': path,
+                'query_string': query.encode(), 'scheme': 'http',
+                'server': ('testserver', 80),
+                'headers': [(b'authorization', b'Token ' + token.encode())],
+            }
+
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    assert message['status'] == 200, message['status']
+                elif message.get('body'):
+                    await asyncio.sleep(delay)
+
+            await asgi(scope, receive, send)
+
+        async def asgi_clients(path, query):
+            remaining = iter(range(args.requests))
+
+            async def client():
+                for _ in remaining:
+                    await asgi_request(path, query)
+            await asyncio.gather(*[client() for _ in range(args.clients)])
+
+        seconds = {}
+        for name, (path, query) in PATHS.items():
+            with timer(seconds, 'wsgi_' + name):
+                with ThreadPoolExecutor(args.workers) as pool:
+                    list(pool.map(lambda _: wsgi_request(path, query),
+                                  range(args.requests)))
+            with timer(seconds, 'asgi_' + name):
+                asyncio.run(asgi_clients(path, query))
+
+        report({
+            'usages': args.usages,
+            'clients': args.clients,
+            'requests': args.requests,
+            'workers': args.workers,
+            'client_delay_ms': args.client_delay_ms,
+            'seconds': seconds,
+            'requests_per_second': {name: args.requests / value
+                                    for name, value in seconds.items()},
+        })
+
+
+if __name__ == '__main__':
+    main()
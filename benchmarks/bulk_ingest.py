@@ -0,0 +1,62 @@
+import argparse
+import json
+
+from datetime import timedelta
+
+from .utils import setup_django, test_database, timer, report
+
+"""
+Compare creating usages one POST at a time with the bulk endpoint
+
+`python -m benchmarks.bulk_ingest --rows 5000`
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.contrib.auth.models import User
+    from django.utils import timezone
+    from rest_framework.test import APIClient
+    from carbon_usage.models import UsageType
+
+    with test_database():
+        user = User.objects.create_user(username='bench', password='bench')
+        usage_type = UsageType.objects.create(name='driving',
+                                              unit='kilometers')
+        client = APIClient()
+        client.force_authenticate(user=user)
+
+        start = timezone.now()
+        rows = [{'usage_type': usage_type.id,
+                 'usage_at': (start + timedelta(seconds=i)).isoformat()}
+                for i in range(args.rows)]
+
+        seconds = {}
+        with timer(seconds, 'single'):
+            for row in rows:
+                response = client.post('/carbon_usage/usage/',
+                                       data=json.dumps(row),
+                                       content_type='application/json')
+                assert response.status_code == 201
+
+        with timer(seconds, 'bulk'):
+            response = client.post('/carbon_usage/usage/bulk/',
+                                   data=json.dumps(rows),
+                                   content_type='application/json')
+            assert response.status_code == 201
+
+        report({
+            'rows': args.rows,
+            'seconds': seconds,
+            'rows_per_second': {name: args.rows / value
+                                for name, value in seconds.items()},
+            'speedup': seconds['single'] / seconds['bulk'],
+        })
+
+
+if __name__ == '__main__':
+    main()
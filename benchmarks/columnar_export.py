@@ -0,0 +1,70 @@
+import argparse
+import io
+import json
+
+from datetime import timedelta
+
+import msgpack
+
+from .utils import setup_django, test_database, timer, report
+
+"""
+Compare exporting usages as NDJSON and as columnar MessagePack
+
+Measures the server side (streaming the whole export), the payload
+size and the client side (decoding it).
+
+`python -m benchmarks.columnar_export --rows 100000`
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.contrib.auth.models import User
+    from django.utils import timezone
+    from rest_framework.test import APIClient
+    from carbon_usage.models import UsageType, Usage
+
+    with test_database():
+        user = User.objects.create_user(username='bench', password='bench')
+        usage_type = UsageType.objects.create(name='driving',
+                                              unit='kilometers')
+        start = timezone.now()
+        Usage.objects.bulk_create([
+            Usage(user=user, usage_type=usage_type,
+                  usage_at=start + timedelta(seconds=i))
+            for i in range(args.rows)], batch_size=5000)
+        client = APIClient()
+        client.force_authenticate(user=user)
+
+        decoders = {
+            'ndjson': lambda body: [json.loads(line)
+                                    for line in body.splitlines()],
+            'msgpack': lambda body: list(msgpack.Unpacker(io.BytesIO(body))),
+        }
+        server = {}
+        client_side = {}
+        size = {}
+        for name, decode in decoders.items():
+            with timer(server, name):
+                response = client.get('/carbon_usage/usage/export/',
+                                      {'format': name})
+                body = b''.join(response.streaming_content)
+            size[name] = len(body)
+            with timer(client_side, name):
+                decode(body)
+
+        report({
+            'rows': args.rows,
+            'server_seconds': server,
+            'decode_seconds': client_side,
+            'bytes': size,
+        })
+
+
+if __name__ == '__main__':
+    main()
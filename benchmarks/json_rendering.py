@@ -0,0 +1,80 @@
+import argparse
+import io
+import json
+
+from datetime import timedelta
+
+from .utils import setup_django, timer, report
+
+"""
+Compare DRF's JSON renderer and parser with the orjson based ones
+
+Renders a page of usages as the list route returns them, and parses a
+bulk upload body, at each size. Checks both produce the same output.
+
+`python -m benchmarks.json_rendering --sizes 10 1000 100000`
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 1000, 100000])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Best of this many runs is reported')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.utils import timezone
+    from rest_framework.parsers import JSONParser
+    from rest_framework.renderers import JSONRenderer
+    from rest_framework.serializers import DateTimeField
+    from carbon_usage.parsers import ORJSONParser
+    from carbon_usage.renderers import ORJSONRenderer
+
+    usage_at = DateTimeField()
+    start = timezone.now()
+    renderers = {'drf': JSONRenderer(), 'orjson': ORJSONRenderer()}
+    parsers = {'drf': JSONParser(), 'orjson': ORJSONParser()}
+
+    results = {}
+    for size in args.sizes:
+        page = {'count': size, 'next': None, 'previous': None, 'results': [{
+            'user': 'bench',
+            'usage_type': i % 20,
+            'usage_at': usage_at.to_representation(
+                start + timedelta(seconds=i)),
+            'id': i,
+        } for i in range(size)]}
+        body = json.dumps([{'usage_type': row['usage_type'],
+                            'usage_at': row['usage_at']}
+                           for row in page['results']]).encode()
+
+        seconds = {}
+        for name, renderer in renderers.items():
+            runs = {}
+            for run in range(args.repeat):
+                with timer(runs, run):
+                    rendered = renderer.render(page)
+            seconds['render_' + name] = min(runs.values())
+        assert renderers['drf'].render(page) == rendered
+
+        for name, json_parser in parsers.items():
+            runs = {}
+            for run in range(args.repeat):
+                with timer(runs, run):
+                    parsed = json_parser.parse(io.BytesIO(body))
+            seconds['parse_' + name] = min(runs.values())
+        assert parsers['drf'].parse(io.BytesIO(body)) == parsed
+
+        results[size] = {
+            'seconds': seconds,
+            'render_speedup': seconds['render_drf'] / seconds['render_orjson'],
+            'parse_speedup': seconds['parse_drf'] / seconds['parse_orjson'],
+        }
+
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
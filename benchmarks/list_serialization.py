@@ -0,0 +1,67 @@
+import argparse
+
+from datetime import timedelta
+
+from .utils import setup_django, test_database, timer, report
+
+"""
+Compare ways of serializing a list of usages
+
+before       UsageSerializer, one extra query per row for the username
+joined       UsageSerializer over select_related('user')
+fast_path    UsageSerializer.to_representation_fast over values()
+
+`python -m benchmarks.list_serialization --rows 10000`
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from django.utils import timezone
+    from carbon_usage.models import UsageType, Usage
+    from carbon_usage.serializers import UsageSerializer
+
+    with test_database():
+        user = User.objects.create_user(username='bench', password='bench')
+        usage_type = UsageType.objects.create(name='driving',
+                                              unit='kilometers')
+        start = timezone.now()
+        Usage.objects.bulk_create([
+            Usage(user=user, usage_type=usage_type,
+                  usage_at=start + timedelta(seconds=i))
+            for i in range(args.rows)], batch_size=5000)
+        usages = Usage.objects.filter(user=user).order_by('id')
+
+        paths = {
+            'before': lambda: UsageSerializer(usages, many=True).data,
+            'joined': lambda: UsageSerializer(
+                usages.select_related('user'), many=True).data,
+            'fast_path': lambda: UsageSerializer.to_representation_fast(
+                usages.values(*UsageSerializer.fast_values), user),
+        }
+        seconds = {}
+        queries = {}
+        for name, path in paths.items():
+            with CaptureQueriesContext(connection) as context:
+                with timer(seconds, name):
+                    path()
+            queries[name] = len(context.captured_queries)
+
+        report({
+            'rows': args.rows,
+            'seconds': seconds,
+            'queries': queries,
+            'rows_per_second': {name: args.rows / value
+                                for name, value in seconds.items()},
+        })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+import argparse
+import random
+import re
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .utils import report
+
+"""
+Drive a running server at fixed request rates and report latencies
+
+Seed the database first, then point this at the server:
+
+`python manage.py seed_usage --users 1000 --usages 100000`
+`python -m benchmarks.loadtest --url http://localhost:8000 --rate 50`
+
+Every scenario gets --rate requests per second for --duration seconds.
+Requests are sent on schedule whether or not earlier ones have
+returned, and latency is counted from the scheduled time, so a server
+falling behind shows up in the percentiles instead of slowing the client.
+
+usage-list       GET /carbon_usage/usage/ as a random seeded user
+usagetype-list   GET /carbon_usage/usage_type/
+api_token_auth   POST /api-token-auth/ with a seeded user's password
+
+Queries per request are read from the Server-Timing header. The server
+under test has to send it to the seeded users, who are not staff: set
+SERVER_TIMING['HEADER'] to True and keep SERVER_TIMING['SAMPLE_RATE'] at
+1 there. A warning is printed for scenarios that got no header back.
+"""
+
+SCENARIOS = ['usage-list', 'usagetype-list', 'api_token_auth']
+
+QUERIES = re.compile(r'(?:^|,)\s*db;[^,]*desc="(\d+) queries"')
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class LoadTest:
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self._local = threading.local()
+        self.tokens = []
+
+    def session(self):
+        # One keep alive connection per client thread
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def username(self):
+        return '%s%s' % (self.args.prefix,
+                         self.random.randrange(self.args.users))
+
+    def login(self, username):
+        return self.session().post(
+            self.args.url + '/api-token-auth/',
+            data={'username': username, 'password': self.args.password})
+
+    def request(self, scenario):
+        """
+        Send one request of scenario, returns (response, rows)
+        """
+        if scenario == 'api_token_auth':
+            return self.login(self.username()), 0
+
+        headers = {'Authorization': 'Token %s'
+                   % self.random.choice(self.tokens)}
+        path = {'usage-list': '/carbon_usage/usage/',
+                'usagetype-list': '/carbon_usage/usage_type/'}[scenario]
+        response = self.session().get(self.args.url + path, headers=headers)
+        rows = 0
+        if response.status_code == 200:
+            rows = len(response.json()['results'])
+        return response, rows
+
+    def run(self, scenario):
+        args = self.args
+        total = int(args.rate * args.duration)
+        results = []
+        lock = threading.Lock()
+
+        def send(scheduled):
+            try:
+                response, rows = self.request(scenario)
+                ok = response.status_code < 400
+                match = QUERIES.search(response.headers.get('Server-Timing',
+                                                            ''))
+                queries = int(match.group(1)) if match else None
+            except requests.RequestException:
+                ok, rows, queries = False, 0, None
+            latency = time.perf_counter() - scheduled
+            with lock:
+                results.append((ok, latency, rows, queries))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            for n in range(total):
+                scheduled = start + n / args.rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(send, scheduled)
+        elapsed = time.perf_counter() - start
+
+        latencies = [latency * 1000 for ok, latency, _, _ in results if ok]
+        queries = [count for ok, _, _, count in results
+                   if ok and count is not None]
+        if latencies and not queries:
+            print("Warning: no Server-Timing header came back for %s, set "
+                  "SERVER_TIMING['HEADER'] to True on the server to get "
+                  "queries per request" % scenario, file=sys.stderr)
+        return {
+            'requests': len(results),
+            'errors': len(results) - len(latencies),
+            'target_rate': args.rate,
+            'achieved_rate': len(results) / elapsed,
+            'latency_ms': {
+                'p50': percentile(latencies, 0.5),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+                'max': max(latencies) if latencies else None,
+            },
+            'rows_per_second': sum(rows for _, _, rows, _ in results)
+            / elapsed,
+            'queries_per_request': (sum(queries) / len(queries)
+                                    if queries else None),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--scenario', action='append', dest='scenarios',
+                        choices=SCENARIOS,
+                        help='Scenario to run, may be given several times, '
+                             'defaults to all')
+    parser.add_argument('--rate', type=float, default=20,
+                        help='Requests per second')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Seconds each scenario runs for')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='Requests in flight at most')
+    parser.add_argument('--users', type=int, default=1000,
+                        help='Seeded users to pick from, see seed_usage')
+    parser.add_argument('--logins', type=int, default=50,
+                        help='Seeded users to get a token for up front')
+    parser.add_argument('--prefix', default='loadtest')
+    parser.add_argument('--password', default='loadtest')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    load_test = LoadTest(args)
+    for n in range(min(args.logins, args.users)):
+        response = load_test.login('%s%s' % (args.prefix, n))
+        response.raise_for_status()
+        load_test.tokens.append(response.json()['token'])
+
+    report({
+        'url': args.url,
+        'duration': args.duration,
+        'concurrency': args.concurrency,
+        'scenarios': {scenario: load_test.run(scenario)
+                      for scenario in args.scenarios or SCENARIOS},
+    })
+
+
+if __name__ == '__main__':
+    main()
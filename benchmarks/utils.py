@@ -0,0 +1,60 @@
+import json
+import os
+import sys
+import time
+
+from contextlib import contextmanager
+
+"""
+Shared helpers for the benchmark scripts in this folder
+
+Benchmarks run against a throwaway copy of the configured
+database, created and destroyed the same way `manage.py test` does,
+so they can be run from inside the web container:
+
+`docker-compose exec web /usr/local/bin/python -m benchmarks.bulk_ingest`
+"""
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                          'planetly_challenge.settings')
+    import django
+    django.setup()
+
+
+@contextmanager
+def test_database():
+    """
+    Create a fresh test database for the duration of the block
+    """
+    from django.db import connection
+    from django.test.utils import setup_test_environment, \
+        teardown_test_environment
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+@contextmanager
+def timer(results, name):
+    """
+    Store the wall clock seconds spent in the block as results[name]
+    """
+    start = time.perf_counter()
+    yield
+    results[name] = time.perf_counter() - start
+
+
+def report(results):
+    """
+    Print results as JSON, so runs can be compared by other tooling
+    """
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
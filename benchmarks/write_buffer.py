@@ -0,0 +1,72 @@
+import argparse
+import json
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from .utils import setup_django, test_database, timer, report
+
+"""
+Compare concurrent single POSTs with and without the write buffer
+
+`python -m benchmarks.write_buffer --events 5000 --clients 50`
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--max-rows', type=int, default=500)
+    parser.add_argument('--max-delay-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.contrib.auth.models import User
+    from django.test import override_settings
+    from django.utils import timezone
+    from rest_framework.test import APIClient
+    from carbon_usage.models import UsageType
+
+    with test_database():
+        user = User.objects.create_user(username='bench', password='bench')
+        usage_type = UsageType.objects.create(name='driving',
+                                              unit='kilometers')
+        start = timezone.now()
+
+        def post(i):
+            client = APIClient()
+            client.force_authenticate(user=user)
+            response = client.post('/carbon_usage/usage/', data=json.dumps({
+                'usage_type': usage_type.id,
+                'usage_at': (start + timedelta(seconds=i)).isoformat(),
+            }), content_type='application/json')
+            assert response.status_code in (201, 202), response.status_code
+
+        def run():
+            with ThreadPoolExecutor(args.clients) as pool:
+                list(pool.map(post, range(args.events)))
+
+        seconds = {}
+        with timer(seconds, 'direct'):
+            run()
+        for ack in ['flush', 'enqueue']:
+            with override_settings(USAGE_WRITE_BUFFER=dict(
+                    settings.USAGE_WRITE_BUFFER, ENABLED=True, ACK=ack,
+                    MAX_ROWS=args.max_rows,
+                    MAX_DELAY_MS=args.max_delay_ms)):
+                with timer(seconds, 'buffered_' + ack):
+                    run()
+
+        report({
+            'events': args.events,
+            'clients': args.clients,
+            'seconds': seconds,
+            'events_per_second': {name: args.events / value
+                                  for name, value in seconds.items()},
+        })
+
+
+if __name__ == '__main__':
+    main()
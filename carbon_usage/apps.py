@@ -3,3 +3,10 @@ from django.apps import AppConfig
 
 class CarbonUsageConfig(AppConfig):
     name = 'carbon_usage'
+
+    def ready(self):
+        # Connect the signal handlers keeping the usage rollups, the
+        # token authentication cache, the usage type catalogue, the
+        # usage response cache and the usage shards up to date
+        from . import authentication, catalogue, rollups  # noqa: F401
+        from . import response_cache, sharding  # noqa: F401
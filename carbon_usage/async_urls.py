@@ -0,0 +1,19 @@
+from django.urls import URLPattern
+from .async_views import async_view
+from .urls import router
+
+"""
+Routes of the usage read endpoints served asynchronously under ASGI,
+see async_views.py
+
+Taken from the router, with its url names and the view's arguments, so
+only the view differs from carbon_usage/urls.py.
+"""
+
+ASYNC_ROUTES = {'usage-list-list', 'usage-list-summary', 'usage-list-export'}
+
+urlpatterns = [
+    URLPattern(pattern.pattern, async_view(pattern.callback),
+               pattern.default_args, pattern.name)
+    for pattern in router.urls if pattern.name in ASYNC_ROUTES
+]
@@ -0,0 +1,147 @@
+import asyncio
+import contextvars
+import functools
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.db import close_old_connections
+
+from .instrumentation import timed, timings_of
+
+"""
+Asynchronous serving of the usage read endpoints under ASGI
+
+Under ASGI, Django 3.1 runs every synchronous view on one shared thread,
+so a single slow list or export holds up every other request. The list,
+summary and export views of the usage api are served instead by
+async_view() wrappers, which run the unchanged DRF views, so with the same
+authentication, IsOwner and scoping to the user, on a bounded pool of
+settings.ASYNC_READS['THREADS'] threads. The event loop only waits on
+them, other requests are served meanwhile.
+
+There is no async PostgreSQL driver in this project, and the Django ORM
+is synchronous, so the pool is the bridge. Each thread uses its own
+database connections, closed or kept after each task as CONN_MAX_AGE says,
+so at most THREADS connections serve the reads.
+
+Streaming exports are pulled from the pool too, a part at a time, by
+ReadPoolASGIHandler, Django's handler iterating them on the event loop.
+"""
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                settings.ASYNC_READS['THREADS'],
+                thread_name_prefix='async-reads')
+        return _executor
+
+
+def _run_task(function, *args):
+    close_old_connections()
+    try:
+        return function(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_in_pool(function, *args):
+    """
+    Run function(*args) on the read pool and return its result
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        executor(), context.run, _run_task, function, *args)
+
+
+def respond(view, request, args, kwargs):
+    """
+    Call view and render its response, measuring its queries
+    """
+    timings = timings_of(request)
+    with timings.capture_queries() if timings else nullcontext():
+        response = view(request, *args, **kwargs)
+        # Rendered here rather than on the event loop
+        if hasattr(response, 'render') and not response.is_rendered:
+            with timed(request, 'render'):
+                response.render()
+    return response
+
+
+def async_view(view):
+    """
+    Wrap a view so GET and HEAD requests run on the read pool
+
+    Other methods run as Django runs synchronous views under ASGI.
+    """
+    sync_view = sync_to_async(view, thread_sensitive=True)
+
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return await sync_view(request, *args, **kwargs)
+        return await run_in_pool(respond, view, request, args, kwargs)
+    return wrapper
+
+
+class ReadPoolASGIHandler(ASGIHandler):
+    """
+    Django's ASGI handler, resolving requests with urlconf and reading
+    streaming responses on the read pool
+    """
+
+    def __init__(self, urlconf=None):
+        super().__init__()
+        self.urlconf = urlconf
+
+    def create_request(self, scope, body_file):
+        request, error_response = super().create_request(scope, body_file)
+        if request is not None and self.urlconf is not None:
+            request.urlconf = self.urlconf
+        return request, error_response
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        # As Django's send_response, except for the body
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            response_headers.append((bytes(header), bytes(value)))
+        for c in response.cookies.values():
+            response_headers.append(
+                (b'Set-Cookie', c.output(header='').encode('ascii').strip()))
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': response_headers,
+        })
+        try:
+            parts = iter(response)
+            while True:
+                part = await run_in_pool(next, parts, None)
+                if part is None:
+                    break
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True,
+                    })
+            await send({'type': 'http.response.body'})
+        finally:
+            await sync_to_async(response.close, thread_sensitive=True)()
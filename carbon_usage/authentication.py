@@ -0,0 +1,151 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token, TokenProxy
+
+from .lru import LRUCache
+
+"""
+Token authentication without a database query per request
+
+CachedTokenAuthentication is a drop in replacement for DRF's
+TokenAuthentication. It remembers which user a token key belongs to in
+an in-process LRU cache, optionally backed by a cache from settings.CACHES
+shared between processes, so that a request with a known token never
+touches the auth tables.
+
+Deleting or regenerating a token, or saving its user (deactivating them,
+renaming them...) evicts the entries of that user's token. The process
+handling the change and the shared cache are updated at once. Other
+processes may keep serving their local copy for up to TOKEN_AUTH_CACHE['TTL']
+seconds, so keep that short.
+
+A lookup racing an eviction may have read the user before the change.
+Shared entries carry the generation of their token, bumped by every
+eviction, and are only used while it is current. Local entries are not
+kept by a lookup that saw an eviction in its process.
+"""
+
+# User fields kept in the cache, the principal put on the request is
+# a User with only these loaded (see principal())
+USER_FIELDS = {'id', 'username', 'is_active', 'is_staff', 'is_superuser'}
+
+token_cache = LRUCache(settings.TOKEN_AUTH_CACHE['MAX_SIZE'],
+                       settings.TOKEN_AUTH_CACHE['TTL'])
+
+
+def _shared_cache():
+    alias = settings.TOKEN_AUTH_CACHE['SHARED_CACHE']
+    return caches[alias] if alias else None
+
+
+def _shared_key(key):
+    return 'carbon_usage:token:%s' % key
+
+
+def _generation_key(key):
+    return 'carbon_usage:token_generation:%s' % key
+
+
+class _Evictions:
+    """
+    Count of the evictions made by this process
+    """
+    count = 0
+
+
+def principal(values):
+    """
+    Build a User from cached field values without querying for it
+
+    Fields outside USER_FIELDS are deferred, so they are loaded on access,
+    and a save() only ever writes the cached fields back.
+    """
+    model = get_user_model()
+    # from_db wants the loaded values in field order
+    field_names = [field.attname for field in model._meta.concrete_fields
+                   if field.attname in values]
+    return model.from_db('default', field_names,
+                         [values[name] for name in field_names])
+
+
+def invalidate(key):
+    _Evictions.count += 1
+    token_cache.delete(key)
+    shared = _shared_cache()
+    if shared is not None:
+        try:
+            shared.incr(_generation_key(key))
+        except ValueError:
+            shared.set(_generation_key(key), 1, None)
+        shared.delete(_shared_key(key))
+
+
+def _shared_get(shared, key):
+    """
+    Return (the cached values of key or None, the generation of key)
+    """
+    found = shared.get_many([_shared_key(key), _generation_key(key)])
+    generation = found.get(_generation_key(key), 0)
+    entry = found.get(_shared_key(key))
+    if entry is None or entry['generation'] != generation:
+        return None, generation
+    return entry['values'], generation
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+
+    def authenticate_credentials(self, key):
+        values = token_cache.get(key)
+        if values is None:
+            evictions = _Evictions.count
+            shared = _shared_cache()
+            if shared is not None:
+                values, generation = _shared_get(shared, key)
+            if values is None:
+                # Raises AuthenticationFailed for bad tokens and inactive
+                # users, neither of which are ever cached
+                user, token = super().authenticate_credentials(key)
+                values = {field: getattr(user, field) for field in USER_FIELDS}
+                if shared is not None:
+                    # Only kept while no eviction happened since the
+                    # generation was read
+                    shared.set(_shared_key(key),
+                               {'generation': generation, 'values': values},
+                               settings.TOKEN_AUTH_CACHE['SHARED_TTL'])
+            if _Evictions.count == evictions:
+                token_cache.set(key, values)
+
+        user = principal(values)
+        return (user, Token(key=key, user=user))
+
+
+def _invalidate_on_commit(key):
+    # Evict now, and again once the change is visible to other requests,
+    # so a concurrent request cannot cache the old state in between
+    invalidate(key)
+    transaction.on_commit(lambda: invalidate(key))
+
+
+# The admin edits tokens through TokenProxy
+@receiver(post_save, sender=Token)
+@receiver(post_save, sender=TokenProxy)
+@receiver(post_delete, sender=Token)
+@receiver(post_delete, sender=TokenProxy)
+def invalidate_token(sender, instance, **kwargs):
+    _invalidate_on_commit(instance.key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_user_tokens(sender, instance, created, update_fields,
+                           **kwargs):
+    # Logging in only touches last_login, which is not cached
+    if created or update_fields == frozenset(['last_login']):
+        return
+    for key in Token.objects.filter(user=instance).values_list(
+            'key', flat=True):
+        _invalidate_on_commit(key)
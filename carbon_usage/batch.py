@@ -0,0 +1,159 @@
+import io
+import re
+from contextlib import ExitStack
+from urllib.parse import urlsplit
+
+import orjson
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.urls import Resolver404, resolve
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+
+from .sharding import placement
+
+"""
+Several usage and usage type writes in one request and one transaction
+
+POST /carbon_usage/batch/ takes a list of operations, each a method, the
+path of a usage or usage type route and a body, as the route itself
+takes them:
+
+    [{"method": "POST", "path": "/carbon_usage/usage_type/",
+      "body": {"name": "cycling", "unit": "kilometers"}},
+     {"method": "POST", "path": "/carbon_usage/usage/",
+      "body": {"usage_type": "${0.id}", "usage_at": "2021-04-05T10:00:00Z"}},
+     {"method": "DELETE", "path": "/carbon_usage/usage/12/"}]
+
+Each operation is handed to the route's view as a request of its own,
+authenticated as the batch's user without authenticating again, so the
+views' serializers and permissions apply unchanged. ${<index>.<field>}
+in a path or body is replaced with that field of the result of an
+earlier operation.
+
+Operations run in order, in a transaction on the default database and
+one on the user's shard, see sharding.py. The first operation to fail
+rolls all of them back. With the shard on another database the two
+commit one after the other, the shard first.
+"""
+
+REFERENCE = re.compile(r'\$\{(\d+)\.(\w+)\}')
+
+
+def _referenced(match, results):
+    index, field = int(match.group(1)), match.group(2)
+    if index >= len(results):
+        raise ValidationError({'non_field_errors': [
+            '%s refers to an operation that has not run yet.'
+            % match.group(0)]})
+    body = results[index]['body']
+    if not isinstance(body, dict) or field not in body:
+        raise ValidationError({'non_field_errors': [
+            'The result of operation %s has no %s.' % (index, field)]})
+    return body[field]
+
+
+def resolve_references(value, results):
+    """
+    Replace the references to earlier results in the strings of value
+
+    A string that is a reference and nothing else is replaced by the
+    field as is, so ids stay numbers.
+    """
+    if isinstance(value, dict):
+        return {key: resolve_references(item, results)
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [resolve_references(item, results) for item in value]
+    if not isinstance(value, str):
+        return value
+    match = REFERENCE.fullmatch(value)
+    if match:
+        return _referenced(match, results)
+    return REFERENCE.sub(lambda match: str(_referenced(match, results)),
+                         value)
+
+
+def operation_request(request, method, path, body=None):
+    """
+    Build the HttpRequest of an operation, authenticated as the user of
+    the batch request
+    """
+    url = urlsplit(path)
+    content = b'' if body is None else orjson.dumps(body)
+    # An Idempotency-Key of the batch would make every create a retry
+    # of the first one
+    environ = {key: value for key, value in request.META.items()
+               if key != 'HTTP_IDEMPOTENCY_KEY'}
+    environ.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': url.path,
+        'QUERY_STRING': url.query,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(content)),
+        'HTTP_ACCEPT': 'application/json',
+        'wsgi.input': io.BytesIO(content),
+    })
+    operation = WSGIRequest(environ)
+    # Picked up by rest_framework.request.Request, as in APIClient tests
+    operation._force_auth_user = request.user
+    operation._force_auth_token = request.auth
+    return operation
+
+
+def run_operation(request, operation, results, views):
+    """
+    Run one operation, validated BatchOperationSerializer data, through
+    its route's view, one of views
+
+    Returns (status code, response data).
+    """
+    try:
+        path = resolve_references(operation['path'], results)
+        body = resolve_references(operation['body'], results)
+    except ValidationError as exc:
+        return status.HTTP_400_BAD_REQUEST, exc.detail
+    try:
+        # The sync views, not the async ones of asgi_urls.py
+        match = resolve(urlsplit(path).path, settings.ROOT_URLCONF)
+    except Resolver404:
+        match = None
+    view = getattr(match.func, 'cls', None) if match is not None else None
+    if view not in views:
+        return status.HTTP_400_BAD_REQUEST, {'non_field_errors': [
+            '%s is not a usage or usage type route.' % path]}
+
+    sub_request = operation_request(request, operation['method'], path, body)
+    sub_request.resolver_match = match
+    response = match.func(sub_request, *match.args, **match.kwargs)
+    return response.status_code, response.data
+
+
+def run_batch(request, operations, views):
+    """
+    Run operations in order, in one transaction
+
+    Returns the {'status': ..., 'body': ...} results of the operations
+    run, the last one having failed if any did, in which case the
+    transaction was rolled back.
+    """
+    aliases = [DEFAULT_DB_ALIAS]
+    shard = placement(request.user.id).alias
+    if shard != DEFAULT_DB_ALIAS:
+        aliases.append(shard)
+
+    results = []
+    # Usage types created by the batch are only seen by its own catalogue
+    # lookups until it commits, see catalogue.py
+    with ExitStack() as stack:
+        for alias in aliases:
+            stack.enter_context(transaction.atomic(using=alias))
+        for operation in operations:
+            code, data = run_operation(request, operation, results, views)
+            results.append({'status': code, 'body': data})
+            if code >= 400:
+                for alias in aliases:
+                    transaction.set_rollback(True, using=alias)
+                break
+    return results
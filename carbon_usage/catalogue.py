@@ -0,0 +1,223 @@
+import functools
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import UsageType
+
+"""
+In-memory catalogue of usage types
+
+The usage type table is small and rarely written, so each process keeps
+a copy of it. The usage type api reads from the copy, and so does the
+validation of usage_type ids on usage writes.
+
+Any save or delete of a usage type (the api, the admin...) drops the copy
+of the process that made it. Other processes notice through the version
+kept in USAGE_TYPE_CATALOGUE['SHARED_CACHE'] if one is configured, and at
+the latest after USAGE_TYPE_CATALOGUE['TTL'] seconds otherwise. An id
+missing from the copy is looked up in the table, and the copy reloaded if
+it is there, so a type created by another process can be used straight
+away. Ids found missing are remembered until the copy is next reloaded,
+so repeating a bogus id does not cost a query each time, but an id
+looked up before its type was created stays missing until then.
+
+A transaction that saves or deletes a usage type gets a copy of its own
+until it commits, which shows its writes to its own lookups. The copy of
+the process only ever holds committed usage types.
+"""
+
+SHARED_VERSION_KEY = 'carbon_usage:usage_type_catalogue:version'
+
+# Ids remembered as missing per copy, beyond which they are forgotten
+MAX_MISSING = 1000
+
+
+class UsageTypeCatalogue:
+
+    def __init__(self, ttl=None, shared_cache=None):
+        self.ttl = ttl
+        self.shared_cache = shared_cache
+        self._lock = threading.Lock()
+        self._state = None
+        # The uncommitted usage type writes of each thread, see written()
+        self._local = threading.local()
+
+    def _shared_version(self):
+        if self.shared_cache is None:
+            return None
+        return self.shared_cache.get_or_set(SHARED_VERSION_KEY, 0)
+
+    def _load(self):
+        version = self._shared_version()
+        # Shared by every request of the process, so never read from a
+        # replica lagging behind, see replicas.py
+        usage_types = {usage_type.id: usage_type for usage_type in
+                       UsageType.objects.using(DEFAULT_DB_ALIAS)
+                       .order_by('id')}
+        rows = [{'name': usage_type.name, 'unit': usage_type.unit,
+                 'id': usage_type.id}
+                for usage_type in usage_types.values()]
+        digest = hashlib.sha1(repr(
+            [tuple(row.values()) for row in rows]).encode()).hexdigest()
+        return {
+            'version': version,
+            'loaded_at': time.monotonic(),
+            'usage_types': usage_types,
+            'rows': rows,
+            'digest': digest,
+            'orderings': {},
+            'missing': set(),
+        }
+
+    def _pending(self):
+        """
+        Return the {'using', 'callbacks', 'state'} of the uncommitted usage
+        type writes of this thread, or None if there are none
+
+        The writes are gone once none of their on_commit callbacks is left
+        to run, the transaction having committed or been rolled back.
+        """
+        pending = getattr(self._local, 'pending', None)
+        if pending is None:
+            return None
+        connection = transaction.get_connection(pending['using'])
+        waiting = {id(func) for _, func in connection.run_on_commit}
+        callbacks = [callback for callback in pending['callbacks']
+                     if id(callback) in waiting]
+        if not callbacks:
+            self._local.pending = None
+            return None
+        if len(callbacks) < len(pending['callbacks']):
+            # A savepoint with some of the writes was rolled back
+            pending['callbacks'] = callbacks
+            pending['state'] = None
+        return pending
+
+    def _current(self, reload=False):
+        pending = self._pending()
+        if pending is not None:
+            # Read through the transaction, never into the shared copy
+            if pending['state'] is None or reload:
+                pending['state'] = self._load()
+            return pending['state']
+        state = self._state
+        if state is not None and not reload:
+            expired = (self.ttl is not None and
+                       time.monotonic() - state['loaded_at'] > self.ttl)
+            if not expired and state['version'] == self._shared_version():
+                return state
+        with self._lock:
+            self._state = state = self._load()
+        return state
+
+    def _find(self, wanted):
+        """
+        Return the current state, reloaded if any of the ids wanted is
+        missing from it but not from the table
+        """
+        state = self._current()
+        unknown = (set(wanted) - state['usage_types'].keys()
+                   - state['missing'])
+        if not unknown:
+            return state
+        found = set(UsageType.objects.using(DEFAULT_DB_ALIAS)
+                    .filter(pk__in=unknown).values_list('id', flat=True))
+        if found:
+            state = self._current(reload=True)
+            unknown -= state['usage_types'].keys()
+        missing = state['missing']
+        if len(missing) + len(unknown) > MAX_MISSING:
+            missing.clear()
+        missing.update(unknown)
+        return state
+
+    def get(self, pk):
+        """
+        Return the UsageType with id pk, or None if there is none
+        """
+        return self._find([pk])['usage_types'].get(pk)
+
+    def ids(self, wanted=()):
+        """
+        Return the set of usage type ids, reloading if any wanted is missing
+        """
+        return set(self._find(wanted)['usage_types'])
+
+    def rows(self, ordering=None):
+        """
+        Return usage type representations, as UsageTypeSerializer gives them
+
+        For an ordering other than by id, the database is asked for the
+        order once per catalogue version, so collation rules match.
+        """
+        state = self._current()
+        if not ordering:
+            return state['rows']
+        ordering = tuple(ordering)
+        if ordering not in state['orderings']:
+            ids = list(UsageType.objects.using(DEFAULT_DB_ALIAS)
+                       .order_by(*ordering).values_list('id', flat=True))
+            by_id = {row['id']: row for row in state['rows']}
+            state['orderings'][ordering] = [by_id[pk] for pk in ids
+                                            if pk in by_id]
+        return state['orderings'][ordering]
+
+    def digest(self):
+        """
+        A hash of the catalogue content, for use in ETags
+        """
+        return self._current()['digest']
+
+    def written(self, using):
+        """
+        Note a usage type write on the database using, which gives this
+        thread a copy of its own until the write commits
+        """
+        connection = transaction.get_connection(using)
+        callback = functools.partial(self.invalidate)
+        # Run right away without a transaction
+        transaction.on_commit(callback, using=using)
+        if not connection.in_atomic_block:
+            return
+        pending = self._pending()
+        if pending is None or pending['using'] != using:
+            pending = self._local.pending = {
+                'using': using, 'callbacks': [], 'state': None}
+        pending['callbacks'].append(callback)
+        pending['state'] = None
+
+    def invalidate(self):
+        self._state = None
+        pending = getattr(self._local, 'pending', None)
+        if pending is not None:
+            pending['state'] = None
+        if self.shared_cache is not None:
+            try:
+                self.shared_cache.incr(SHARED_VERSION_KEY)
+            except ValueError:
+                self.shared_cache.set(SHARED_VERSION_KEY, 1)
+
+
+def _shared_cache():
+    alias = settings.USAGE_TYPE_CATALOGUE['SHARED_CACHE']
+    return caches[alias] if alias else None
+
+
+catalogue = UsageTypeCatalogue(settings.USAGE_TYPE_CATALOGUE['TTL'],
+                               _shared_cache())
+
+
+@receiver(post_save, sender=UsageType)
+@receiver(post_delete, sender=UsageType)
+def invalidate_catalogue(sender, using, **kwargs):
+    # Drop the copy now, and again once the change is visible to other
+    # requests, so a concurrent request cannot reload the old table
+    catalogue.invalidate()
+    catalogue.written(using)
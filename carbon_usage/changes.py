@@ -0,0 +1,72 @@
+from django.db import connections
+from django.db.models import Q
+
+from .models import Usage
+
+"""
+Changes feed of usages, for clients keeping a copy of their usages
+
+Every insert, and every update that changes a usage, soft deletes
+included, stamps the row with the id of the writing transaction
+(change_xid, set by a trigger, see migration 0004). The feed returns a
+user's usages in (change_xid, id) order after a cursor, the last pair
+the client was given, so a sync only reads what changed since.
+
+Transactions commit in any order, so a usage written by a transaction
+still running may get a lower change_xid than one already returned.
+The feed therefore stops before the oldest running transaction: every
+change below it is final, and a client never skips past one.
+"""
+
+
+def encode_cursor(position, epoch=0):
+    # The epoch counts the moves of the user to another shard, whose
+    # transaction ids are unrelated, see sharding.py
+    if epoch:
+        return '%s.%s.%s' % (position + (epoch,))
+    return '%s.%s' % position
+
+
+def decode_cursor(cursor):
+    """
+    Parse a cursor into a ((change_xid, id), epoch) pair, raises ValueError
+    """
+    change_xid, pk, *epoch = cursor.split('.')
+    if len(epoch) > 1:
+        raise ValueError('Too many parts')
+    return (int(change_xid), int(pk)), int(epoch[0]) if epoch else 0
+
+
+def stable_xid(using='default'):
+    """
+    Every transaction with a lower id has committed or rolled back
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+        return cursor.fetchone()[0]
+
+
+def usage_changes(user, since=(0, 0), limit=1000, using='default'):
+    """
+    Return (rows, cursor, more), the usages of user changed after since
+
+    rows are .values() dicts, deleted usages included, cursor the
+    position to ask for next and more whether there are more rows
+    ready after it.
+    """
+    change_xid, pk = since
+    # Taken before the rows are read, so everything under it is visible
+    horizon = stable_xid(using)
+    rows = list(
+        Usage.all_objects.using(using)
+        .filter(user=user, change_xid__lt=horizon)
+        .filter(Q(change_xid__gt=change_xid) | Q(change_xid=change_xid,
+                                                 id__gt=pk))
+        .order_by('change_xid', 'id')
+        .values('usage_type_id', 'usage_at', 'id', 'modified_at',
+                'deleted_at', 'change_xid')[:limit + 1])
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        since = (rows[-1]['change_xid'], rows[-1]['id'])
+    return rows, since, more
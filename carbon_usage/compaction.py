@@ -0,0 +1,104 @@
+import gzip
+import os
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .models import Usage, UsageCompaction
+from .renderers import NDJSONRenderer
+from .response_cache import bump_version
+from .rollups import day_start, rollup_timezone
+
+"""
+Retention of raw usages
+
+Usages older than the retention horizon are deleted from the usage
+table, optionally archived first to a gzipped NDJSON file, one usage per
+line. Their counts stay in the daily rollups, which deleting raw rows
+does not touch, so totals and day aligned summaries keep covering them.
+The horizon is always a midnight in the rollup time zone, so every
+rollup day is either fully compacted or fully kept.
+
+Rows are deleted a batch per short transaction, skipping rows locked by
+concurrent writers, so writes from the api never wait on a compaction
+for long. Running the compaction again resumes it. Archived rows are
+written out before their deletion commits, so an interrupted batch may
+be archived twice, never lost: dedupe archives on id.
+"""
+
+BATCH_SIZE = 5000
+
+# Columns of the archive, in this order
+ARCHIVE_FIELDS = ['id', 'user', 'usage_type', 'usage_at', 'modified_at',
+                  'deleted_at']
+
+
+def horizon(days=None):
+    """
+    Return the midnight before which usages are compacted
+    """
+    if days is None:
+        days = settings.USAGE_RETENTION['DAYS']
+    tz = rollup_timezone()
+    day = timezone.localtime(timezone.now(), tz).date() - timedelta(days=days)
+    return day_start(day, tz)
+
+
+def open_archive(directory, before):
+    """
+    Create an archive file in directory, return (path, gzip file)
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'usages-before-%s-%s.ndjson.gz' % (
+        before.date().isoformat(),
+        timezone.now().strftime('%Y%m%dT%H%M%S')))
+    return path, gzip.open(path, 'xb')
+
+
+def compact_batch(before, batch_size=BATCH_SIZE, archive=None,
+                  using='default'):
+    """
+    Delete, and archive to the open archive file, up to batch_size usages
+    before before, return the number deleted
+    """
+    table = Usage._meta.db_table
+    connection = connections[using]
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute(
+            'WITH batch AS ('
+            '    SELECT id, usage_at FROM {table} WHERE usage_at < %s'
+            '    LIMIT %s FOR UPDATE SKIP LOCKED) '
+            'DELETE FROM {table} USING batch '
+            'WHERE {table}.id = batch.id '
+            'AND {table}.usage_at = batch.usage_at '
+            'RETURNING {table}.id, user_id, usage_type_id, {table}.usage_at, '
+            'modified_at, deleted_at'.format(
+                table=connection.ops.quote_name(table)),
+            [before, batch_size])
+        rows = cursor.fetchall()
+
+        if archive is not None and rows:
+            for content in NDJSONRenderer().render_stream(ARCHIVE_FIELDS,
+                                                          [rows]):
+                archive.write(content)
+            # On disk before the rows are gone
+            archive.flush()
+            os.fsync(archive.fileobj.fileno())
+
+        for user_id in {row[1] for row in rows}:
+            transaction.on_commit(lambda user_id=user_id: bump_version(
+                user_id), using=using)
+    return len(rows)
+
+
+def start(before, archive='', using='default'):
+    """
+    Record a compaction before before, from now on the rollups of the
+    days before it are never rebuilt, see rollups.rebuild()
+    """
+    return UsageCompaction.objects.using(using).create(before=before,
+                                                       archive=archive)
+
@@ -0,0 +1,145 @@
+from django.db.models import BigIntegerField, Func
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence
+from rest_framework import serializers
+
+from .pagination import ordering_keys, seek
+
+"""
+Streaming export of usages
+
+Rows are read a chunk at a time as plain tuples and encoded as they
+come, so neither the queryset nor the serialized output is ever held in
+memory as a whole. Columnar renderers get each chunk as parallel arrays
+instead, see usage_column_chunks().
+
+Every chunk is a query of its own, seeking past the last row of the
+previous chunk like the keyset pagination does, so no cursor or
+connection is held while the client reads. A chunk can be read by any
+thread, see async_views.py. The export is not one snapshot: usages
+written while it runs may or may not be in it.
+"""
+
+CHUNK_SIZE = 2000
+
+# Same columns, in the same order, as UsageSerializer
+FIELDS = ['user', 'usage_type', 'usage_at', 'id']
+
+
+def keyset_chunks(queryset, values, chunk_size=CHUNK_SIZE):
+    """
+    Yield lists of up to chunk_size queryset.values_list(*values) rows,
+    in the queryset's ordering, each chunk read by a query of its own
+    """
+    keys = ordering_keys(queryset.model, queryset.query.order_by)
+    queryset = queryset.order_by(*[
+        ('-' if descending else '') + name for name, _, descending in keys])
+    rows = queryset.values_list(*values, *[attname for _, attname, _ in keys])
+    position = None
+    while True:
+        page = rows if position is None else rows.filter(seek(keys, position))
+        chunk = list(page[:chunk_size])
+        if not chunk:
+            return
+        position = chunk[-1][-len(keys):]
+        yield [row[:-len(keys)] for row in chunk]
+        if len(chunk) < chunk_size:
+            return
+
+
+def usage_chunks(queryset, user, fields=FIELDS, chunk_size=CHUNK_SIZE):
+    """
+    Yield lists of tuples of fields, by default (user, usage_type,
+    usage_at, id)
+
+    Every usage in the queryset belongs to user, so the username is filled
+    in here rather than joining auth_user for every row. usage_at is
+    formatted exactly like UsageSerializer does. Only the columns of
+    fields are read.
+    """
+    usage_at = serializers.DateTimeField()
+    columns = _columns(fields)
+    for rows in keyset_chunks(queryset, columns, chunk_size):
+        values = dict(zip(columns, zip(*rows)))
+        if 'usage_at' in values:
+            values['usage_at'] = [usage_at.to_representation(at)
+                                  for at in values['usage_at']]
+        values['user'] = [user.username] * len(rows)
+        yield list(zip(*[values[COLUMNS.get(name, 'user')]
+                         for name in fields]))
+
+
+# Column read for each field but user
+COLUMNS = {'usage_type': 'usage_type_id', 'usage_at': 'usage_at', 'id': 'id'}
+
+
+def _columns(fields):
+    return [COLUMNS[name] for name in fields if name in COLUMNS]
+
+
+class EpochMicroseconds(Func):
+    """
+    A timestamp as microseconds since the epoch, computed by the database
+    """
+    template = '(EXTRACT(EPOCH FROM %(expressions)s) * 1000000)::bigint'
+    output_field = BigIntegerField()
+
+
+def usage_column_chunks(queryset, user, fields=FIELDS,
+                        chunk_size=CHUNK_SIZE):
+    """
+    Yield chunks shaped like UsageSerializer.to_columns() gives them
+
+    usage_at is converted by the database, so no datetime is ever
+    built for a row.
+    """
+    names = [name for name in fields if name in COLUMNS]
+    values = [EpochMicroseconds(column) if column == 'usage_at' else column
+              for column in _columns(fields)]
+    for rows in keyset_chunks(queryset, values, chunk_size):
+        columns = {name: list(column)
+                   for name, column in zip(names, zip(*rows))}
+        if 'user' in fields:
+            yield {'user': user.username, 'columns': columns}
+        else:
+            yield {'columns': columns}
+
+
+def streaming_response(request, renderer, chunks, filename, fields=FIELDS):
+    """
+    Build a StreamingHttpResponse encoding chunks with renderer
+
+    The body is gzipped on the fly if the client accepts it.
+    """
+    content = renderer.render_stream(fields, chunks)
+    gzip = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if gzip:
+        content = compress_sequence(content)
+
+    content_type = renderer.media_type
+    if renderer.charset:
+        content_type += '; charset=%s' % renderer.charset
+    response = StreamingHttpResponse(content, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (
+        filename, renderer.format)
+    if gzip:
+        response['Content-Encoding'] = 'gzip'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+def in_context(parts, context):
+    """
+    Yield from the iterator parts, producing each part in context
+
+    A streaming response is read after its view returns, this keeps the
+    context variables routing its queries as the view had set them, see
+    replicas.py and sharding.py.
+    """
+    parts = iter(parts)
+    while True:
+        part = context.run(next, parts, None)
+        if part is None:
+            return
+        yield part
@@ -0,0 +1,178 @@
+import csv
+import io
+
+from itertools import islice
+
+from django.db import connections, transaction
+from rest_framework import serializers
+
+from . import response_cache
+from .models import UsageType, Usage, UsageDailyRollup
+from .parsers import loads
+from .rollups import rollup_timezone, set_local_timezone
+
+"""
+Bulk import of historical usages, see the import_usage command
+
+Rows are read from CSV or NDJSON a chunk at a time and loaded with COPY
+into a temporary staging table, from which a single statement inserts
+them into the usage table and adds them to the daily rollups. Imports
+dedupe: a usage type and usage_at make one usage, so rows identical to
+a live usage already there (same user, usage type and usage_at) or to
+another row of the file are skipped, wherever they are in the file. An
+interrupted import can then be run again. Each chunk commits on its own.
+
+Usage types are given by name and looked up in a dictionary loaded once,
+rows of unknown types are rejected unless the types are created.
+"""
+
+CHUNK_SIZE = 10000
+
+# Rejected rows whose line and reason are kept, past those only counted
+MAX_ERRORS = 100
+
+STAGING_TABLE = 'carbon_usage_usage_import'
+
+
+class RowError(ValueError):
+    pass
+
+
+def read_rows(stream, format):
+    """
+    Yield (line number, row dict) pairs from a text stream
+    """
+    if format == 'csv':
+        # Line 1 is the header
+        yield from enumerate(csv.DictReader(stream), start=2)
+        return
+    for line_number, line in enumerate(stream, start=1):
+        if line.strip():
+            try:
+                yield line_number, loads(line)
+            except ValueError as exc:
+                yield line_number, RowError('Invalid JSON: %s' % exc)
+
+
+def usage_type_ids():
+    """
+    Return {name: id} of every usage type, the lowest id for a name used
+    more than once
+    """
+    return dict(UsageType.objects.order_by('-id').values_list('name', 'id'))
+
+
+class Importer:
+    """
+    Imports usages for a user, see import_chunk()
+
+    Counts of the rows imported, skipped as already there and rejected
+    are kept in imported, skipped and rejected, and the first rejected
+    rows in errors as (line number, reason) pairs.
+    """
+
+    def __init__(self, user, create_types=False, unit='', using='default'):
+        self.user = user
+        self.create_types = create_types
+        self.unit = unit
+        self.using = using
+        self.usage_types = usage_type_ids()
+        self.usage_at = serializers.DateTimeField()
+        self.imported = self.skipped = self.rejected = 0
+        self.errors = []
+
+    def usage_type_id(self, name):
+        usage_type_id = self.usage_types.get(name)
+        if usage_type_id is None:
+            if not name or not self.create_types:
+                raise RowError('Unknown usage type %r' % name)
+            # Usage types are global, not on the usages' shard
+            usage_type_id = UsageType.objects.create(
+                name=name, unit=self.unit).id
+            self.usage_types[name] = usage_type_id
+        return usage_type_id
+
+    def convert(self, row):
+        """
+        Return the (usage_type_id, usage_at) of a row dict
+        """
+        if isinstance(row, RowError):
+            raise row
+        if not isinstance(row, dict):
+            raise RowError('Not an object')
+        try:
+            usage_at = self.usage_at.to_internal_value(row.get('usage_at'))
+        except serializers.ValidationError as exc:
+            raise RowError('usage_at: %s' % ' '.join(exc.detail))
+        return self.usage_type_id(row.get('usage_type')), usage_at
+
+    def chunks(self, rows, chunk_size=CHUNK_SIZE):
+        """
+        Yield lists of converted rows, from up to chunk_size rows each
+        """
+        rows = iter(rows)
+        while True:
+            raw = list(islice(rows, chunk_size))
+            if not raw:
+                return
+            chunk = []
+            for line_number, row in raw:
+                try:
+                    chunk.append(self.convert(row))
+                except RowError as exc:
+                    self.rejected += 1
+                    if len(self.errors) < MAX_ERRORS:
+                        self.errors.append((line_number, str(exc)))
+            if chunk:
+                yield chunk
+
+    def import_chunk(self, chunk):
+        """
+        COPY a chunk of (usage_type_id, usage_at) rows to the staging
+        table and merge it, return the number of usages inserted
+        """
+        connection = connections[self.using]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for usage_type_id, usage_at in chunk:
+            writer.writerow((usage_type_id, usage_at.isoformat()))
+        buffer.seek(0)
+
+        with transaction.atomic(using=self.using), \
+                connection.cursor() as cursor:
+            set_local_timezone(cursor, rollup_timezone())
+            cursor.execute(
+                'CREATE TEMPORARY TABLE IF NOT EXISTS %s '
+                '(usage_type_id integer, usage_at timestamptz) '
+                'ON COMMIT DELETE ROWS' % STAGING_TABLE)
+            cursor.copy_expert(
+                'COPY %s (usage_type_id, usage_at) FROM STDIN '
+                'WITH (FORMAT csv)' % STAGING_TABLE, buffer)
+            cursor.execute(
+                'WITH inserted AS ('
+                '    INSERT INTO {usage} (user_id, usage_type_id, usage_at)'
+                '    SELECT DISTINCT %s, usage_type_id, usage_at'
+                '    FROM {staging} s'
+                '    WHERE NOT EXISTS ('
+                '        SELECT 1 FROM {usage} u WHERE u.user_id = %s'
+                '        AND u.usage_at = s.usage_at'
+                '        AND u.usage_type_id = s.usage_type_id'
+                '        AND u.deleted_at IS NULL)'
+                '    RETURNING usage_type_id, usage_at'
+                '), counted AS ('
+                '    INSERT INTO {rollup} (user_id, usage_type_id, day, count)'
+                '    SELECT %s, usage_type_id, usage_at::date, COUNT(*)'
+                '    FROM inserted GROUP BY 2, 3 ORDER BY 2, 3'
+                '    ON CONFLICT (user_id, day, usage_type_id)'
+                '    DO UPDATE SET count = {rollup}.count + EXCLUDED.count'
+                ') SELECT COUNT(*) FROM inserted'.format(
+                    usage=Usage._meta.db_table,
+                    rollup=UsageDailyRollup._meta.db_table,
+                    staging=STAGING_TABLE),
+                [self.user.id] * 3)
+            inserted = cursor.fetchone()[0]
+            response_cache.bump_version_on_commit(self.user.id, self.using)
+
+        self.imported += inserted
+        self.skipped += len(chunk) - inserted
+        return inserted
@@ -0,0 +1,244 @@
+from django.db import connections, transaction
+from rest_framework import serializers, status
+from rest_framework.exceptions import APIException
+from rest_framework.relations import PrimaryKeyRelatedField
+
+from . import response_cache, rollups
+from .catalogue import catalogue
+from .models import Usage, UsageIdempotencyKey
+from .serializers import UsageBulkRowSerializer
+from .sharding import USAGE_ID_SEQUENCE, group_by_shard
+
+"""
+Set based validation and insertion of many usages at once
+
+Used by the bulk endpoint on the usage api. Rows are validated
+without touching the database, then every referenced usage type is
+checked against the usage type catalogue and the valid rows are
+inserted together.
+
+Rows may carry an idempotency key. A row whose key the user already
+used is not inserted again, the usage created the first time is returned
+instead, as long as the row is the same. A key used for another usage,
+or for a usage since deleted, refuses the row.
+
+Unique indexes of the partitioned usage table have to hold usage_at,
+so keys are claimed in UsageIdempotencyKey, unique per user, with an
+INSERT ... ON CONFLICT DO NOTHING that also picks the id of the usage.
+Only rows whose key was already claimed are looked up.
+"""
+
+BATCH_SIZE = 1000
+
+# Claims the keys not claimed yet, giving each a usage id. Rows with a
+# claimed key are left out of the RETURNING
+CLAIM_KEYS = """
+INSERT INTO {keys} (user_id, key, usage_id)
+SELECT user_id, key, nextval(%s)
+FROM unnest(%s::integer[], %s::varchar[]) AS claimed (user_id, key)
+ON CONFLICT (user_id, key) DO NOTHING
+RETURNING user_id, key, usage_id
+"""
+
+
+class IdempotencyKeyReused(APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = 'This idempotency key was used for another usage.'
+    default_code = 'idempotency_key_reused'
+
+
+class IdempotentUsageDeleted(APIException):
+    status_code = status.HTTP_410_GONE
+    default_detail = ('The usage created with this idempotency key was '
+                      'deleted.')
+    default_code = 'idempotent_usage_deleted'
+
+
+def validate_usage_rows(rows):
+    """
+    Validate a list of usage dicts
+
+    Returns (valid, errors), valid being a list of (index, validated data)
+    pairs and errors a list of {'index': ..., 'errors': ...} dicts, both
+    in input order. An invalid row never fails the other rows.
+    """
+    # A single serializer instance is reused for every row,
+    # run_validation does not keep any per row state
+    row_serializer = UsageBulkRowSerializer()
+    valid = []
+    errors = []
+    for index, row in enumerate(rows):
+        try:
+            valid.append((index, row_serializer.run_validation(row)))
+        except serializers.ValidationError as exc:
+            errors.append({'index': index, 'errors': exc.detail})
+
+    usage_type_ids = {data['usage_type'] for _, data in valid}
+    existing = catalogue.ids(usage_type_ids) & usage_type_ids
+    if existing != usage_type_ids:
+        message = PrimaryKeyRelatedField.default_error_messages['does_not_exist']
+        checked = []
+        for index, data in valid:
+            if data['usage_type'] in existing:
+                checked.append((index, data))
+            else:
+                errors.append({'index': index, 'errors': {'usage_type': [
+                    message.format(pk_value=data['usage_type'])]}})
+        valid = checked
+        errors.sort(key=lambda error: error['index'])
+
+    return valid, errors
+
+
+def create_usages(user, rows):
+    """
+    Insert validated usage rows for user in one transaction
+
+    Returns (usage, created) pairs in row order, created being False for
+    rows whose idempotency key was used before. Rows refused for their
+    key get the APIException refusing them instead, see replayed().
+    """
+    return create_many_usages([(user, data) for data in rows])
+
+
+def create_many_usages(entries):
+    """
+    Insert (user, validated usage row) pairs, in one transaction per shard
+
+    Same as create_usages(), for rows of any number of users, see
+    sharding.py.
+    """
+    pairs = [None] * len(entries)
+    for using, indexes in group_by_shard(
+            [user for user, _ in entries]).items():
+        created = _create_many_usages([entries[i] for i in indexes], using)
+        for index, pair in zip(indexes, created):
+            pairs[index] = pair
+    return pairs
+
+
+def _create_many_usages(entries, using):
+    users = {}
+    keyed = {}
+    for user, data in entries:
+        users[user.id] = user
+        if data.get('idempotency_key') is not None:
+            keyed.setdefault((user.id, data['idempotency_key']), (user, data))
+    usages = [Usage(user=user, usage_type_id=data['usage_type'],
+                    usage_at=data['usage_at'])
+              for user, data in entries
+              if data.get('idempotency_key') is None]
+    with transaction.atomic(using=using):
+        # bulk_create does not send post_save, count the rollups
+        # and invalidate the users' cached responses here
+        usages = Usage.objects.using(using).bulk_create(
+            usages, batch_size=BATCH_SIZE)
+        results = insert_keyed_usages(list(keyed.values()), using)
+        created = usages + [result[0] for result in results.values()
+                            if not isinstance(result, APIException)
+                            and result[1]]
+        rollups.apply_deltas(rollups.count_usages(created), using)
+        for user_id in users:
+            response_cache.bump_version_on_commit(user_id, using)
+
+    pairs = []
+    usages = iter(usages)
+    for user, data in entries:
+        key = data.get('idempotency_key')
+        if key is None:
+            pairs.append((next(usages), True))
+            continue
+        result = results[user.id, key]
+        if data is not keyed[user.id, key][1] and \
+                not isinstance(result, APIException):
+            # Repeats a key earlier in entries
+            result = replayed(result[0], data)
+        pairs.append(result)
+    return pairs
+
+
+def insert_keyed_usages(entries, using='default'):
+    """
+    Insert (user, row) pairs with distinct users and idempotency keys,
+    skipping those whose key the user used before
+
+    Returns {(user id, key): (usage, created)}, the usage of a key used
+    before being the one created then, or the APIException refusing the
+    row, see replayed(). Has to run in a transaction.
+    """
+    # Claimed in the same order by every transaction, so that two
+    # claiming the same keys wait on each other instead of deadlocking
+    entries = sorted(entries, key=lambda entry: (
+        entry[0].id, entry[1]['idempotency_key']))
+    claimed = {}
+    with connections[using].cursor() as cursor:
+        for start in range(0, len(entries), BATCH_SIZE):
+            batch = entries[start:start + BATCH_SIZE]
+            cursor.execute(
+                CLAIM_KEYS.format(keys=UsageIdempotencyKey._meta.db_table),
+                [USAGE_ID_SEQUENCE, [user.id for user, _ in batch],
+                 [data['idempotency_key'] for _, data in batch]])
+            claimed.update(((user_id, key), usage_id)
+                           for user_id, key, usage_id in cursor.fetchall())
+
+    results = {}
+    new = []
+    used = {}
+    for user, data in entries:
+        usage_id = claimed.get((user.id, data['idempotency_key']))
+        if usage_id is None:
+            used.setdefault(user, []).append(data)
+            continue
+        new.append(Usage(id=usage_id, user=user,
+                         usage_type_id=data['usage_type'],
+                         usage_at=data['usage_at'],
+                         idempotency_key=data['idempotency_key']))
+    for usage in Usage.objects.using(using).bulk_create(
+            new, batch_size=BATCH_SIZE):
+        results[usage.user_id, usage.idempotency_key] = usage, True
+
+    for user, rows in used.items():
+        results.update(_replayed_usages(user, rows, using))
+    return results
+
+
+def _replayed_usages(user, rows, using):
+    """
+    Return {(user id, key): replayed()} of rows whose key user used before
+    """
+    keys = [data['idempotency_key'] for data in rows]
+    usage_ids = {}
+    for start in range(0, len(keys), BATCH_SIZE):
+        usage_ids.update(UsageIdempotencyKey.objects.using(using).filter(
+            user_id=user.id, key__in=keys[start:start + BATCH_SIZE])
+            .values_list('key', 'usage_id'))
+    usages = {}
+    ids = list(usage_ids.values())
+    for start in range(0, len(ids), BATCH_SIZE):
+        for usage in Usage.all_objects.using(using).filter(
+                user_id=user.id, id__in=ids[start:start + BATCH_SIZE]):
+            usage.user = user
+            usages[usage.id] = usage
+    results = {}
+    for data in rows:
+        key = data['idempotency_key']
+        usage = usages.get(usage_ids[key])
+        # Compacted since, see compaction.py
+        results[user.id, key] = (IdempotentUsageDeleted() if usage is None
+                                 else replayed(usage, data))
+    return results
+
+
+def replayed(usage, data):
+    """
+    Return what a row gets when usage was created with its key before
+
+    (usage, False) if the row is the same as the one that created it,
+    otherwise the APIException refusing the row.
+    """
+    if usage.usage_type_id != data['usage_type'] or \
+            usage.usage_at != data['usage_at']:
+        return IdempotencyKeyReused()
+    if usage.deleted_at is not None:
+        return IdempotentUsageDeleted()
+    return usage, False
@@ -0,0 +1,363 @@
+import asyncio
+import os
+import random
+import socket
+import threading
+import time
+
+from bisect import bisect_left
+from collections import deque
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+"""
+Per request timings, as Server-Timing headers and per route histograms
+
+ServerTimingMiddleware measures a sample of requests (see
+SERVER_TIMING['SAMPLE_RATE']):
+
+total       the whole request, as seen by the middleware
+db          time spent in SQL, with the number of queries as description
+auth        DRF's authentication, permission and throttling checks
+serialize   turning instances or rows into their representation
+render      rendering the response body
+
+auth and serialize are measured by ServerTimingMixin on the api views,
+and include the SQL they run. Every measure is recorded in rolling
+histograms per route (url name), read through /carbon_usage/timings/ for
+the process answering it or, if SERVER_TIMING['SHARED_CACHE'] is set, with
+the request_timings command for all processes together. The measures of
+a request are only sent back in its Server-Timing header as
+SERVER_TIMING['HEADER'] allows, as they tell clients about the database.
+"""
+
+# Histogram bucket upper bounds, the last bucket is unbounded
+MILLISECONDS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                10000)
+QUERIES = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+PROCESSES_KEY = 'carbon_usage:timings:processes'
+
+
+class RollingHistogram:
+    """
+    Bucketed counts of the values recorded in the last window seconds
+
+    The window is kept as a few slots, so old values are forgotten a slot
+    at a time.
+    """
+
+    def __init__(self, bounds, window, slots=5):
+        self.bounds = bounds
+        self.slot_seconds = window / slots
+        self._slots = deque(maxlen=slots)
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        index = int(time.monotonic() // self.slot_seconds)
+        with self._lock:
+            if not self._slots or self._slots[-1]['index'] != index:
+                self._slots.append({'index': index, 'sum': 0, 'count': 0,
+                                    'counts': [0] * (len(self.bounds) + 1)})
+            slot = self._slots[-1]
+            slot['counts'][bisect_left(self.bounds, value)] += 1
+            slot['sum'] += value
+            slot['count'] += 1
+
+    def snapshot(self):
+        oldest = (int(time.monotonic() // self.slot_seconds)
+                  - self._slots.maxlen)
+        snapshot = {'bounds': list(self.bounds), 'sum': 0, 'count': 0,
+                    'counts': [0] * (len(self.bounds) + 1)}
+        with self._lock:
+            for slot in self._slots:
+                if slot['index'] > oldest:
+                    merge(snapshot, slot)
+        return snapshot
+
+
+def merge(into, snapshot):
+    into['sum'] += snapshot['sum']
+    into['count'] += snapshot['count']
+    into['counts'] = [a + b for a, b in zip(into['counts'],
+                                            snapshot['counts'])]
+    return into
+
+
+def percentile(snapshot, fraction):
+    """
+    The upper bound of the bucket holding the given fraction of values
+    """
+    wanted = fraction * snapshot['count']
+    seen = 0
+    for bound, count in zip(snapshot['bounds'], snapshot['counts']):
+        seen += count
+        if seen >= wanted:
+            return bound
+    return None
+
+
+def summarize(snapshots):
+    """
+    Count, mean and percentiles of {route: {metric: snapshot}}
+    """
+    return {route: {metric: {
+        'count': snapshot['count'],
+        'mean': (snapshot['sum'] / snapshot['count']
+                 if snapshot['count'] else None),
+        'p50': percentile(snapshot, 0.5),
+        'p95': percentile(snapshot, 0.95),
+        'p99': percentile(snapshot, 0.99),
+    } for metric, snapshot in metrics.items()}
+        for route, metrics in snapshots.items()}
+
+
+class TimingRegistry:
+    """
+    The rolling histograms of every route and metric of this process
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._published = 0
+
+    def record(self, route, metric, value):
+        key = (route, metric)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, RollingHistogram(
+                    QUERIES if metric == 'queries' else MILLISECONDS,
+                    self.window))
+        histogram.record(value)
+
+    def snapshot(self):
+        snapshots = {}
+        for (route, metric), histogram in list(self._histograms.items()):
+            snapshots.setdefault(route, {})[metric] = histogram.snapshot()
+        return snapshots
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def publish(self, cache, interval):
+        """
+        Share this process' histograms through cache, at most every interval
+        """
+        now = time.monotonic()
+        if now - self._published < interval:
+            return
+        self._published = now
+        key = 'carbon_usage:timings:%s:%s' % (socket.gethostname(),
+                                              os.getpid())
+        cache.set(key, self.snapshot(), self.window)
+        # Not atomic, a process dropped by a concurrent update adds itself
+        # back on its next publish
+        processes = cache.get(PROCESSES_KEY, set())
+        if key not in processes:
+            cache.set(PROCESSES_KEY, processes | {key}, None)
+
+
+def shared_snapshot(cache):
+    """
+    The histograms published by every process, merged
+    """
+    merged = {}
+    for snapshots in cache.get_many(cache.get(PROCESSES_KEY, set())).values():
+        for route, metrics in snapshots.items():
+            for metric, snapshot in metrics.items():
+                if metric in merged.setdefault(route, {}):
+                    merge(merged[route][metric], snapshot)
+                else:
+                    merged[route][metric] = snapshot
+    return merged
+
+
+def shared_cache():
+    alias = settings.SERVER_TIMING['SHARED_CACHE']
+    return caches[alias] if alias else None
+
+
+registry = TimingRegistry(settings.SERVER_TIMING['WINDOW'])
+
+
+class RequestTimings:
+    """
+    The measures of a single request, in seconds
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self.queries = 0
+
+    def add(self, name, seconds):
+        self.durations[name] = self.durations.get(name, 0) + seconds
+
+    @contextmanager
+    def capture_queries(self):
+        """
+        Record the queries run on this thread's connections in the block
+        """
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(
+                    connection.execute_wrapper(self.record_query))
+            yield
+
+    def record_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.add('db', time.perf_counter() - start)
+            self.queries += 1
+
+    def wrap(self, name, function):
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+        return timed_function
+
+    def header(self):
+        entries = []
+        for name, seconds in self.durations.items():
+            entry = '%s;dur=%.3f' % (name, seconds * 1000)
+            if name == 'db':
+                entry += ';desc="%s queries"' % self.queries
+            entries.append(entry)
+        if 'db' not in self.durations:
+            entries.append('db;dur=0;desc="0 queries"')
+        return ', '.join(entries)
+
+
+def timings_of(request):
+    # DRF's Request passes unknown attributes through to the HttpRequest
+    return getattr(request, 'server_timings', None)
+
+
+@contextmanager
+def timed(request, name):
+    """
+    Add the time spent in the block to the request's timings, if measured
+    """
+    timings = timings_of(request)
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def sends_header(request):
+    """
+    Whether the response to request carries a Server-Timing header
+    """
+    header = settings.SERVER_TIMING['HEADER']
+    if header == 'staff':
+        # Set by DRF on the HttpRequest once the view authenticated
+        user = getattr(request, 'user', None)
+        return user is not None and user.is_staff
+    return bool(header)
+
+
+class ServerTimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Tells Django this instance is async, as MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        timings = self.start(request)
+        if timings is None:
+            return self.get_response(request)
+        start = time.perf_counter()
+        with timings.capture_queries():
+            response = self.get_response(request)
+        return self.finish(request, response, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        timings = self.start(request)
+        if timings is None:
+            return await self.get_response(request)
+        # Views run on other threads, which capture their queries
+        # themselves, see async_views.py
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        return self.finish(request, response, time.perf_counter() - start)
+
+    def start(self, request):
+        """
+        Return the timings to measure request with, None if not sampled
+        """
+        sample_rate = settings.SERVER_TIMING['SAMPLE_RATE']
+        if sample_rate < 1 and random.random() >= sample_rate:
+            return None
+        request.server_timings = RequestTimings()
+        return request.server_timings
+
+    def finish(self, request, response, seconds):
+        timings = request.server_timings
+        timings.add('total', seconds)
+
+        if sends_header(request):
+            response['Server-Timing'] = timings.header()
+
+        match = request.resolver_match
+        route = match.url_name if match and match.url_name else 'unresolved'
+        for name, seconds in timings.durations.items():
+            registry.record(route, name, seconds * 1000)
+        registry.record(route, 'queries', timings.queries)
+
+        cache = shared_cache()
+        if cache is not None:
+            registry.publish(cache, settings.SERVER_TIMING['PUBLISH_INTERVAL'])
+        return response
+
+    def process_template_response(self, request, response):
+        # Runs just before the response is rendered, DRF's Response is
+        # rendered like a template response
+        timings = timings_of(request)
+        if timings is not None:
+            start = time.perf_counter()
+            response.add_post_render_callback(
+                lambda response: timings.add('render',
+                                             time.perf_counter() - start))
+        return response
+
+
+class ServerTimingMixin:
+    """
+    Adds the auth and serialize measures of ServerTimingMiddleware to a view
+    """
+
+    def initial(self, request, *args, **kwargs):
+        with timed(request, 'auth'):
+            super().initial(request, *args, **kwargs)
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        timings = timings_of(self.request)
+        if timings is not None:
+            # .data calls to_representation() once, on the whole instance
+            # or list of instances
+            serializer.to_representation = timings.wrap(
+                'serialize', serializer.to_representation)
+        return serializer
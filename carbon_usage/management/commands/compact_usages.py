@@ -0,0 +1,65 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from carbon_usage import compaction
+
+
+class Command(BaseCommand):
+    help = ('Delete usages older than the retention horizon, keeping their '
+            'daily rollups and optionally archiving them')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.USAGE_RETENTION['DAYS'],
+            help='Compact usages older than this many days')
+        parser.add_argument(
+            '--archive-dir', default=settings.USAGE_RETENTION['ARCHIVE_DIR'],
+            help='Archive the usages to a gzipped NDJSON file in this '
+                 'directory before deleting them')
+        parser.add_argument(
+            '--no-archive', action='store_true',
+            help='Do not archive, even if an archive directory is set')
+        parser.add_argument(
+            '--batch-size', type=int, default=compaction.BATCH_SIZE,
+            help='Usages deleted per transaction')
+        parser.add_argument(
+            '--pause', type=float, default=0,
+            help='Seconds to wait between batches, to leave the database '
+                 'to other writers')
+        parser.add_argument(
+            '--database', default='default',
+            help='Database alias to compact the usages of')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        before = compaction.horizon(options['days'])
+        path, archive = '', None
+        if options['archive_dir'] and not options['no_archive']:
+            path, archive = compaction.open_archive(options['archive_dir'],
+                                                    before)
+        run = compaction.start(before, path, using=using)
+        self.stdout.write('Compacting usages before %s' % before.isoformat())
+
+        try:
+            while True:
+                count = compaction.compact_batch(
+                    before, options['batch_size'], archive, using=using)
+                if not count:
+                    break
+                run.compacted += count
+                run.save(update_fields=['compacted'])
+                self.stdout.write('Compacted %s usages' % run.compacted)
+                time.sleep(options['pause'])
+        finally:
+            if archive is not None:
+                archive.close()
+
+        run.finished_at = timezone.now()
+        run.save(update_fields=['finished_at'])
+        if path:
+            self.stdout.write('Archived to %s' % path)
+        self.stdout.write(self.style.SUCCESS(
+            'Compacted %s usages in total' % run.compacted))
@@ -0,0 +1,44 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from carbon_usage import partitions
+
+
+class Command(BaseCommand):
+    help = ('Create the monthly partitions of the usage table for the '
+            'months ahead, run it at least monthly')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months-ahead', type=int, default=partitions.MONTHS_AHEAD,
+            help='Months after the current one to have partitions for')
+        parser.add_argument(
+            '--since',
+            help='Also create the partitions of past months from this '
+                 'date (YYYY-MM-DD), moving their usages out of the '
+                 'default partition')
+        parser.add_argument(
+            '--database', default='default',
+            help='Database alias to create the partitions in')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = parse_date(options['since'])
+            except ValueError:
+                since = None
+            if since is None:
+                raise CommandError('--since must be a YYYY-MM-DD date')
+            since = datetime(since.year, since.month, since.day,
+                             tzinfo=timezone.utc)
+
+        created = partitions.create_partitions(
+            options['months_ahead'], since, using=options['database'])
+        for name in created:
+            self.stdout.write('Created partition %s' % name)
+        self.stdout.write(self.style.SUCCESS(
+            'Created %s partitions' % len(created)))
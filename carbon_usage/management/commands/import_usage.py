@@ -0,0 +1,86 @@
+import gzip
+import io
+import sys
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from carbon_usage import importer, sharding
+
+
+class Command(BaseCommand):
+    help = ('Import usages of a user from a CSV or NDJSON file with '
+            'usage_type (a name) and usage_at columns')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', help='File to import, may be gzipped, - for stdin')
+        parser.add_argument(
+            '--user', required=True, help='Username the usages belong to')
+        parser.add_argument(
+            '--format', choices=['csv', 'ndjson'],
+            help='Defaults to the file extension, or csv')
+        parser.add_argument(
+            '--chunk-size', type=int, default=importer.CHUNK_SIZE,
+            help='Rows read, copied and committed at a time')
+        parser.add_argument(
+            '--create-types', action='store_true',
+            help='Create the usage types not found, instead of rejecting '
+                 'their rows')
+        parser.add_argument(
+            '--unit', default='',
+            help='Unit of the usage types created')
+        parser.add_argument(
+            '--database',
+            help='Database alias to import into, defaults to the shard '
+                 'of the user')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError('No user named %s' % options['user'])
+        placement = sharding.placement(user.id)
+        if placement.moving:
+            raise CommandError('%s is being moved to another shard'
+                               % user.username)
+        using = options['database'] or placement.alias
+
+        path = options['path']
+        name = path[:-3] if path.endswith('.gz') else path
+        format = options['format'] or (
+            'ndjson' if name.endswith(('.ndjson', '.jsonl')) else 'csv')
+
+        if path == '-':
+            stream = sys.stdin
+        elif path.endswith('.gz'):
+            stream = gzip.open(path, 'rt', encoding='utf-8', newline='')
+        else:
+            stream = io.open(path, encoding='utf-8', newline='')
+
+        usage_importer = importer.Importer(
+            user, options['create_types'], options['unit'], using=using)
+        started = time.monotonic()
+        try:
+            rows = importer.read_rows(stream, format)
+            for chunk in usage_importer.chunks(rows, options['chunk_size']):
+                usage_importer.import_chunk(chunk)
+                self.stdout.write(self.progress(usage_importer, started))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        for line_number, error in usage_importer.errors:
+            self.stderr.write('Line %s: %s' % (line_number, error))
+        self.stdout.write(self.style.SUCCESS(self.progress(
+            usage_importer, started)))
+
+    def progress(self, usage_importer, started):
+        read = (usage_importer.imported + usage_importer.skipped
+                + usage_importer.rejected)
+        seconds = max(time.monotonic() - started, 1e-6)
+        return ('Imported %s usages, skipped %s already there, rejected '
+                '%s, %.0f rows/s' % (
+                    usage_importer.imported, usage_importer.skipped,
+                    usage_importer.rejected, read / seconds))
@@ -0,0 +1,105 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from carbon_usage import response_cache, sharding
+from carbon_usage.changes import stable_xid
+
+
+class Command(BaseCommand):
+    help = ('Move the usages of a user to another shard, while the user '
+            'keeps using the api')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user', required=True, help='Username of the user to move')
+        parser.add_argument(
+            '--to', required=True, dest='target',
+            help='Alias of the shard to move to, from USAGE_SHARDS')
+        parser.add_argument(
+            '--batch-size', type=int, default=sharding.BATCH_SIZE,
+            help='Usages copied per transaction')
+        parser.add_argument(
+            '--grace', type=float, default=5,
+            help='Seconds writes are refused before the last copy, longer '
+                 'than any request takes, so none is still writing')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError('No user named %s' % options['user'])
+        target = options['target']
+        if target not in sharding.shard_aliases():
+            raise CommandError('%s is not a shard' % target)
+        placement = sharding.placement(user.id)
+        source = placement.alias
+        if source == target:
+            raise CommandError('%s is already on %s' % (user.username, target))
+        if self.same_database(source, target):
+            raise CommandError('%s and %s are the same database'
+                               % (source, target))
+
+        try:
+            removed = self.copy(user, source, target, placement, options)
+        except sharding.UsageIdTaken as exc:
+            sharding.delete_usages(user.id, target, options['batch_size'])
+            sharding.place(user.id, source, epoch=placement.epoch)
+            raise CommandError('Not moved: %s' % exc)
+
+        sharding.place(user.id, target, epoch=placement.epoch + 1)
+        response_cache.bump_version(user.id)
+        self.stdout.write('%s is on %s, removed %s usages deleted meanwhile'
+                          % (user.username, target, removed))
+
+        deleted = sharding.delete_usages(user.id, source,
+                                         options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            'Moved %s to %s, deleted %s usages from %s'
+            % (user.username, target, deleted, source)))
+
+    def copy(self, user, source, target, placement, options):
+        """
+        Copy the usages, rollups and idempotency keys of user from source
+        to target, return the number of usages removed from target as
+        deleted meanwhile
+        """
+        # Copied while the user keeps writing, then again for the writes
+        # made meanwhile. A move started before resumes from the start
+        copied, cursor = sharding.copy_changes(
+            user.id, source, target, batch_size=options['batch_size'])
+        self.stdout.write('Copied %s usages' % copied)
+
+        sharding.place(user.id, source, moving=True, epoch=placement.epoch)
+        self.stdout.write('Refusing writes, waiting %ss for those underway'
+                          % options['grace'])
+        time.sleep(options['grace'])
+        # Every transaction started before this has ended once the stable
+        # horizon of the changes feed passes it
+        cutoff = self.next_xid(source)
+        while True:
+            settled = stable_xid(source) >= cutoff
+            copied, cursor = sharding.copy_changes(
+                user.id, source, target, cursor, options['batch_size'])
+            if settled and not copied:
+                break
+            self.stdout.write('Copied %s more usages' % copied)
+            time.sleep(0.1)
+        removed = sharding.remove_stale(user.id, source, target)
+        sharding.copy_rollups(user.id, source, target)
+        sharding.copy_keys(user.id, source, target)
+        return removed
+
+    def same_database(self, alias, other):
+        keys = ['HOST', 'PORT', 'NAME']
+        settings_dict = connections[alias].settings_dict
+        other_dict = connections[other].settings_dict
+        return [settings_dict[key] for key in keys] == \
+            [other_dict[key] for key in keys]
+
+    def next_xid(self, alias):
+        with connections[alias].cursor() as cursor:
+            cursor.execute('SELECT txid_snapshot_xmax(txid_current_snapshot())')
+            return cursor.fetchone()[0]
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from carbon_usage import rollups, sharding
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the daily usage rollups from the usage table, '
+            'a few users at a time')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user', type=int, action='append', dest='users',
+            help='Only rebuild this user id, may be given several times')
+        parser.add_argument(
+            '--after', type=int, default=0,
+            help='Only rebuild users with a higher id, to resume a rebuild')
+        parser.add_argument(
+            '--chunk-size', type=int, default=10,
+            help='Users rebuilt per transaction. Writes to the usage '
+                 'table wait for each transaction, so keep this small')
+        parser.add_argument(
+            '--database', default='default',
+            help='Database alias to rebuild the rollups of')
+
+    def handle(self, *args, **options):
+        users = sharding.users_on(options['database']).order_by('id')
+        if options['users']:
+            users = users.filter(id__in=options['users'])
+
+        last_id = options['after']
+        total = 0
+        while True:
+            chunk = list(users.filter(id__gt=last_id).values_list(
+                'id', flat=True)[:options['chunk_size']])
+            if not chunk:
+                break
+            count = rollups.rebuild(chunk, using=options['database'])
+            total += count
+            last_id = chunk[-1]
+            self.stdout.write('Rebuilt %s rollups for users up to id %s'
+                              % (count, last_id))
+
+        self.stdout.write(self.style.SUCCESS(
+            'Rebuilt %s rollups in total' % total))
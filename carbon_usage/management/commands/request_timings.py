@@ -0,0 +1,44 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from carbon_usage import instrumentation
+
+
+class Command(BaseCommand):
+    help = ('Show the request timing histograms published by every '
+            'process, see SERVER_TIMING in settings')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--route', action='append', dest='routes',
+            help='Only show this route (url name), may be given several times')
+        parser.add_argument(
+            '--json', action='store_true',
+            help='Print the summary as JSON')
+
+    def handle(self, *args, **options):
+        cache = instrumentation.shared_cache()
+        if cache is None:
+            raise CommandError(
+                "Processes only publish their timings when "
+                "SERVER_TIMING['SHARED_CACHE'] is set")
+
+        summary = instrumentation.summarize(
+            instrumentation.shared_snapshot(cache))
+        if options['routes']:
+            summary = {route: metrics for route, metrics in summary.items()
+                       if route in options['routes']}
+
+        if options['json']:
+            self.stdout.write(json.dumps(summary, indent=2, sort_keys=True))
+            return
+
+        self.stdout.write('%-28s %-10s %8s %10s %8s %8s %8s' % (
+            'route', 'metric', 'count', 'mean', 'p50', 'p95', 'p99'))
+        for route, metrics in sorted(summary.items()):
+            for metric, values in sorted(metrics.items()):
+                self.stdout.write('%-28s %-10s %8s %10s %8s %8s %8s' % (
+                    route, metric, values['count'],
+                    '%.2f' % values['mean'] if values['count'] else '-',
+                    values['p50'], values['p95'], values['p99']))
@@ -0,0 +1,90 @@
+import random
+
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from carbon_usage import rollups
+from carbon_usage.models import UsageType, Usage
+
+
+class Command(BaseCommand):
+    help = ('Create users, usage types and usages to load test against, '
+            'see benchmarks/loadtest.py')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--usage-types', type=int, default=20)
+        parser.add_argument(
+            '--usages', type=int, default=100000,
+            help='Usages in total, spread evenly over the users')
+        parser.add_argument(
+            '--days', type=int, default=365,
+            help='Usages are spread over this many days up to now')
+        parser.add_argument(
+            '--prefix', default='loadtest',
+            help='Users are named <prefix><n>, usage types <prefix>-<n>')
+        parser.add_argument('--password', default='loadtest')
+        parser.add_argument(
+            '--clear', action='store_true',
+            help='Delete the users and usage types of an earlier run first')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Random seed, the same seed gives the same usages')
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        prefix = options['prefix']
+        users = User.objects.filter(username__startswith=prefix)
+        usage_types = UsageType.objects.filter(name__startswith=prefix + '-')
+        if options['clear']:
+            # Deleting the users deletes their usages and rollups
+            users.delete()
+            usage_types.delete()
+        elif users.exists():
+            raise CommandError('Users named %s... already exist, pass '
+                               '--clear to replace them' % prefix)
+
+        password = make_password(options['password'])
+        with transaction.atomic():
+            # bulk_create skips the post_save creating tokens, so
+            # users are created without signals and given a token here
+            users = User.objects.bulk_create([
+                User(username='%s%s' % (prefix, n), password=password)
+                for n in range(options['users'])])
+            Token.objects.bulk_create([
+                Token(key=Token.generate_key(), user=user) for user in users])
+            usage_types = UsageType.objects.bulk_create([
+                UsageType(name='%s-%s' % (prefix, n), unit='kilometers')
+                for n in range(options['usage_types'])])
+        self.stdout.write('Created %s users and %s usage types'
+                          % (len(users), len(usage_types)))
+
+        generator = random.Random(options['seed'])
+        now = timezone.now()
+        seconds = options['days'] * 24 * 3600
+        total = options['usages']
+        created = 0
+        while created < total:
+            batch = []
+            for n in range(created, min(created + options['batch_size'],
+                                        total)):
+                batch.append(Usage(
+                    user=users[n % len(users)],
+                    usage_type=generator.choice(usage_types),
+                    usage_at=now - timedelta(
+                        seconds=generator.randrange(seconds))))
+            # Rollups are rebuilt once at the end, much faster
+            # than counting each batch
+            Usage.objects.bulk_create(batch)
+            created += len(batch)
+            self.stdout.write('Created %s of %s usages' % (created, total))
+
+        rollups.rebuild([user.id for user in users])
+        self.stdout.write(self.style.SUCCESS(
+            'Seeded %s usages for %s users' % (created, len(users))))
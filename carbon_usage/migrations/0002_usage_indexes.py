@@ -0,0 +1,43 @@
+# Generated by Django 3.1.7 on 2026-10-18 08:30
+
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    # Build the indexes without locking out writes to the usage table,
+    # which cannot be done inside a transaction
+    atomic = False
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('carbon_usage', '0001_initial'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='usage',
+            index=models.Index(
+                fields=['user', 'usage_at', 'id'],
+                name='usage_user_usage_at_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='usage',
+            index=models.Index(
+                fields=['user', 'usage_type', 'id'],
+                name='usage_user_usage_type_idx'),
+        ),
+        # Only drop the single column user index once
+        # the composite indexes are in place
+        migrations.AlterField(
+            model_name='usage',
+            name='user',
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.1.7 on 2026-10-18 08:36
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('carbon_usage', '0002_usage_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageDailyRollup',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True, primary_key=True,
+                    serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('count', models.IntegerField(default=0)),
+                ('usage_type', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    to='carbon_usage.usagetype')),
+                ('user', models.ForeignKey(
+                    db_index=False,
+                    on_delete=django.db.models.deletion.CASCADE,
+                    to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='usagedailyrollup',
+            constraint=models.UniqueConstraint(
+                fields=('user', 'day', 'usage_type'),
+                name='usage_rollup_user_day_type'),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 3.1.7 on 2026-10-18 08:56
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+# Stamp inserts, and updates that change the row, with the time and the
+# id of the writing transaction, see changes.py. Saves that write the row
+# back unchanged keep the previous stamp.
+TRACK_CHANGES = """
+CREATE FUNCTION carbon_usage_usage_track_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND
+            (NEW.user_id, NEW.usage_type_id, NEW.usage_at, NEW.deleted_at)
+            IS NOT DISTINCT FROM
+            (OLD.user_id, OLD.usage_type_id, OLD.usage_at, OLD.deleted_at)
+    THEN
+        NEW.modified_at := OLD.modified_at;
+        NEW.change_xid := OLD.change_xid;
+    ELSE
+        NEW.modified_at := now();
+        NEW.change_xid := txid_current();
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER carbon_usage_usage_track_change
+BEFORE INSERT OR UPDATE ON carbon_usage_usage
+FOR EACH ROW EXECUTE PROCEDURE carbon_usage_usage_track_change();
+"""
+
+UNTRACK_CHANGES = """
+DROP TRIGGER carbon_usage_usage_track_change ON carbon_usage_usage;
+DROP FUNCTION carbon_usage_usage_track_change();
+"""
+
+
+class Migration(migrations.Migration):
+
+    # Build the index without locking out writes to the usage table,
+    # which cannot be done inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('carbon_usage', '0003_usage_daily_rollup'),
+    ]
+
+    operations = [
+        # Existing usages are all reported by the first sync, with a
+        # constant default the column is added without rewriting the table
+        migrations.AddField(
+            model_name='usage',
+            name='change_xid',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='usage',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='usage',
+            name='modified_at',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.RunSQL(TRACK_CHANGES, UNTRACK_CHANGES),
+        AddIndexConcurrently(
+            model_name='usage',
+            index=models.Index(
+                fields=['user', 'change_xid', 'id'],
+                name='usage_user_change_idx'),
+        ),
+    ]
@@ -0,0 +1,132 @@
+from django.db import migrations
+
+
+# Move the indexes (but the primary key), foreign keys and the change
+# tracking trigger of table {source} to table {target}, under the same names
+MOVE_DEPENDENTS = """
+DO $$
+DECLARE
+    dependent record;
+BEGIN
+    FOR dependent IN
+        SELECT conname, pg_get_constraintdef(oid) AS definition
+        FROM pg_constraint
+        WHERE conrelid = '{source}'::regclass AND contype = 'f'
+    LOOP
+        EXECUTE format('ALTER TABLE {source} DROP CONSTRAINT %I',
+                       dependent.conname);
+        EXECUTE format('ALTER TABLE {target} ADD CONSTRAINT %I %s',
+                       dependent.conname, dependent.definition);
+    END LOOP;
+
+    FOR dependent IN
+        SELECT indexname, indexdef
+        FROM pg_indexes
+        WHERE tablename = '{source}' AND indexname NOT IN (
+            SELECT conname FROM pg_constraint
+            WHERE conrelid = '{source}'::regclass AND contype = 'p')
+    LOOP
+        EXECUTE format('DROP INDEX %I', dependent.indexname);
+        EXECUTE regexp_replace(dependent.indexdef, ' ON \\S+ USING ',
+                               ' ON {target} USING ');
+    END LOOP;
+END;
+$$;
+
+DROP TRIGGER carbon_usage_usage_track_change ON {source};
+CREATE TRIGGER carbon_usage_usage_track_change
+BEFORE INSERT OR UPDATE ON {target}
+FOR EACH ROW EXECUTE PROCEDURE carbon_usage_usage_track_change();
+"""
+
+# Swap carbon_usage_usage for a copy of it with a primary key of {pk},
+# created by {create}. The trigger is only moved once the rows are copied,
+# so they keep their change stamps
+SWAP = """
+ALTER TABLE carbon_usage_usage RENAME TO carbon_usage_usage_swapped;
+ALTER TABLE carbon_usage_usage_swapped
+    RENAME CONSTRAINT carbon_usage_usage_pkey
+    TO carbon_usage_usage_swapped_pkey;
+
+{create}
+ALTER TABLE carbon_usage_usage
+    ADD CONSTRAINT carbon_usage_usage_pkey PRIMARY KEY ({pk});
+ALTER SEQUENCE carbon_usage_usage_id_seq OWNED BY carbon_usage_usage.id;
+
+INSERT INTO carbon_usage_usage SELECT * FROM carbon_usage_usage_swapped;
+""" + MOVE_DEPENDENTS.format(source='carbon_usage_usage_swapped',
+                             target='carbon_usage_usage') + """
+DROP TABLE carbon_usage_usage_swapped;
+"""
+
+# Monthly partitions, in UTC, from the oldest usage (at most five years
+# back) to three months ahead, later ones are made by the
+# create_usage_partitions command. Anything outside goes to the default
+# partition
+CREATE_PARTITIONED = """
+CREATE TABLE carbon_usage_usage
+    (LIKE carbon_usage_usage_swapped INCLUDING DEFAULTS)
+    PARTITION BY RANGE (usage_at);
+
+DO $$
+DECLARE
+    month timestamp;
+    last_month timestamp;
+BEGIN
+    SELECT date_trunc('month', GREATEST(
+        COALESCE(min(usage_at), now()), now() - interval '5 years')
+        AT TIME ZONE 'UTC')
+    INTO month FROM carbon_usage_usage_swapped;
+    last_month := date_trunc('month', now() AT TIME ZONE 'UTC')
+        + interval '3 months';
+    WHILE month <= last_month LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF carbon_usage_usage '
+            'FOR VALUES FROM (%L) TO (%L)',
+            'carbon_usage_usage_p' || to_char(month, 'YYYY_MM'),
+            month AT TIME ZONE 'UTC',
+            (month + interval '1 month') AT TIME ZONE 'UTC');
+        month := month + interval '1 month';
+    END LOOP;
+END;
+$$;
+
+CREATE TABLE carbon_usage_usage_default
+    PARTITION OF carbon_usage_usage DEFAULT;
+"""
+
+CREATE_UNPARTITIONED = """
+CREATE TABLE carbon_usage_usage
+    (LIKE carbon_usage_usage_swapped INCLUDING DEFAULTS);
+"""
+
+
+def check_version(apps, schema_editor):
+    # BEFORE ROW triggers on partitioned tables, as the change tracking
+    # one, need Postgres 13
+    version = schema_editor.connection.pg_version
+    if version < 130000:
+        raise RuntimeError('Partitioning the usage table needs Postgres 13 '
+                           'or later, this is %s' % version)
+
+
+class Migration(migrations.Migration):
+    """
+    Partition the usage table by month of usage_at
+
+    Postgres wants the partition key in the primary key, so it becomes
+    (id, usage_at). ids still come from the same sequence, the model keeps
+    treating id as the primary key. The rows are copied over in this
+    migration's transaction, during which the usage table is locked.
+    """
+
+    dependencies = [
+        ('carbon_usage', '0004_usage_changes'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_version, migrations.RunPython.noop),
+        migrations.RunSQL(
+            SWAP.format(create=CREATE_PARTITIONED, pk='id, usage_at'),
+            SWAP.format(create=CREATE_UNPARTITIONED, pk='id')),
+    ]
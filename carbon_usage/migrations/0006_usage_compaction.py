@@ -0,0 +1,24 @@
+# Generated by Django 3.1.7 on 2026-10-18 09:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carbon_usage', '0005_partition_usage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageCompaction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('before', models.DateTimeField()),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('compacted', models.IntegerField(default=0)),
+                ('archive', models.CharField(blank=True, max_length=1024)),
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.1.7 on 2026-10-18 09:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carbon_usage', '0006_usage_compaction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usage',
+            name='idempotency_key',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='usage',
+            constraint=models.UniqueConstraint(fields=('user', 'idempotency_key', 'usage_at'), name='usage_user_idempotency_key'),
+        ),
+    ]
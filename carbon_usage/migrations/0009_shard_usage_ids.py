@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.db import migrations
+
+
+# Usage ids are given out in steps of ID_STRIDE, starting from the position
+# of the database in settings.DATABASES, so no two shards ever give out the
+# same id and a usage keeps its id when its user is moved to another shard.
+# Only ever add databases at the end of settings.DATABASES
+ID_STRIDE = 64
+
+
+def stride_usage_ids(apps, schema_editor):
+    connection = schema_editor.connection
+    offset = list(settings.DATABASES).index(connection.alias) % ID_STRIDE
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM carbon_usage_usage')
+        highest = cursor.fetchone()[0]
+        start = highest - highest % ID_STRIDE + ID_STRIDE + offset
+        cursor.execute(
+            'ALTER SEQUENCE carbon_usage_usage_id_seq '
+            'INCREMENT BY %s RESTART WITH %s' % (ID_STRIDE, start))
+
+
+def unstride_usage_ids(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            'ALTER SEQUENCE carbon_usage_usage_id_seq INCREMENT BY 1')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carbon_usage', '0008_user_shards'),
+    ]
+
+    operations = [
+        migrations.RunPython(stride_usage_ids, unstride_usage_ids),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 3.1.7 on 2026-10-18 10:07
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# The keys used so far, by the first usage created with each
+COPY_KEYS = """
+INSERT INTO carbon_usage_usageidempotencykey (user_id, key, usage_id)
+SELECT DISTINCT ON (user_id, idempotency_key) user_id, idempotency_key, id
+FROM carbon_usage_usage
+WHERE idempotency_key IS NOT NULL
+ORDER BY user_id, idempotency_key, id;
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('carbon_usage', '0009_shard_usage_ids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageIdempotencyKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255)),
+                ('usage_id', models.IntegerField()),
+            ],
+        ),
+        migrations.RemoveConstraint(
+            model_name='usage',
+            name='usage_user_idempotency_key',
+        ),
+        migrations.AddField(
+            model_name='usageidempotencykey',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='usageidempotencykey',
+            constraint=models.UniqueConstraint(fields=('user', 'key'), name='usage_idempotency_key_user_key'),
+        ),
+        migrations.RunSQL(COPY_KEYS, migrations.RunSQL.noop),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
@@ -19,10 +20,174 @@ class UsageType(models.Model):
         return self.name
 
 
+class LiveUsageManager(models.Manager):
+    """
+    Leaves out deleted usages, which are kept as tombstones
+    """
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
 class Usage(models.Model):
-    user = models.ForeignKey('auth.User', on_delete=models.CASCADE)
-    usage_type = models.ForeignKey(UsageType, on_delete=models.CASCADE)
+    # The table is partitioned by month of usage_at, see partitions.py.
+    # Its primary key in the database is (id, usage_at), ids are still
+    # unique as they all come from the one sequence
+    # The composite indexes below all lead with user,
+    # so a separate single column index on it is redundant.
+    # Users and usage types are kept on the default database, usages
+    # possibly on another shard, so the foreign keys are not constraints
+    # in the database, see sharding.py
+    user = models.ForeignKey('auth.User', on_delete=models.CASCADE,
+                             db_index=False, db_constraint=False)
+    usage_type = models.ForeignKey(UsageType, on_delete=models.CASCADE,
+                                   db_constraint=False)
     usage_at = models.DateTimeField('usage date')
 
+    # Set by the database on every insert, and on every update that
+    # changes the row, see changes.py and migration 0004
+    modified_at = models.DateTimeField(null=True, editable=False)
+    change_xid = models.BigIntegerField(default=0, editable=False)
+    # Deleted usages are kept, so the changes feed can report them
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    # Given by the client, a retried write returns the usage created
+    # with the same key instead of creating another. Keys are unique in
+    # UsageIdempotencyKey, see ingest.py
+    idempotency_key = models.CharField(max_length=255, null=True, blank=True,
+                                       editable=False)
+
+    objects = LiveUsageManager()
+    all_objects = models.Manager()
+
+    class Meta:
+        # Every api query is scoped to a user, then range filtered and/or
+        # ordered by usage_at or usage_type. The id column is the tie
+        # breaker used by keyset pagination, see pagination.py
+        indexes = [
+            models.Index(fields=['user', 'usage_at', 'id'],
+                         name='usage_user_usage_at_idx'),
+            models.Index(fields=['user', 'usage_type', 'id'],
+                         name='usage_user_usage_type_idx'),
+            # The changes feed, see changes.py
+            models.Index(fields=['user', 'change_xid', 'id'],
+                         name='usage_user_change_idx'),
+        ]
+
     def __str__(self):
         return self.usage_type.name
+
+    def delete(self, using=None, keep_parents=False):
+        """
+        Mark the usage deleted, leaving a tombstone for the changes feed
+
+        Deleting querysets, or the usage's user, still removes rows.
+        """
+        self.deleted_at = timezone.now()
+        self.save(using=using, update_fields=['deleted_at'])
+        return 1, {self._meta.label: 1}
+
+    def hard_delete(self, using=None, keep_parents=False):
+        return super().delete(using=using, keep_parents=keep_parents)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the values as loaded, so an update can move the
+        # usage out of its old rollup without re-reading it
+        if ROLLUP_FIELDS.issubset(field_names):
+            instance._loaded_values = (instance.user_id,
+                                       instance.usage_type_id,
+                                       instance.usage_at,
+                                       instance.deleted_at)
+        return instance
+
+
+ROLLUP_FIELDS = {'user_id', 'usage_type_id', 'usage_at', 'deleted_at'}
+
+
+class UsageDailyRollup(models.Model):
+    """
+    Number of usages per user, usage type and day
+
+    Kept up to date as usages are written, see rollups.py. Days are
+    calendar days in settings.TIME_ZONE.
+    """
+    # On the user's shard, as the usages, see sharding.py
+    user = models.ForeignKey('auth.User', on_delete=models.CASCADE,
+                             db_index=False, db_constraint=False)
+    usage_type = models.ForeignKey(UsageType, on_delete=models.CASCADE,
+                                   db_constraint=False)
+    day = models.DateField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        # Summaries read a day range of a single user across usage types
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'day', 'usage_type'],
+                                    name='usage_rollup_user_day_type'),
+        ]
+
+    def __str__(self):
+        return '%s %s: %s' % (self.day, self.usage_type_id, self.count)
+
+
+class UsageIdempotencyKey(models.Model):
+    """
+    An idempotency key a user created a usage with
+
+    Unique indexes of the partitioned usage table have to hold usage_at,
+    so keys are made unique per user in this table instead, see ingest.py.
+    """
+    # On the user's shard, as the usages, see sharding.py
+    user = models.ForeignKey('auth.User', on_delete=models.CASCADE,
+                             db_index=False, db_constraint=False)
+    key = models.CharField(max_length=255)
+    # Not a foreign key, the primary key of usages holds usage_at too
+    usage_id = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'],
+                                    name='usage_idempotency_key_user_key'),
+        ]
+
+    def __str__(self):
+        return '%s %s: %s' % (self.user_id, self.key, self.usage_id)
+
+
+class UsageCompaction(models.Model):
+    """
+    A run of the compact_usages command
+
+    Usages before before are deleted, only their daily rollups are kept,
+    see compaction.py.
+    """
+    before = models.DateTimeField()
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Usages deleted so far
+    compacted = models.IntegerField(default=0)
+    archive = models.CharField(max_length=1024, blank=True)
+
+    def __str__(self):
+        return 'before %s: %s' % (self.before, self.compacted)
+
+
+class UserShard(models.Model):
+    """
+    The shard database holding a user's usages, see sharding.py
+
+    Users without one are on the first of settings.USAGE_SHARDS['ALIASES'].
+    """
+    user = models.OneToOneField('auth.User', on_delete=models.CASCADE,
+                                primary_key=True)
+    alias = models.CharField(max_length=100)
+    # Set while the user is moved to another shard, their writes are
+    # refused meanwhile
+    moving = models.BooleanField(default=False)
+    # Times the user was moved, changes feed cursors given before the
+    # last move start the feed over
+    epoch = models.IntegerField(default=0)
+
+    def __str__(self):
+        return '%s: %s' % (self.user_id, self.alias)
@@ -0,0 +1,186 @@
+from base64 import b64decode, b64encode
+from collections import namedtuple
+from urllib import parse
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.urls import replace_query_param
+
+"""
+Keyset pagination for the usage api
+
+DRF's CursorPagination only seeks on the first ordering field and falls
+back to an OFFSET for ties, which degrades badly when ordering by a
+low cardinality column such as usage_type. Here the cursor carries the
+full sort key of the boundary row, always ending with the primary key,
+so every page is a single index seek with no COUNT(*) and no OFFSET.
+"""
+
+Cursor = namedtuple('Cursor', ['reverse', 'position'])
+
+
+def ordering_keys(model, ordering):
+    """
+    Return the sort key of ordering as (field name, attname, descending)
+    triples
+
+    The primary key is always appended as a tie breaker, in the same
+    direction as the leading field so a single index can serve it.
+    """
+    keys = []
+    for term in ordering:
+        name = term.lstrip('-')
+        if name in ('pk', model._meta.pk.name):
+            break
+        field = model._meta.get_field(name)
+        keys.append((name, field.attname, term.startswith('-')))
+    descending = keys[0][2] if keys else False
+    pk = model._meta.pk
+    keys.append((pk.name, pk.attname, descending))
+    return keys
+
+
+def seek(keys, position, reverse=False):
+    """
+    Build the WHERE clause selecting rows strictly after position, the
+    values of keys of a row
+
+    Equivalent to a row comparison (a, b, id) > (x, y, z), spelled out
+    as a disjunction so it works with mixed sort directions. The
+    leading >= bound is redundant but lets the planner seek the index.
+    """
+    condition = Q()
+    equal = Q()
+    for (name, _, descending), value in zip(keys, position):
+        lookup = 'lt' if descending != reverse else 'gt'
+        condition |= equal & Q(**{'%s__%s' % (name, lookup): value})
+        equal &= Q(**{name: value})
+
+    name, _, descending = keys[0]
+    lookup = 'lte' if descending != reverse else 'gte'
+    leading = Q(**{'%s__%s' % (name, lookup): position[0]})
+    return leading & condition
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Opaque next/previous cursors over (ordering fields..., id)
+    """
+    ordering = 'usage_at'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.keys = self.get_keys(queryset.model, request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+
+        reverse = self.cursor is not None and self.cursor.reverse
+        queryset = queryset.order_by(*[
+            ('-' if descending != reverse else '') + name
+            for name, _, descending in self.keys
+        ])
+        if queryset._fields:
+            # The cursor is read off the rows of a values() queryset
+            missing = [attname for _, attname, _ in self.keys
+                       if attname not in queryset._fields]
+            if missing:
+                queryset = queryset.values(*queryset._fields, *missing)
+        if self.cursor is not None:
+            queryset = queryset.filter(self._seek(self.cursor))
+
+        # Fetch one extra row to find out if there is a following page
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_following = len(results) > self.page_size
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = True
+            self.has_previous = has_following
+        else:
+            self.has_next = has_following
+            self.has_previous = self.cursor is not None
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
+
+    def get_ordering(self, request, queryset, view):
+        # The ordering filter returns None when no ?ordering is given,
+        # fall back to our own default rather than asserting
+        for filter_cls in getattr(view, 'filter_backends', []):
+            if hasattr(filter_cls, 'get_ordering'):
+                ordering = filter_cls().get_ordering(request, queryset, view)
+                if ordering:
+                    return tuple(ordering)
+        return (self.ordering,)
+
+    def get_keys(self, model, request, queryset, view):
+        keys = ordering_keys(model,
+                             self.get_ordering(request, queryset, view))
+        self.fields = [model._meta.get_field(name) for name, _, _ in keys]
+        return keys
+
+    def _seek(self, cursor):
+        return seek(self.keys, cursor.position, cursor.reverse)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if not self.page:
+            # An empty reversed page, step forward from where we were
+            return self.encode_cursor(Cursor(False, self.cursor.position))
+        return self.encode_cursor(
+            Cursor(False, self._get_position_from_instance(self.page[-1])))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return self.encode_cursor(Cursor(True, self.cursor.position))
+        return self.encode_cursor(
+            Cursor(True, self._get_position_from_instance(self.page[0])))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            querystring = b64decode(encoded.encode('ascii')).decode('ascii')
+            tokens = parse.parse_qs(querystring, keep_blank_values=True)
+            reverse = bool(int(tokens.get('r', ['0'])[0]))
+            position = tokens['p']
+            if len(position) != len(self.fields):
+                raise ValueError()
+            position = [field.to_python(value)
+                        for field, value in zip(self.fields, position)]
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+        return Cursor(reverse=reverse, position=position)
+
+    def encode_cursor(self, cursor):
+        tokens = {'p': [self._encode_value(value) for value in cursor.position]}
+        if cursor.reverse:
+            tokens['r'] = '1'
+
+        querystring = parse.urlencode(tokens, doseq=True)
+        encoded = b64encode(querystring.encode('ascii')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def _encode_value(self, value):
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        return str(value)
+
+    def _get_position_from_instance(self, instance, ordering=None):
+        if isinstance(instance, dict):
+            return [instance[attname] for _, attname, _ in self.keys]
+        return [getattr(instance, attname) for _, attname, _ in self.keys]
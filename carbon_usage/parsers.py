@@ -0,0 +1,69 @@
+import codecs
+import io
+
+import orjson
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, JSONParser
+from rest_framework.settings import api_settings
+from rest_framework.utils import json
+
+
+def loads(data, parse_constant=None):
+    """
+    json.loads, through orjson for anything but what orjson rejects
+
+    orjson rejects everything the json module does, and more (NaN,
+    integers beyond 64 bits...), which the json module then gets to
+    accept or word the error for.
+    """
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data, parse_constant=parse_constant)
+
+
+class ORJSONParser(JSONParser):
+    """
+    JSONParser parsing with orjson, see loads()
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        if codecs.lookup(encoding).name != 'utf-8':
+            return super().parse(stream, media_type, parser_context)
+
+        body = stream.read()
+        try:
+            return orjson.loads(body)
+        except orjson.JSONDecodeError:
+            return super().parse(io.BytesIO(body), media_type,
+                                 parser_context)
+
+
+class NDJSONParser(BaseParser):
+    """
+    Parses newline delimited JSON, one object per line, into a list
+    """
+    media_type = 'application/x-ndjson'
+    strict = api_settings.STRICT_JSON
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        parse_constant = json.strict_constant if self.strict else None
+
+        rows = []
+        decoded_stream = codecs.getreader(encoding)(stream)
+        for line_number, line in enumerate(decoded_stream, start=1):
+            # Tolerate blank lines, e.g. a trailing newline
+            if not line.strip():
+                continue
+            try:
+                rows.append(loads(line, parse_constant))
+            except ValueError as exc:
+                raise ParseError('NDJSON parse error on line %s - %s'
+                                 % (line_number, str(exc)))
+        return rows
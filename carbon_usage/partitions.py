@@ -0,0 +1,98 @@
+from datetime import datetime
+
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .models import Usage
+
+"""
+Monthly partitions of the usage table
+
+The usage table is partitioned by range of usage_at, one partition per
+UTC month named <table>_pYYYY_MM, see migration 0005. Usages outside of
+every month partition land in the default partition <table>_default, so
+partitions for the months ahead must be created before they start, see
+the create_usage_partitions management command.
+
+Queries filtering on usage_at only scan the partitions of the months in
+range.
+"""
+
+# Months created ahead of the current one by default
+MONTHS_AHEAD = 3
+
+
+def add_months(month, months):
+    month_index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=month_index // 12, month=month_index % 12 + 1)
+
+
+def month_of(value):
+    """
+    Return the start of the UTC month value is in
+    """
+    value = value.astimezone(timezone.utc)
+    return datetime(value.year, value.month, 1, tzinfo=timezone.utc)
+
+
+def partition_name(month):
+    return '%s_p%04d_%02d' % (Usage._meta.db_table, month.year, month.month)
+
+
+def partitions(using='default'):
+    """
+    Return the names of the partitions of the usage table
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            'SELECT inhrelid::regclass::text FROM pg_inherits '
+            'WHERE inhparent = %s::regclass ORDER BY 1',
+            [Usage._meta.db_table])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def create_partition(month, using='default'):
+    """
+    Create the partition of month, moving its usages out of the default
+    partition
+
+    The partition is filled as a table of its own, then attached. Rows
+    are moved with plain SQL, which neither restamps them as changed nor
+    touches the rollups, they only change partition.
+    """
+    table = Usage._meta.db_table
+    name = partition_name(month)
+    default = '%s_default' % table
+    bounds = [month, add_months(month, 1)]
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute(
+            'CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)'
+            % (quote(name), quote(table)))
+        cursor.execute(
+            'WITH moved AS (DELETE FROM %s WHERE usage_at >= %%s '
+            'AND usage_at < %%s RETURNING *) INSERT INTO %s '
+            'SELECT * FROM moved' % (quote(default), quote(name)), bounds)
+        cursor.execute(
+            'ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (%%s) '
+            'TO (%%s)' % (quote(table), quote(name)), bounds)
+    return name
+
+
+def create_partitions(months_ahead=MONTHS_AHEAD, since=None,
+                      using='default'):
+    """
+    Create the missing partitions from the month of since, this month by
+    default, to months_ahead months ahead, return the names of the ones
+    created
+    """
+    existing = set(partitions(using))
+    month = month_of(since or timezone.now())
+    last_month = add_months(month_of(timezone.now()), months_ahead)
+    created = []
+    while month <= last_month:
+        if partition_name(month) not in existing:
+            created.append(create_partition(month, using))
+        month = add_months(month, 1)
+    return created
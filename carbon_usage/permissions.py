@@ -8,4 +8,5 @@ class IsOwner(permissions.BasePermission):
 
     def has_object_permission(self, request, view, obj):
         # Permissions are only allowed to the owner of the snippet.
-        return obj.user == request.user
+        # Compare ids, so the owner does not need to be loaded
+        return obj.user_id == request.user.id
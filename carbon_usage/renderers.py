@@ -0,0 +1,143 @@
+import csv
+import io
+
+import msgpack
+import orjson
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils import encoders
+
+"""
+Renderers for the api and the usage export formats
+
+ORJSONRenderer is the api's JSON renderer, MessagePackRenderer a columnar
+binary format for bulk reads, see their docstrings.
+
+Besides the regular render() used for small payloads such as error
+responses, each export renderer can encode an iterator of rows chunk by
+chunk with render_stream(), so an export never holds more than a chunk
+of rows in memory.
+"""
+
+ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+
+# orjson handles str, int, float, bool, None, dicts, lists, datetimes,
+# dates and times itself. Everything else (Decimal, lazy translations,
+# querysets...) is turned into one of those the way DRF's encoder does
+orjson_default = encoders.JSONEncoder().default
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer producing the same bytes, encoded with orjson
+
+    Datetimes, dates and times are encoded by orjson directly, in the
+    format DRF's encoder uses, so serializers may hand them over without
+    formatting them first. Pretty printed output (?format=api, an
+    indent in the Accept header) and anything orjson cannot encode, like
+    integers beyond 64 bits, goes through JSONRenderer.
+
+    Floats are the exception to the byte for byte promise: orjson writes
+    1e16 and null for NaN where the json module writes 1e+16 and NaN.
+    No api route returns floats.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if indent is not None or self.ensure_ascii or not self.compact:
+            return super().render(data, accepted_media_type,
+                                  renderer_context)
+        try:
+            ret = orjson.dumps(data, default=orjson_default,
+                               option=ORJSON_OPTIONS)
+        except TypeError:
+            return super().render(data, accepted_media_type,
+                                  renderer_context)
+        # Escaped by JSONRenderer so the output is valid javascript
+        if b'\xe2\x80\xa8' in ret or b'\xe2\x80\xa9' in ret:
+            ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(
+                b'\xe2\x80\xa9', b'\\u2029')
+        return ret
+
+
+class StreamingRenderer(BaseRenderer):
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if isinstance(data, dict):
+            data = [data]
+        fields = list(data[0].keys()) if data else []
+        rows = ([row.get(field) for field in fields] for row in data)
+        return b''.join(self.render_stream(fields, [rows]))
+
+    def render_stream(self, fields, chunks):
+        """
+        Encode chunks (iterables of row tuples) into an iterator of bytes
+        """
+        raise NotImplementedError('render_stream() must be overridden.')
+
+
+class CSVRenderer(StreamingRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+    def render_stream(self, fields, chunks):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(fields)
+        for chunk in chunks:
+            writer.writerows(chunk)
+            yield buffer.getvalue().encode(self.charset)
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode(self.charset)
+
+
+class NDJSONRenderer(StreamingRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def render_stream(self, fields, chunks):
+        for chunk in chunks:
+            lines = [orjson.dumps(dict(zip(fields, row)),
+                                  default=orjson_default,
+                                  option=ORJSON_OPTIONS)
+                     for row in chunk]
+            if lines:
+                yield b'\n'.join(lines) + b'\n'
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Columnar MessagePack, for bulk reads of usages
+
+    Views check for columnar and hand this renderer parallel arrays of
+    column values rather than a dict per row, see
+    UsageSerializer.to_columns(). Anything else, such as error responses,
+    is packed as is.
+    """
+    media_type = 'application/x-msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    columnar = True
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=orjson_default)
+
+    def render_stream(self, fields, chunks):
+        """
+        Pack each chunk of columns as its own MessagePack map, read them
+        back with msgpack.Unpacker
+        """
+        packer = msgpack.Packer(default=orjson_default)
+        for chunk in chunks:
+            yield packer.pack(chunk)
@@ -0,0 +1,128 @@
+import random
+
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.permissions import SAFE_METHODS
+
+from .export import in_context
+
+"""
+Reads of the usage api from read replicas
+
+The usage and usage type views read from one of the replica aliases in
+settings.USAGE_READ_REPLICAS['ALIASES'], picked at random per request,
+while every write, and every read outside of these views, goes to the
+default database.
+
+A user who wrote through these views is pinned to the default database
+for PIN_SECONDS after, so they always read their own writes, as long as
+the replicas lag less than that behind. The pins are kept in the CACHE
+alias of settings.CACHES, which has to be shared by all processes when
+running several.
+
+The replica a view reads from is kept in a context variable for
+ReplicaRouter, the router in settings.DATABASE_ROUTERS, to return.
+"""
+
+_read_alias = ContextVar('carbon_usage_read_alias', default=None)
+
+
+def replica_aliases():
+    return settings.USAGE_READ_REPLICAS['ALIASES']
+
+
+@contextmanager
+def reading_from(alias):
+    """
+    Send the reads in the block to the alias database, None for default
+    """
+    token = _read_alias.set(alias)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+def _pin_key(user_id):
+    return 'carbon_usage:primary_pin:%s' % user_id
+
+
+def pin(user_id):
+    """
+    Have user read from the default database for the next PIN_SECONDS
+    """
+    config = settings.USAGE_READ_REPLICAS
+    if config['ALIASES']:
+        caches[config['CACHE']].set(_pin_key(user_id), True,
+                                    config['PIN_SECONDS'])
+
+
+def replica_for(user):
+    """
+    Return the replica alias user may read from, None for the default one
+    """
+    aliases = replica_aliases()
+    if not aliases:
+        return None
+    if user.is_authenticated and caches[
+            settings.USAGE_READ_REPLICAS['CACHE']].get(_pin_key(user.id)):
+        return None
+    return random.choice(aliases)
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        # Instances read from a replica are saved to the default database
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in replica_aliases():
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db in replica_aliases():
+            return False
+        return None
+
+
+class ReplicaReadMixin:
+    """
+    Sends the reads of a view's safe requests to a replica, and pins the
+    users of its successful other requests to the default database
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with reading_from(None):
+            return super().dispatch(request, *args, **kwargs)
+
+    def initial(self, request, *args, **kwargs):
+        # The user is only known once authenticated
+        super().initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS:
+            self.read_alias = replica_for(request.user)
+            _read_alias.set(self.read_alias)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(
+            request, response, *args, **kwargs)
+        if request.method not in SAFE_METHODS:
+            if response.status_code < 400 and request.user.is_authenticated:
+                pin(request.user.id)
+        elif response.streaming and getattr(self, 'read_alias', None):
+            # Read after the view returns
+            response.streaming_content = in_context(
+                response.streaming_content, copy_context())
+        return response
@@ -0,0 +1,114 @@
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from rest_framework.response import Response
+
+from .models import Usage
+
+"""
+Cache of usage list responses, per user
+
+Entries are keyed by the user's current version and the normalized
+request, and a write to any of the user's usages (the api, the bulk
+route, the admin...) moves the version on, so an entry is never served
+after a write. Old entries are left to expire or be culled by the cache.
+
+The cache is the USAGE_RESPONSE_CACHE alias of settings.CACHES. With a
+local memory backend each process only sees its own writes, use a backend
+shared by all processes (file based, memcached...) when running several.
+"""
+
+
+def response_cache():
+    alias = settings.USAGE_RESPONSE_CACHE
+    return caches[alias] if alias else None
+
+
+def _version_key(user_id):
+    return 'carbon_usage:usage_responses:version:%s' % user_id
+
+
+def _new_version():
+    # Never a value used before, so an evicted version cannot come back
+    # and match entries stored before a write
+    return uuid.uuid4().hex
+
+
+def version(cache, user_id):
+    return cache.get_or_set(_version_key(user_id), _new_version)
+
+
+def bump_version(user_id):
+    """
+    Make every cached response of the user stale
+    """
+    cache = response_cache()
+    if cache is not None:
+        cache.set(_version_key(user_id), _new_version())
+
+
+def bump_version_on_commit(user_id, using=DEFAULT_DB_ALIAS):
+    # Bump now, and again once the write is visible to other requests, so
+    # a response built from the old rows in between is not kept either
+    bump_version(user_id)
+    transaction.on_commit(lambda: bump_version(user_id), using=using)
+
+
+def response_key(cache, request):
+    """
+    Key of the response to request, with query parameters normalized
+    """
+    request_hash = hashlib.sha1(repr((
+        request.get_host(),
+        request.path,
+        sorted(request.query_params.lists()),
+        request.accepted_media_type,
+    )).encode()).hexdigest()
+    return 'carbon_usage:usage_responses:%s:%s:%s' % (
+        request.user.id, version(cache, request.user.id), request_hash)
+
+
+def cached_response(request, respond):
+    """
+    Return the cached response to request, or call respond() and cache
+    the data of its response
+
+    The data is cached rather than the rendered response, so cached
+    responses still carry .data, rendering it is cheap next to the query
+    and serialization. Only responses rendered for machines are cached,
+    the browsable api embeds per request details such as CSRF tokens.
+    """
+    cache = response_cache()
+    if cache is None or request.accepted_renderer.format == 'api':
+        return respond()
+
+    key = response_key(cache, request)
+    data = cache.get(key)
+    if data is not None:
+        return Response(data)
+
+    response = respond()
+    if response.status_code == 200:
+        cache.set(key, response.data)
+    return response
+
+
+@receiver(pre_save, sender=Usage)
+def invalidate_previous_user_responses(sender, instance, using, **kwargs):
+    # A usage moved to another user also leaves the lists of its old
+    # user, as loaded by rollups.remember_previous_values() which is
+    # connected before this
+    previous = getattr(instance, '_loaded_values', None)
+    if previous is not None and previous[0] != instance.user_id:
+        bump_version_on_commit(previous[0], using)
+
+
+@receiver(post_save, sender=Usage)
+@receiver(post_delete, sender=Usage)
+def invalidate_user_responses(sender, instance, using, **kwargs):
+    bump_version_on_commit(instance.user_id, using)
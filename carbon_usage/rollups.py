@@ -0,0 +1,262 @@
+from collections import Counter
+from datetime import datetime, time
+
+from django.db import connections, transaction
+from django.db.models import Sum
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Usage, UsageDailyRollup, UsageCompaction
+from .sharding import group_by_shard
+
+"""
+Incrementally maintained daily usage counts
+
+Every usage written through the ORM (the api, the admin, the bulk path)
+moves the count of its (user, usage_type, day) rollup row, in the same
+database as the usage. Summaries can then be answered from at most one
+row per user, usage type and day instead of scanning every usage.
+
+Writes that bypass the ORM signals, such as QuerySet.update() or raw SQL,
+must call apply_deltas() themselves or be followed by a rebuild, see the
+rebuild_usage_rollups management command.
+"""
+
+# Keys per statement when applying many deltas at once
+BATCH_SIZE = 1000
+
+
+def rollup_timezone():
+    return timezone.get_default_timezone()
+
+
+def rollup_key(user_id, usage_type_id, usage_at):
+    """
+    Return the (user_id, usage_type_id, day) rollup row a usage counts in
+    """
+    usage_at = Usage._meta.get_field('usage_at').to_python(usage_at)
+    if timezone.is_naive(usage_at):
+        # Django stores naive datetimes in the default time zone
+        usage_at = timezone.make_aware(usage_at, rollup_timezone())
+    return (user_id, usage_type_id,
+            timezone.localtime(usage_at, rollup_timezone()).date())
+
+
+def apply_deltas(deltas, using='default'):
+    """
+    Add a Counter of {rollup key: change in count} to the rollup table
+
+    Keys are applied in sorted order, so concurrent writers always lock
+    rollup rows in the same order and cannot deadlock each other.
+    Decrements only ever update existing rows, they never insert one.
+    """
+    increments = sorted((key, n) for key, n in deltas.items() if n > 0)
+    decrements = sorted((key, n) for key, n in deltas.items() if n < 0)
+    table = UsageDailyRollup._meta.db_table
+
+    with connections[using].cursor() as cursor:
+        for batch in _batches(increments):
+            cursor.execute(
+                'INSERT INTO {table} (user_id, usage_type_id, day, count) '
+                'VALUES {values} '
+                'ON CONFLICT (user_id, day, usage_type_id) '
+                'DO UPDATE SET count = {table}.count + EXCLUDED.count'.format(
+                    table=table,
+                    values=', '.join(['(%s, %s, %s, %s)'] * len(batch))),
+                [value for key, n in batch for value in (*key, n)])
+        for batch in _batches(decrements):
+            cursor.execute(
+                'UPDATE {table} SET count = {table}.count + v.delta '
+                'FROM (VALUES {values}) AS v (user_id, usage_type_id, day, delta) '
+                'WHERE {table}.user_id = v.user_id '
+                'AND {table}.usage_type_id = v.usage_type_id '
+                'AND {table}.day = v.day'.format(
+                    table=table,
+                    values=', '.join(['(%s, %s, %s::date, %s)'] * len(batch))),
+                [value for key, n in batch for value in (*key, n)])
+
+
+def _batches(items):
+    for start in range(0, len(items), BATCH_SIZE):
+        yield items[start:start + BATCH_SIZE]
+
+
+def count_usages(usages):
+    """
+    Return the rollup deltas for creating the given Usage instances
+    """
+    return Counter(rollup_key(usage.user_id, usage.usage_type_id,
+                              usage.usage_at)
+                   for usage in usages)
+
+
+def usage_counts(users):
+    """
+    Return {user id: number of live usages} of a list of users, summed
+    from their rollups on the shard of each
+
+    Usages compacted away are still counted, see compaction.py.
+    """
+    counts = {}
+    for alias, indexes in group_by_shard(users).items():
+        counts.update(
+            UsageDailyRollup.objects.using(alias)
+            .filter(user_id__in=[users[index].id for index in indexes])
+            .order_by().values_list('user_id').annotate(Sum('count')))
+    return counts
+
+
+def compacted_before(using='default'):
+    """
+    Return the latest horizon usages were compacted before, or None
+
+    The usages before it are gone, only their rollups are left, see
+    compaction.py.
+    """
+    compaction = (UsageCompaction.objects.using(using)
+                  .order_by('-before').first())
+    return compaction.before if compaction else None
+
+
+def rebuild(user_ids, using='default'):
+    """
+    Recompute the rollups of the given users from their usages
+
+    Writes to the usage table are blocked until the transaction commits,
+    so that no usage is counted twice or missed. Keep user_ids short.
+    Days before the last compaction are left as they are.
+    """
+    usage_table = Usage._meta.db_table
+    rollup_table = UsageDailyRollup._meta.db_table
+    rollup_filter = usage_filter = ''
+    rollup_params = usage_params = [list(user_ids)]
+    before = compacted_before(using)
+    if before is not None:
+        rollup_filter = ' AND day >= %s'
+        rollup_params = rollup_params + [
+            timezone.localtime(before, rollup_timezone()).date()]
+        usage_filter = ' AND usage_at >= %s'
+        usage_params = usage_params + [before]
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            set_local_timezone(cursor, rollup_timezone())
+            cursor.execute('LOCK TABLE %s IN SHARE MODE' % usage_table)
+            cursor.execute(
+                'DELETE FROM %s WHERE user_id = ANY(%%s)%s'
+                % (rollup_table, rollup_filter), rollup_params)
+            cursor.execute(
+                'INSERT INTO {rollup} (user_id, usage_type_id, day, count) '
+                'SELECT user_id, usage_type_id, usage_at::date, COUNT(*) '
+                'FROM {usage} WHERE user_id = ANY(%s) '
+                'AND deleted_at IS NULL{usage_filter} '
+                'GROUP BY 1, 2, 3'.format(rollup=rollup_table,
+                                          usage=usage_table,
+                                          usage_filter=usage_filter),
+                usage_params)
+            return cursor.rowcount
+
+
+def set_local_timezone(cursor, tz):
+    """
+    Make date and date_trunc conversions use tz until the transaction ends
+
+    Postgres reads a zone name such as 'CET' in AT TIME ZONE as the fixed
+    offset abbreviation, ignoring daylight saving time. The session time
+    zone is always the full zone with its DST rules, same as pytz.
+    """
+    cursor.execute('SET LOCAL TIME ZONE %s', [tz.zone])
+
+
+def day_range(tz, timerange_start=None, timerange_end=None):
+    """
+    Translate the timerange filters into a range of rollup days
+
+    Returns (first day, last day), either possibly None for an open end,
+    or raises ValueError if the rollups cannot answer the range exactly:
+    a different time zone, or bounds that do not fall on day boundaries.
+    """
+    if tz.zone != rollup_timezone().zone:
+        raise ValueError('Rollups are kept in %s' % rollup_timezone().zone)
+
+    first_day = last_day = None
+    if timerange_start is not None:
+        start = _local(timerange_start)
+        if start.time() != time.min:
+            raise ValueError('timerange_start is not at midnight')
+        first_day = start.date()
+    if timerange_end is not None:
+        end = _local(timerange_end)
+        # timerange_end is inclusive, so must be the last instant of a day
+        if end.time() != time.max:
+            raise ValueError('timerange_end is not at the end of a day')
+        last_day = end.date()
+    return first_day, last_day
+
+
+def starts_before(timerange_start, before):
+    """
+    Return whether a range from timerange_start, None for an open start,
+    takes in usages from before the datetime before
+    """
+    if timerange_start is None:
+        return True
+    try:
+        return _local(timerange_start) < before
+    except ValueError:
+        return True
+
+
+def _local(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError('Cannot parse %s' % value)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, rollup_timezone())
+    return timezone.localtime(parsed, rollup_timezone())
+
+
+def day_start(day, tz):
+    """
+    Return midnight at the start of day in tz, as an aware datetime
+    """
+    return tz.localize(datetime.combine(day, time.min))
+
+
+@receiver(pre_save, sender=Usage)
+def remember_previous_values(sender, instance, **kwargs):
+    # Usages loaded from the database already carry their previous
+    # values (see Usage.from_db), only look them up otherwise
+    if not instance._state.adding and not hasattr(instance, '_loaded_values'):
+        instance._loaded_values = (
+            sender._base_manager.using(kwargs['using'])
+            .filter(pk=instance.pk)
+            .values_list('user_id', 'usage_type_id', 'usage_at',
+                         'deleted_at').first())
+
+
+# The values remembered are (user_id, usage_type_id, usage_at, deleted_at),
+# deleted usages (tombstones) are not counted
+
+@receiver(post_save, sender=Usage)
+def count_saved_usage(sender, instance, created, using, **kwargs):
+    deltas = Counter()
+    previous = getattr(instance, '_loaded_values', None)
+    if not created and previous is not None and previous[3] is None:
+        deltas[rollup_key(*previous[:3])] -= 1
+    current = (instance.user_id, instance.usage_type_id, instance.usage_at,
+               instance.deleted_at)
+    if instance.deleted_at is None:
+        deltas[rollup_key(*current[:3])] += 1
+    apply_deltas(deltas, using=using)
+    instance._loaded_values = current
+
+
+@receiver(post_delete, sender=Usage)
+def count_deleted_usage(sender, instance, using, **kwargs):
+    previous = getattr(instance, '_loaded_values', None) or (
+        instance.user_id, instance.usage_type_id, instance.usage_at,
+        instance.deleted_at)
+    if previous[3] is None:
+        apply_deltas(Counter({rollup_key(*previous[:3]): -1}), using=using)
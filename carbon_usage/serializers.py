@@ -1,27 +1,209 @@
+import pytz
+
+from datetime import datetime, timedelta
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth.models import User
+from .catalogue import catalogue
+from .changes import decode_cursor
 from .models import UsageType, Usage
+from .sparse_fields import SparseFieldsMixin
 
 
 class UserSerializer(serializers.ModelSerializer):
 
-    usage = serializers.PrimaryKeyRelatedField(
-        many=True, queryset=Usage.objects.all())
+    # Set on a page of users at once, see views.UserList
+    usage_count = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = User
-        fields = ['id', 'username', 'usage']
+        fields = ['id', 'username', 'usage_count']
 
 
-class UsageTypeSerializer(serializers.ModelSerializer):
+class UsageTypeSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = UsageType
         fields = ['name', 'unit', 'id']
 
 
-class UsageSerializer(serializers.ModelSerializer):
+class CatalogueUsageTypeField(serializers.PrimaryKeyRelatedField):
+    """
+    A usage type by id, looked up in the usage type catalogue
+
+    Validating a usage does not need a query for its usage type,
+    see catalogue.py
+    """
+
+    def to_internal_value(self, data):
+        try:
+            usage_type = catalogue.get(int(data))
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if usage_type is None:
+            self.fail('does_not_exist', pk_value=data)
+        return usage_type
+
+
+class UsageSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     user = serializers.CharField(read_only=True, source='user.username')
+    usage_type = CatalogueUsageTypeField(queryset=UsageType.objects.all())
+    # Also taken from the Idempotency-Key header, see UsageViewSet.create
+    idempotency_key = serializers.CharField(write_only=True, required=False,
+                                            max_length=255)
 
     class Meta:
         model = Usage
-        fields = ['user', 'usage_type', 'usage_at', 'id']
+        fields = ['user', 'usage_type', 'usage_at', 'id', 'idempotency_key']
+
+    def update(self, instance, validated_data):
+        # Keys only identify the write that created a usage
+        validated_data.pop('idempotency_key', None)
+        return super().update(instance, validated_data)
+
+    # Columns needed by to_representation_fast()
+    fast_values = ['usage_type_id', 'usage_at', 'id']
+
+    @classmethod
+    def fast_values_for(cls, fields=None):
+        """
+        Return the columns needed to represent fields, a list of field
+        names or None for all of them
+
+        The username comes from the request's user rather than a join.
+        id is always read, values() of no columns would read them all.
+        """
+        if fields is None:
+            return cls.fast_values
+        wanted = {'id', *[Usage._meta.get_field(name).attname
+                          for name in fields if name != 'user']}
+        return [value for value in cls.fast_values if value in wanted]
+
+    @classmethod
+    def to_representation_fast(cls, rows, user, fields=None):
+        """
+        Represent .values(*fast_values_for(fields)) dicts of usages owned
+        by user
+
+        Gives the same output as UsageSerializer(many=True).data, without
+        building a model and serializer instance per row, for read only
+        list endpoints.
+        """
+        usage_at = serializers.DateTimeField()
+        if fields is None:
+            return [{
+                'user': user.username,
+                'usage_type': row['usage_type_id'],
+                'usage_at': usage_at.to_representation(row['usage_at']),
+                'id': row['id'],
+            } for row in rows]
+
+        represent = {
+            'user': lambda row: user.username,
+            'usage_type': lambda row: row['usage_type_id'],
+            'usage_at': lambda row: usage_at.to_representation(
+                row['usage_at']),
+            'id': lambda row: row['id'],
+        }
+        return [{name: represent[name](row) for name in fields}
+                for row in rows]
+
+    @classmethod
+    def to_representation_changes(cls, rows, user):
+        """
+        Represent the rows of changes.usage_changes()
+
+        As to_representation_fast(), with when each usage was last
+        modified and, for deleted usages, when it was deleted.
+        """
+        at = serializers.DateTimeField()
+        representations = cls.to_representation_fast(rows, user)
+        for representation, row in zip(representations, rows):
+            representation['modified_at'] = at.to_representation(
+                row['modified_at'])
+            representation['deleted_at'] = at.to_representation(
+                row['deleted_at'])
+        return representations
+
+    @classmethod
+    def to_columns(cls, rows, user, fields=None):
+        """
+        Represent .values(*fast_values_for(fields)) dicts of usages owned
+        by user as parallel arrays, for columnar renderers
+
+        usage_at is given in microseconds since the epoch.
+        """
+        fields = fields or ['user', 'usage_type', 'usage_at', 'id']
+        columns = {}
+        if 'usage_type' in fields:
+            columns['usage_type'] = [row['usage_type_id'] for row in rows]
+        if 'usage_at' in fields:
+            columns['usage_at'] = [epoch_microseconds(row['usage_at'])
+                                   for row in rows]
+        if 'id' in fields:
+            columns['id'] = [row['id'] for row in rows]
+        if 'user' in fields:
+            return {'user': user.username, 'columns': columns}
+        return {'columns': columns}
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def epoch_microseconds(value):
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+class UsageBulkRowSerializer(serializers.Serializer):
+    """
+    Validates a single row of a bulk upload
+
+    usage_type is only checked to be an integer here, the bulk path
+    checks all referenced usage types exist against the catalogue at once
+    """
+    usage_type = serializers.IntegerField()
+    usage_at = serializers.DateTimeField()
+    idempotency_key = serializers.CharField(required=False, max_length=255)
+
+
+class BatchOperationSerializer(serializers.Serializer):
+    """
+    Validates an operation of a batch, see batch.py
+
+    path and body may refer to earlier results, they are only checked
+    by the route once those are filled in.
+    """
+    method = serializers.ChoiceField(['POST', 'PUT', 'PATCH', 'DELETE'])
+    path = serializers.CharField()
+    body = serializers.JSONField(required=False, default=None)
+
+
+class UsageChangesQuerySerializer(serializers.Serializer):
+    """
+    Validates the query parameters of the usage changes route
+    """
+    since = serializers.CharField(default='0.0')
+    limit = serializers.IntegerField(
+        min_value=1, max_value=settings.USAGE_CHANGES_MAX_LIMIT,
+        default=settings.USAGE_CHANGES_MAX_LIMIT)
+
+    def validate_since(self, value):
+        try:
+            return decode_cursor(value)
+        except ValueError:
+            raise serializers.ValidationError('Invalid cursor.')
+
+
+class UsageSummaryQuerySerializer(serializers.Serializer):
+    """
+    Validates the query parameters of the usage summary route
+    """
+    bucket = serializers.ChoiceField(['day', 'week', 'month'], default='day')
+    group_by = serializers.ChoiceField(['usage_type', ''], default='')
+    tz = serializers.CharField(default=settings.TIME_ZONE)
+
+    def validate_tz(self, value):
+        try:
+            return pytz.timezone(value)
+        except pytz.UnknownTimeZoneError:
+            raise serializers.ValidationError(
+                'Unknown time zone "%s".' % value)
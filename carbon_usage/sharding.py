@@ -0,0 +1,402 @@
+from collections import namedtuple
+from contextvars import ContextVar, copy_context
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, pre_delete
+from django.dispatch import receiver
+from rest_framework import status
+from rest_framework.authtoken.models import Token, TokenProxy
+from rest_framework.exceptions import APIException
+from rest_framework.permissions import SAFE_METHODS
+
+from .changes import stable_xid
+from .export import in_context
+from .models import (UsageType, Usage, UsageDailyRollup, UsageIdempotencyKey,
+                     UserShard)
+
+"""
+Usages spread over several databases by user
+
+Every usage api query is scoped to a user, so the usages, daily rollups
+and idempotency keys of a user are kept together on one of the shard databases in
+settings.USAGE_SHARDS['ALIASES']. Users, tokens, usage types and
+everything else stay on the default database, which can be a shard too.
+
+Which shard holds a user is recorded in UserShard, on the default
+database. New users are placed by id, user id % number of shards, and
+users without a UserShard, from before sharding, are on the first
+shard. The placements are cached in the CACHE alias of settings.CACHES.
+
+ShardRouter sends the queries of usages and rollups to the shard of the
+user they belong to: of the instance being saved or read from, or else
+of the user of the api request, which UserShardMixin sets up. Other
+code has to pass the shard along, the management commands take it as
+--database.
+
+move_user_shard moves a user to another shard while they keep using
+the api: their usages are copied over through the changes feed, then
+their writes are refused for a moment while the last changes are copied,
+see the functions at the end of this module. Each shard gives out usage
+ids of its own, see migration 0009, so usages keep their ids when moved.
+"""
+
+SHARDED_MODELS = {model._meta.label_lower
+                  for model in (Usage, UsageDailyRollup, UsageIdempotencyKey)}
+
+# Models only ever kept on the default database, which usages and rollups
+# on a shard refer to. Others, like UsageCompaction, are on every shard
+GLOBAL_MODELS = {model._meta.label_lower
+                 for model in (User, UsageType, Token, TokenProxy)}
+
+BATCH_SIZE = 5000
+
+Placement = namedtuple('Placement', ['alias', 'moving', 'epoch'])
+
+# (user id, Placement) of the api request's user
+_request_shard = ContextVar('carbon_usage_request_shard', default=None)
+
+
+class UserMoving(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Your usages are being moved, try again shortly.'
+    default_code = 'user_moving'
+
+    def __init__(self, detail=None, code=None, wait=5):
+        super().__init__(detail, code)
+        # Sent as Retry-After
+        self.wait = wait
+
+
+def shard_aliases():
+    return settings.USAGE_SHARDS['ALIASES']
+
+
+def _placement_key(user_id):
+    return 'carbon_usage:user_shard:%s' % user_id
+
+
+def placement(user_id):
+    """
+    Return the Placement of the usages of user_id
+    """
+    current = _request_shard.get()
+    if current is not None and current[0] == user_id:
+        return current[1]
+    config = settings.USAGE_SHARDS
+    if len(config['ALIASES']) == 1:
+        return Placement(config['ALIASES'][0], False, 0)
+    cache = caches[config['CACHE']]
+    found = cache.get(_placement_key(user_id))
+    if found is None:
+        found = UserShard.objects.using(DEFAULT_DB_ALIAS).filter(
+            user_id=user_id).values_list('alias', 'moving', 'epoch').first()
+        found = found or (config['ALIASES'][0], False, 0)
+        cache.set(_placement_key(user_id), found, config['CACHE_TTL'])
+    return Placement(*found)
+
+
+def place(user_id, alias, moving=False, epoch=0):
+    """
+    Record the Placement of the usages of user_id
+    """
+    UserShard.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+        user_id=user_id,
+        defaults={'alias': alias, 'moving': moving, 'epoch': epoch})
+    caches[settings.USAGE_SHARDS['CACHE']].delete(_placement_key(user_id))
+
+
+def current_shard():
+    """
+    Return the shard of the api request's user, default outside requests
+    """
+    current = _request_shard.get()
+    return current[1].alias if current is not None else DEFAULT_DB_ALIAS
+
+
+def users_on(alias):
+    """
+    Return the users whose usages are on alias, as a queryset
+    """
+    placed = UserShard.objects.using(DEFAULT_DB_ALIAS)
+    users = User.objects.using(DEFAULT_DB_ALIAS)
+    if alias == shard_aliases()[0]:
+        return users.exclude(
+            id__in=placed.exclude(alias=alias).values('user_id'))
+    return users.filter(id__in=placed.filter(alias=alias).values('user_id'))
+
+
+def group_by_shard(users):
+    """
+    Return {shard alias: [index, ...]} of a list of users
+    """
+    groups = {}
+    for index, user in enumerate(users):
+        groups.setdefault(placement(user.id).alias, []).append(index)
+    return groups
+
+
+class ShardRouter:
+
+    def _shard_of(self, hints):
+        instance = hints.get('instance')
+        if isinstance(instance, User):
+            return placement(instance.pk).alias
+        if instance is not None:
+            # Where the usage or rollup was loaded from or saved to
+            if instance._state.db in shard_aliases():
+                return instance._state.db
+            if getattr(instance, 'user_id', None) is not None:
+                return placement(instance.user_id).alias
+        return current_shard() if _request_shard.get() else None
+
+    def _global(self, model, hints):
+        # Users and usage types of usages on another shard
+        if model._meta.label_lower not in GLOBAL_MODELS:
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db != DEFAULT_DB_ALIAS \
+                and instance._state.db in shard_aliases():
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def db_for_read(self, model, **hints):
+        if model._meta.label_lower not in SHARDED_MODELS:
+            return self._global(model, hints)
+        alias = self._shard_of(hints)
+        # Reads of the default database may go to a replica, see replicas.py
+        return None if alias == DEFAULT_DB_ALIAS else alias
+
+    def db_for_write(self, model, **hints):
+        if model._meta.label_lower not in SHARDED_MODELS:
+            return self._global(model, hints)
+        return self._shard_of(hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *shard_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class UserShardMixin:
+    """
+    Routes the queries of a view's usages and rollups to the shard of the
+    request's user, refusing writes while the user is moved
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        token = _request_shard.set(None)
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            _request_shard.reset(token)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.user.is_authenticated:
+            user_placement = placement(request.user.id)
+            if user_placement.moving and request.method not in SAFE_METHODS:
+                raise UserMoving()
+            _request_shard.set((request.user.id, user_placement))
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(
+            request, response, *args, **kwargs)
+        if response.streaming and _request_shard.get() is not None:
+            response.streaming_content = in_context(
+                response.streaming_content, copy_context())
+        return response
+
+
+@receiver(post_save, sender=User)
+def place_new_user(sender, instance, created, raw=False, **kwargs):
+    aliases = shard_aliases()
+    if created and not raw and len(aliases) > 1:
+        place(instance.id, aliases[instance.id % len(aliases)])
+
+
+# Users and usage types are deleted from the default database, the
+# deletion only cascades to the usages there
+
+@receiver(pre_delete, sender=User)
+def delete_sharded_usages(sender, instance, using, **kwargs):
+    alias = placement(instance.id).alias
+    if alias != using:
+        UsageDailyRollup.objects.using(alias).filter(user=instance).delete()
+        UsageIdempotencyKey.objects.using(alias).filter(
+            user=instance).delete()
+        Usage.all_objects.using(alias).filter(user=instance).delete()
+
+
+@receiver(pre_delete, sender=UsageType)
+def delete_sharded_usages_of_type(sender, instance, using, **kwargs):
+    for alias in shard_aliases():
+        if alias != using:
+            UsageDailyRollup.objects.using(alias).filter(
+                usage_type=instance).delete()
+            Usage.all_objects.using(alias).filter(
+                usage_type=instance).delete()
+
+
+# Moving a user to another shard
+
+COPIED_FIELDS = ['id', 'user_id', 'usage_type_id', 'usage_at', 'deleted_at',
+                 'idempotency_key']
+
+USAGE_ID_SEQUENCE = 'carbon_usage_usage_id_seq'
+
+
+class UsageIdTaken(Exception):
+    """
+    A usage to move has the id of a usage of another user on the target
+    """
+
+
+def copy_changes(user_id, source, target, since=(0, 0),
+                 batch_size=BATCH_SIZE):
+    """
+    Copy the usages of user_id changed on source after since to target
+
+    Returns (rows copied, cursor to copy from next). Rows are read in
+    changes feed order, see changes.py, so copying again from the cursor
+    only picks up later writes. Raises UsageIdTaken before copying a
+    usage whose id another user's usage has on target.
+    """
+    copied = 0
+    table = Usage._meta.db_table
+    while True:
+        horizon = stable_xid(source)
+        change_xid, pk = since
+        rows = list(
+            Usage.all_objects.using(source)
+            .filter(user_id=user_id, change_xid__lt=horizon)
+            .filter(Q(change_xid__gt=change_xid) | Q(change_xid=change_xid,
+                                                     id__gt=pk))
+            .order_by('change_xid', 'id')
+            .values_list('change_xid', *COPIED_FIELDS)[:batch_size])
+        if not rows:
+            return copied, since
+        ids = [row[1] for row in rows]
+        # Past the ids copied first, so target cannot give them out meanwhile
+        advance_ids(target, max(ids))
+        taken = list(Usage.all_objects.using(target).filter(id__in=ids)
+                     .exclude(user_id=user_id).values_list('id', flat=True))
+        if taken:
+            raise UsageIdTaken('Usages %s are on %s for another user'
+                               % (', '.join(map(str, sorted(taken))), target))
+        with transaction.atomic(using=target), \
+                connections[target].cursor() as cursor:
+            # A usage_at changed since the last copy moves the row to
+            # another (id, usage_at) key, delete by id first
+            cursor.execute(
+                'DELETE FROM {table} WHERE user_id = %s AND id = ANY(%s)'
+                .format(table=table), [user_id, ids])
+            cursor.execute(
+                'INSERT INTO {table} ({fields}) VALUES {values}'.format(
+                    table=table, fields=', '.join(COPIED_FIELDS),
+                    values=', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(rows))),
+                [value for row in rows for value in row[1:]])
+        copied += len(rows)
+        since = (rows[-1][0], rows[-1][1])
+
+
+def remove_stale(user_id, source, target):
+    """
+    Delete the usages of user_id on target that are gone from source,
+    hard deleted after they were copied
+    """
+    kept = set(Usage.all_objects.using(source).filter(
+        user_id=user_id).values_list('id', flat=True))
+    stale = [pk for pk in Usage.all_objects.using(target).filter(
+        user_id=user_id).values_list('id', flat=True) if pk not in kept]
+    with connections[target].cursor() as cursor:
+        for start in range(0, len(stale), BATCH_SIZE):
+            cursor.execute(
+                'DELETE FROM %s WHERE user_id = %%s AND id = ANY(%%s)'
+                % Usage._meta.db_table,
+                [user_id, stale[start:start + BATCH_SIZE]])
+    return len(stale)
+
+
+def copy_rollups(user_id, source, target):
+    """
+    Replace the rollups of user_id on target with those on source
+
+    Rollups of compacted days have no usages left to rebuild them from.
+    """
+    rollups = list(UsageDailyRollup.objects.using(source).filter(
+        user_id=user_id).values_list('usage_type_id', 'day', 'count'))
+    with transaction.atomic(using=target), \
+            connections[target].cursor() as cursor:
+        cursor.execute('DELETE FROM %s WHERE user_id = %%s'
+                       % UsageDailyRollup._meta.db_table, [user_id])
+        UsageDailyRollup.objects.using(target).bulk_create(
+            [UsageDailyRollup(user_id=user_id, usage_type_id=usage_type_id,
+                              day=day, count=count)
+             for usage_type_id, day, count in rollups],
+            batch_size=BATCH_SIZE)
+
+
+def copy_keys(user_id, source, target):
+    """
+    Replace the idempotency keys of user_id on target with those on source
+
+    Keys of compacted usages have no usage left to copy them with.
+    """
+    keys = list(UsageIdempotencyKey.objects.using(source).filter(
+        user_id=user_id).values_list('key', 'usage_id'))
+    with transaction.atomic(using=target), \
+            connections[target].cursor() as cursor:
+        cursor.execute('DELETE FROM %s WHERE user_id = %%s'
+                       % UsageIdempotencyKey._meta.db_table, [user_id])
+        UsageIdempotencyKey.objects.using(target).bulk_create(
+            [UsageIdempotencyKey(user_id=user_id, key=key, usage_id=usage_id)
+             for key, usage_id in keys],
+            batch_size=BATCH_SIZE)
+
+
+def advance_ids(target, highest):
+    """
+    Make the ids target gives out next higher than highest
+
+    Shards give out ids of their own, see migration 0009, but usages from
+    before it and moved over could still be given out again by target.
+    The sequence keeps its step, and so the ids of target.
+    """
+    with connections[target].cursor() as cursor:
+        cursor.execute(
+            'SELECT COALESCE(last_value, start_value - increment_by), '
+            'increment_by FROM pg_sequences '
+            'WHERE schemaname = current_schema() AND sequencename = %s',
+            [USAGE_ID_SEQUENCE])
+        last_value, step = cursor.fetchone()
+        if highest > last_value:
+            steps = -(-(highest - last_value) // step)
+            cursor.execute('SELECT setval(%s, %s)',
+                           [USAGE_ID_SEQUENCE, last_value + steps * step])
+
+
+def delete_usages(user_id, alias, batch_size=BATCH_SIZE):
+    """
+    Delete the usages, rollups and idempotency keys of user_id from
+    alias, a batch at a time
+    """
+    deleted = 0
+    table = Usage._meta.db_table
+    with connections[alias].cursor() as cursor:
+        while True:
+            cursor.execute(
+                'DELETE FROM {table} WHERE user_id = %s AND id IN ('
+                '    SELECT id FROM {table} WHERE user_id = %s LIMIT %s'
+                ')'.format(table=table), [user_id, user_id, batch_size])
+            if not cursor.rowcount:
+                break
+            deleted += cursor.rowcount
+        for model in (UsageDailyRollup, UsageIdempotencyKey):
+            cursor.execute('DELETE FROM %s WHERE user_id = %%s'
+                           % model._meta.db_table, [user_id])
+    return deleted
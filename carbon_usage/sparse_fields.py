@@ -0,0 +1,67 @@
+from rest_framework.exceptions import ValidationError
+
+"""
+Sparse fieldsets, ?fields=id,usage_at
+
+Clients asking for fewer fields get only those in every representation
+of the view, and the views leave the other columns out of their
+queries. Serializers represent just context['fields'], which
+SparseFieldsViewMixin sets from the query parameter, while the read only
+fast paths that skip the serializer trim their output themselves, see
+UsageSerializer.fast_values_for().
+"""
+
+
+def parse_fields(value, available):
+    """
+    Return the field names listed in a ?fields= value, in the order of
+    available, or None when none are listed
+    """
+    names = {name.strip() for name in value.split(',')} - {''}
+    if not names:
+        return None
+    unknown = names.difference(available)
+    if unknown:
+        raise ValidationError({'fields': [
+            'Unknown fields: %s. Choose from %s.' % (
+                ', '.join(sorted(unknown)), ', '.join(available))]})
+    return [name for name in available if name in names]
+
+
+class SparseFieldsMixin:
+    """
+    Serializer representing only the fields in context['fields'], all of
+    them when that is None or not given
+
+    Fields left out are never read from the instance, so they may be
+    deferred. Writes are validated as usual.
+    """
+
+    @property
+    def _readable_fields(self):
+        fields = self.context.get('fields')
+        for field in super()._readable_fields:
+            if fields is None or field.field_name in fields:
+                yield field
+
+
+class SparseFieldsViewMixin:
+    """
+    Passes the fields of ?fields= to the view's serializers, rejecting
+    names the serializer does not represent
+    """
+
+    @property
+    def requested_fields(self):
+        if not hasattr(self, '_requested_fields'):
+            serializer = self.get_serializer_class()()
+            available = [name for name, field in serializer.fields.items()
+                         if not field.write_only]
+            self._requested_fields = parse_fields(
+                self.request.query_params.get('fields', ''), available)
+        return self._requested_fields
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['fields'] = self.requested_fields
+        return context
@@ -0,0 +1,96 @@
+from django.db import connections, transaction
+from django.db.models import Count, DateField, DateTimeField, Func, Sum, Value
+from django.db.models.functions import Trunc
+from rest_framework import serializers
+
+from .models import UsageDailyRollup
+from .rollups import day_start, set_local_timezone
+
+"""
+Time bucketed usage counts, computed in the database
+
+The bucketing (date_trunc in the caller's time zone) and the GROUP BY
+both run in postgres, so a summary is a single query returning one row
+per bucket and group rather than one row per usage.
+
+When the daily rollups can answer the question exactly (same time zone,
+day aligned range) summarize_rollups() reads those instead, which costs
+O(days) rather than O(usages).
+"""
+
+
+class LocalTrunc(Func):
+    """
+    date_trunc of the wall clock time in the session time zone
+
+    Returns a naive datetime, see rollups.set_local_timezone()
+    """
+    template = "DATE_TRUNC(%(expressions)s::timestamp)"
+    output_field = DateTimeField()
+
+    def __init__(self, kind, expression):
+        super().__init__(Value(kind), expression)
+
+
+def summarize(queryset, bucket, tz, group_by=''):
+    """
+    Count usages in queryset per bucket ('day', 'week' or 'month')
+
+    Returns a list of series, one per usage type if group_by is
+    'usage_type' or a single series otherwise. Each series holds parallel
+    'buckets' (bucket start, in tz) and 'counts' lists, in time order.
+    """
+    group_fields = ['usage_type'] if group_by else []
+    rows = (queryset.order_by()
+            .annotate(bucket=LocalTrunc(bucket, 'usage_at'))
+            .values(*group_fields, 'bucket')
+            .annotate(count=Count('id'))
+            .order_by(*group_fields, 'bucket')
+            .values_list(*group_fields, 'bucket', 'count'))
+    with transaction.atomic(using=queryset.db):
+        with connections[queryset.db].cursor() as cursor:
+            set_local_timezone(cursor, tz)
+        rows = [row[:-2] + (tz.localize(row[-2]), row[-1]) for row in rows]
+    return build_series(rows, tz, group_by)
+
+
+def summarize_rollups(user, bucket, tz, group_by='',
+                      first_day=None, last_day=None):
+    """
+    Same as summarize(), computed from the user's daily rollups
+    """
+    queryset = UsageDailyRollup.objects.filter(user=user, count__gt=0)
+    if first_day is not None:
+        queryset = queryset.filter(day__gte=first_day)
+    if last_day is not None:
+        queryset = queryset.filter(day__lte=last_day)
+
+    group_fields = ['usage_type'] if group_by else []
+    rows = (queryset
+            .annotate(bucket=Trunc('day', bucket, output_field=DateField()))
+            .values(*group_fields, 'bucket')
+            .annotate(count=Sum('count'))
+            .order_by(*group_fields, 'bucket')
+            .values_list(*group_fields, 'bucket', 'count'))
+    rows = (row[:-2] + (day_start(row[-2], tz), row[-1]) for row in rows)
+    return build_series(rows, tz, group_by)
+
+
+def build_series(rows, tz, group_by=''):
+    """
+    Fold (group..., bucket, count) rows, sorted by group, into series
+    """
+    bucket_field = serializers.DateTimeField(default_timezone=tz)
+    series = []
+    current_group = None
+    for row in rows:
+        group, (bucket_start, count) = row[:-2], row[-2:]
+        if not series or group != current_group:
+            current_group = group
+            current = {group_by: group[0]} if group_by else {}
+            current['buckets'] = []
+            current['counts'] = []
+            series.append(current)
+        current['buckets'].append(bucket_field.to_representation(bucket_start))
+        current['counts'].append(count)
+    return series
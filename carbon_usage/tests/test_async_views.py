@@ -0,0 +1,123 @@
+import json
+
+from asgiref.sync import async_to_sync
+from datetime import timedelta
+from http import HTTPStatus
+from django.conf import settings
+from django.test import TransactionTestCase, override_settings
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from planetly_challenge.asgi import application
+from ..catalogue import catalogue
+from ..models import UsageType, Usage
+
+
+"""
+Test the usage read endpoints served asynchronously through ASGI
+
+Requests are sent straight to the ASGI application. The reads run on the
+read pool's threads, with connections of their own, so the data has to be
+committed.
+"""
+
+
+@override_settings(ROOT_URLCONF='planetly_challenge.asgi_urls')
+class AsyncUsageViewsTest(TransactionTestCase):
+
+    def setUp(self):
+        catalogue.invalidate()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.other = User.objects.create_user(
+            username='otheruser',
+            password='verysecure')
+        self.token = Token.objects.get(user=self.user).key
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+        start = timezone.now() - timedelta(days=3)
+        for i in range(30):
+            Usage.objects.create(user=self.user, usage_type=self.driving,
+                                 usage_at=start + timedelta(hours=i))
+        self.others = Usage.objects.create(
+            user=self.other, usage_type=self.driving, usage_at=start)
+
+    def request(self, path, query='', method='GET', body=b'', token=None):
+        """
+        Return the status, headers and body the ASGI application sends
+        """
+        token = self.token if token is None else token
+        headers = [(b'content-type', b'application/json'),
+                   (b'content-length', str(len(body)).encode())]
+        if token:
+            headers.append((b'authorization', b'Token ' + token.encode()))
+        scope = {
+            'type': 'http', 'method': method, 'path': path,
+            'query_string': query.encode(), 'headers': headers,
+            'scheme': 'http', 'server': ('testserver', 80),
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body}
+
+        async def send(message):
+            messages.append(message)
+
+        async_to_sync(application)(scope, receive, send)
+        start = messages[0]
+        return (start['status'], dict(start['headers']),
+                b''.join(message.get('body', b'') for message in messages[1:]))
+
+    def test_list(self):
+        with override_settings(SERVER_TIMING=dict(
+                settings.SERVER_TIMING, HEADER=True)):
+            status, headers, body = self.request('/carbon_usage/usage/',
+                                                 'ordering=-usage_at')
+        self.assertEqual(status, HTTPStatus.OK._value_)
+        expected = self.client.get('/carbon_usage/usage/',
+                                   {'ordering': '-usage_at'})
+        self.assertEqual(json.loads(body)['results'],
+                         json.loads(expected.content)['results'])
+        self.assertNotIn(self.others.id,
+                         [row['id'] for row in json.loads(body)['results']])
+        # Queries run on the read pool are measured
+        self.assertNotIn(b'desc="0 queries"', headers[b'Server-Timing'])
+
+    def test_summary(self):
+        status, _, body = self.request('/carbon_usage/usage/summary/')
+        self.assertEqual(status, HTTPStatus.OK._value_)
+        self.assertEqual(
+            json.loads(body),
+            json.loads(self.client.get('/carbon_usage/usage/summary/').content))
+
+    def test_export(self):
+        status, headers, body = self.request('/carbon_usage/usage/export/',
+                                             'format=ndjson')
+        self.assertEqual(status, HTTPStatus.OK._value_)
+        ids = [json.loads(line)['id'] for line in body.splitlines()]
+        self.assertEqual(sorted(ids), sorted(
+            Usage.objects.filter(user=self.user).values_list('id', flat=True)))
+
+    def test_authentication(self):
+        status, _, _ = self.request('/carbon_usage/usage/', token='')
+        self.assertEqual(status, HTTPStatus.UNAUTHORIZED._value_)
+        status, _, _ = self.request('/carbon_usage/usage/', token='wrong')
+        self.assertEqual(status, HTTPStatus.UNAUTHORIZED._value_)
+
+    def test_other_routes(self):
+        # Still served as under WSGI
+        status, _, _ = self.request(
+            '/carbon_usage/usage/%s/' % self.others.id)
+        self.assertEqual(status, HTTPStatus.NOT_FOUND._value_)
+        status, _, body = self.request(
+            '/carbon_usage/usage/', method='POST', body=json.dumps({
+                'usage_type': self.driving.id,
+                'usage_at': '2021-04-05T10:00:00Z'}).encode())
+        self.assertEqual(status, HTTPStatus.CREATED._value_)
+        self.assertEqual(json.loads(body)['user'], 'testuser')
@@ -0,0 +1,137 @@
+from http import HTTPStatus
+from unittest import mock
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from ..authentication import token_cache, invalidate
+from ..models import UsageType, Usage
+from django.utils import timezone
+
+
+"""
+Test the cached token authentication
+"""
+
+
+class CachedTokenAuthenticationTest(TestCase):
+
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        # A token is created for every new user, see models.py
+        self.token = Token.objects.get(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+        driving = UsageType.objects.create(name="driving", unit="kilometers")
+        self.usage = Usage.objects.create(user=self.user, usage_type=driving,
+                                          usage_at=timezone.now())
+
+    def get(self, url='/carbon_usage/usage/'):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        auth_queries = [query for query in context.captured_queries
+                        if 'authtoken_token' in query['sql']]
+        return response, len(auth_queries)
+
+    def test_second_request_skips_database(self):
+        response, auth_queries = self.get()
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        self.assertEqual(auth_queries, 1)
+
+        response, auth_queries = self.get()
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        self.assertEqual(auth_queries, 0)
+        self.assertEqual(response.data['results'][0]['user'], 'testuser')
+
+        # IsOwner still works with the cached principal
+        response, _ = self.get('/carbon_usage/usage/%s/' % self.usage.id)
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+
+    def test_deleted_token_is_rejected(self):
+        self.get()
+        self.token.delete()
+        response, _ = self.get()
+        self.assertEqual(response.status_code,
+                         HTTPStatus.UNAUTHORIZED._value_)
+
+    def test_regenerated_token(self):
+        self.get()
+        self.token.delete()
+        new_token = Token.objects.create(user=self.user)
+        response, _ = self.get()
+        self.assertEqual(response.status_code,
+                         HTTPStatus.UNAUTHORIZED._value_)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + new_token.key)
+        response, _ = self.get()
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+
+    def test_deactivated_user_is_rejected(self):
+        self.get()
+        self.user.is_active = False
+        self.user.save()
+        response, _ = self.get()
+        self.assertEqual(response.status_code,
+                         HTTPStatus.UNAUTHORIZED._value_)
+
+    def test_principal_save_only_writes_cached_fields(self):
+        self.get()
+        response, _ = self.get()
+        principal = response.wsgi_request.user
+        principal.is_staff = True
+        principal.save()
+        user = User.objects.get(id=self.user.id)
+        self.assertTrue(user.is_staff)
+        self.assertTrue(user.check_password('verysecure'))
+
+    @override_settings(TOKEN_AUTH_CACHE=dict(settings.TOKEN_AUTH_CACHE,
+                                             SHARED_CACHE='default'))
+    def test_eviction_during_lookup(self):
+        caches['default'].clear()
+        authenticate = TokenAuthentication.authenticate_credentials
+
+        def deactivated_meanwhile(auth, key):
+            # The user was read before a deactivation that commits now
+            result = authenticate(auth, key)
+            User.objects.filter(id=self.user.id).update(is_active=False)
+            invalidate(key)
+            return result
+
+        with mock.patch.object(TokenAuthentication,
+                               'authenticate_credentials',
+                               deactivated_meanwhile):
+            response, _ = self.get()
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+
+        # Neither cache kept the user from before the deactivation
+        for _ in range(2):
+            response, auth_queries = self.get()
+            self.assertEqual(response.status_code,
+                             HTTPStatus.UNAUTHORIZED._value_)
+            self.assertEqual(auth_queries, 1)
+
+    @override_settings(TOKEN_AUTH_CACHE=dict(settings.TOKEN_AUTH_CACHE,
+                                             SHARED_CACHE='default'))
+    def test_shared_cache(self):
+        caches['default'].clear()
+        self.get()
+        token_cache.clear()
+        response, auth_queries = self.get()
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        self.assertEqual(auth_queries, 0)
+
+        self.user.is_active = False
+        self.user.save()
+        token_cache.clear()
+        response, _ = self.get()
+        self.assertEqual(response.status_code,
+                         HTTPStatus.UNAUTHORIZED._value_)
@@ -0,0 +1,113 @@
+import json
+
+from http import HTTPStatus
+from django.test import TestCase
+from django.contrib.auth.models import User
+from rest_framework.test import APIClient
+from ..catalogue import catalogue
+from ..models import UsageType, Usage
+
+
+"""
+Test /carbon_usage/batch/ runs usage and usage type writes in one
+transaction
+"""
+
+
+class UsageBatchTest(TestCase):
+
+    def setUp(self):
+        catalogue.invalidate()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+        self.usage = Usage.objects.create(
+            user=self.user, usage_type=self.driving,
+            usage_at='2021-04-05T10:00:00Z')
+
+    def batch(self, operations, **extra):
+        return self.client.post('/carbon_usage/batch/',
+                                data=json.dumps(operations),
+                                content_type='application/json', **extra)
+
+    def test_sync(self):
+        response = self.batch([
+            {'method': 'POST', 'path': '/carbon_usage/usage_type/',
+             'body': {'name': 'cycling', 'unit': 'kilometers'}},
+            {'method': 'POST', 'path': '/carbon_usage/usage/',
+             'body': {'usage_type': '${0.id}',
+                      'usage_at': '2021-04-06T10:00:00Z'}},
+            {'method': 'PATCH', 'path': '/carbon_usage/usage/${1.id}/',
+             'body': {'usage_at': '2021-04-07T10:00:00Z'}},
+            {'method': 'DELETE',
+             'path': '/carbon_usage/usage/%s/' % self.usage.id},
+        ], HTTP_IDEMPOTENCY_KEY='sync-1')
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        results = response.data['results']
+        self.assertEqual([result['status'] for result in results], [
+            HTTPStatus.CREATED._value_, HTTPStatus.CREATED._value_,
+            HTTPStatus.OK._value_, HTTPStatus.NO_CONTENT._value_])
+
+        cycling = UsageType.objects.get(name='cycling')
+        usage = Usage.objects.get()
+        self.assertEqual(results[1]['body']['usage_type'], cycling.id)
+        self.assertEqual(usage.usage_type, cycling)
+        self.assertEqual(usage.usage_at.day, 7)
+        self.assertEqual(results[2]['body']['id'], usage.id)
+
+    def test_failure_rolls_back(self):
+        response = self.batch([
+            {'method': 'POST', 'path': '/carbon_usage/usage_type/',
+             'body': {'name': 'cycling', 'unit': 'kilometers'}},
+            {'method': 'DELETE',
+             'path': '/carbon_usage/usage/%s/' % self.usage.id},
+            {'method': 'POST', 'path': '/carbon_usage/usage/',
+             'body': {'usage_type': 999,
+                      'usage_at': '2021-04-06T10:00:00Z'}},
+            {'method': 'DELETE',
+             'path': '/carbon_usage/usage/%s/' % self.usage.id},
+        ])
+        self.assertEqual(response.status_code,
+                         HTTPStatus.BAD_REQUEST._value_)
+        results = response.data['results']
+        self.assertEqual(len(results), 3)
+        self.assertIn('usage_type', results[2]['body'])
+        self.assertFalse(UsageType.objects.filter(name='cycling').exists())
+        self.assertEqual(Usage.objects.get(), self.usage)
+        self.assertIsNone(catalogue.get(results[0]['body']['id']))
+
+    def test_owner_only(self):
+        other = User.objects.create_user(username='otheruser')
+        usage = Usage.objects.create(user=other, usage_type=self.driving,
+                                     usage_at='2021-04-05T10:00:00Z')
+        response = self.batch([
+            {'method': 'DELETE',
+             'path': '/carbon_usage/usage/%s/' % self.usage.id},
+            {'method': 'DELETE', 'path': '/carbon_usage/usage/%s/' % usage.id},
+        ])
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND._value_)
+        self.assertEqual(Usage.objects.count(), 2)
+
+    def test_invalid_operations(self):
+        response = self.batch([{'method': 'GET',
+                                'path': '/carbon_usage/usage/'}])
+        self.assertEqual(response.status_code,
+                         HTTPStatus.BAD_REQUEST._value_)
+        self.assertIn('method', response.data[0])
+
+        for path in ['/carbon_usage/timings/', '/carbon_usage/usage/${1.id}/']:
+            response = self.batch([{'method': 'DELETE', 'path': path}])
+            self.assertEqual(response.status_code,
+                             HTTPStatus.BAD_REQUEST._value_)
+            self.assertIn('non_field_errors',
+                          response.data['results'][0]['body'])
+
+    def test_authentication_required(self):
+        self.client.force_authenticate(user=None)
+        response = self.batch([])
+        self.assertEqual(response.status_code,
+                         HTTPStatus.UNAUTHORIZED._value_)
@@ -0,0 +1,98 @@
+import json
+
+from datetime import timedelta
+from http import HTTPStatus
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.test import APIClient
+from ..models import UsageType, Usage
+
+
+"""
+Test bulk creation of usages through POST /carbon_usage/usage/bulk/
+"""
+
+
+class UsageBulkTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+        self.flying = UsageType.objects.create(
+            name="flying", unit="kilometers")
+
+    def rows(self, count):
+        start = timezone.now() - timedelta(days=1)
+        return [{
+            "usage_type": self.driving.id if i % 2 else self.flying.id,
+            "usage_at": (start + timedelta(minutes=i)).isoformat()
+        } for i in range(count)]
+
+    def test_bulk_json(self):
+        rows = self.rows(20)
+        response = self.client.post('/carbon_usage/usage/bulk/',
+                                    data=json.dumps(rows),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED._value_)
+        self.assertEqual(response.data['errors'], [])
+        self.assertEqual(len(response.data['ids']), 20)
+
+        usages = Usage.objects.filter(user=self.user).order_by('id')
+        self.assertEqual(list(usages.values_list('id', flat=True)),
+                         response.data['ids'])
+        self.assertEqual(usages[1].usage_type, self.driving)
+
+    def test_bulk_ndjson_with_errors(self):
+        rows = self.rows(5)
+        rows[1]['usage_type'] = 9999
+        rows[3]['usage_at'] = 'yesterday'
+        body = '\n'.join(json.dumps(row) for row in rows) + '\n'
+        response = self.client.post('/carbon_usage/usage/bulk/',
+                                    data=body,
+                                    content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED._value_)
+
+        # Bad rows are reported by index, the rest are still created
+        self.assertEqual([error['index'] for error in response.data['errors']],
+                         [1, 3])
+        self.assertIn('usage_type', response.data['errors'][0]['errors'])
+        self.assertIn('usage_at', response.data['errors'][1]['errors'])
+        self.assertEqual(response.data['ids'][1], None)
+        self.assertEqual(response.data['ids'][3], None)
+        self.assertEqual(Usage.objects.filter(user=self.user).count(), 3)
+
+    def test_bulk_all_invalid(self):
+        response = self.client.post('/carbon_usage/usage/bulk/',
+                                    data=json.dumps([{"usage_type": "x"}]),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code,
+                         HTTPStatus.BAD_REQUEST._value_)
+
+        response = self.client.post('/carbon_usage/usage/bulk/',
+                                    data=json.dumps({"usage_type": 1}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code,
+                         HTTPStatus.BAD_REQUEST._value_)
+
+    def test_bulk_query_count_is_constant(self):
+        # Load the usage type catalogue first, see catalogue.py
+        self.client.post('/carbon_usage/usage/bulk/',
+                         data=json.dumps(self.rows(1)),
+                         content_type='application/json')
+        counts = []
+        for size in (10, 500):
+            with CaptureQueriesContext(connection) as context:
+                self.client.post('/carbon_usage/usage/bulk/',
+                                 data=json.dumps(self.rows(size)),
+                                 content_type='application/json')
+            counts.append(len(context.captured_queries))
+        self.assertEqual(counts[0], counts[1])
@@ -0,0 +1,160 @@
+from http import HTTPStatus
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.test import APIClient
+from ..catalogue import catalogue
+from ..models import UsageType
+
+
+"""
+Test the usage type catalogue and conditional GETs of /usage_type/
+"""
+
+
+class UsageTypeCatalogueTest(TestCase):
+
+    def setUp(self):
+        # Rolled back rows of earlier tests never sent post_delete
+        catalogue.invalidate()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+        self.sailing = UsageType.objects.create(
+            name="sailing", unit="nautical miles")
+
+    def get(self, url='/carbon_usage/usage_type/', **headers):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, **headers)
+        return response, len(context.captured_queries)
+
+    def test_not_modified_without_queries(self):
+        response, _ = self.get()
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('"'))
+
+        response, queries = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code,
+                         HTTPStatus.NOT_MODIFIED._value_)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(queries, 0)
+
+        # Without a matching ETag the list is served from memory too
+        response, queries = self.get(HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        self.assertEqual(queries, 0)
+        self.assertEqual(response.data['count'], 2)
+
+    def test_etag_changes_on_writes(self):
+        response, _ = self.get()
+        etag = response['ETag']
+
+        response = self.client.patch(
+            '/carbon_usage/usage_type/%s/' % self.driving.id,
+            {'unit': 'miles'}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+
+        response, _ = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['results'][0]['unit'], 'miles')
+
+        etag = response['ETag']
+        self.sailing.delete()
+        response, _ = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        self.assertEqual(response.data['count'], 1)
+
+    def test_etag_depends_on_query(self):
+        response, _ = self.get()
+        response, _ = self.get('/carbon_usage/usage_type/?ordering=-name',
+                               HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        self.assertEqual([row['name'] for row in response.data['results']],
+                         ['sailing', 'driving'])
+
+    def test_retrieve(self):
+        url = '/carbon_usage/usage_type/%s/' % self.sailing.id
+        response, _ = self.get(url)
+        self.assertEqual(response.data, {
+            'name': 'sailing', 'unit': 'nautical miles',
+            'id': self.sailing.id})
+
+        response, queries = self.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code,
+                         HTTPStatus.NOT_MODIFIED._value_)
+        self.assertEqual(queries, 0)
+
+        response, _ = self.get('/carbon_usage/usage_type/0/')
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND._value_)
+
+    def test_usage_validation(self):
+        self.get()
+        response = self.client.post('/carbon_usage/usage/', {
+            'usage_type': 0, 'usage_at': timezone.now().isoformat()})
+        self.assertEqual(response.status_code,
+                         HTTPStatus.BAD_REQUEST._value_)
+        self.assertIn('usage_type', response.data)
+
+        # A usage type unknown to the catalogue is looked up again, as it
+        # may have been created by another process
+        flying = UsageType(name="flying", unit="kilometers")
+        UsageType.objects.bulk_create([flying])
+        flying = UsageType.objects.get(name="flying")
+        response = self.client.post('/carbon_usage/usage/', {
+            'usage_type': flying.id, 'usage_at': timezone.now().isoformat()})
+        self.assertEqual(response.status_code, HTTPStatus.CREATED._value_)
+        self.assertEqual(response.data['usage_type'], flying.id)
+
+    def test_missing_ids_are_remembered(self):
+        catalogue.get(self.driving.id)
+        # Looked up once, without loading the whole table again
+        for expected in [1, 0]:
+            with CaptureQueriesContext(connection) as context:
+                self.assertIsNone(catalogue.get(0))
+                self.assertEqual(catalogue.ids([0, self.driving.id]),
+                                 {self.driving.id, self.sailing.id})
+            self.assertEqual(len(context.captured_queries), expected)
+
+
+class UsageTypeCatalogueTransactionTest(TransactionTestCase):
+
+    def setUp(self):
+        catalogue.invalidate()
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+
+    def test_rolled_back_types_are_not_kept(self):
+        self.assertEqual(catalogue.ids(), {self.driving.id})
+        with transaction.atomic():
+            flying = UsageType.objects.create(name="flying",
+                                              unit="kilometers")
+            with transaction.atomic():
+                sailing = UsageType.objects.create(name="sailing",
+                                                   unit="nautical miles")
+                self.assertEqual(catalogue.get(sailing.id), sailing)
+                transaction.set_rollback(True)
+            self.assertIsNone(catalogue.get(sailing.id))
+            self.assertEqual(catalogue.get(flying.id), flying)
+            transaction.set_rollback(True)
+
+        self.assertIsNone(catalogue.get(flying.id))
+        self.assertEqual(catalogue.ids(), {self.driving.id})
+
+    def test_committed_types_are_kept(self):
+        with transaction.atomic():
+            flying = UsageType.objects.create(name="flying",
+                                              unit="kilometers")
+            self.assertEqual(catalogue.get(flying.id), flying)
+        self.assertEqual(catalogue.ids(), {self.driving.id, flying.id})
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(catalogue.get(flying.id), flying)
+        self.assertEqual(len(context.captured_queries), 0)
@@ -0,0 +1,141 @@
+import threading
+
+from datetime import timedelta
+from http import HTTPStatus
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.test import APIClient
+from ..catalogue import catalogue
+from ..changes import usage_changes
+from ..models import UsageType, Usage, UsageDailyRollup
+
+
+"""
+Test the usage changes feed at /carbon_usage/usage/changes/
+
+Transaction ids only move on between transactions, so these tests
+commit like the api does outside of tests.
+"""
+
+
+class UsageChangesTest(TransactionTestCase):
+
+    def setUp(self):
+        catalogue.invalidate()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+        self.start = timezone.now() - timedelta(days=1)
+
+    def create(self, hours=0):
+        response = self.client.post('/carbon_usage/usage/', {
+            'usage_type': self.driving.id,
+            'usage_at': (self.start + timedelta(hours=hours)).isoformat()})
+        self.assertEqual(response.status_code, HTTPStatus.CREATED._value_)
+        return response.data
+
+    def changes(self, cursor=None, **params):
+        if cursor is not None:
+            params['since'] = cursor
+        response = self.client.get('/carbon_usage/usage/changes/', params)
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        return response.data
+
+    def test_sync(self):
+        created = [self.create(hours) for hours in range(3)]
+        data = self.changes()
+        self.assertEqual([row['id'] for row in data['results']],
+                         [usage['id'] for usage in created])
+        self.assertFalse(data['more'])
+        self.assertIsNotNone(data['results'][0]['modified_at'])
+        self.assertIsNone(data['results'][0]['deleted_at'])
+
+        # Nothing changed since
+        cursor = data['cursor']
+        data = self.changes(cursor)
+        self.assertEqual(data['results'], [])
+        self.assertEqual(data['cursor'], cursor)
+
+        # An update
+        usage_id = created[1]['id']
+        self.client.patch('/carbon_usage/usage/%s/' % usage_id,
+                          {'usage_at': self.start.isoformat()})
+        data = self.changes(cursor)
+        self.assertEqual([row['id'] for row in data['results']], [usage_id])
+
+        # A delete leaves a tombstone in the feed only
+        cursor = data['cursor']
+        response = self.client.delete('/carbon_usage/usage/%s/' % usage_id)
+        self.assertEqual(response.status_code,
+                         HTTPStatus.NO_CONTENT._value_)
+        data = self.changes(cursor)
+        self.assertEqual([row['id'] for row in data['results']], [usage_id])
+        self.assertIsNotNone(data['results'][0]['deleted_at'])
+
+        response = self.client.get('/carbon_usage/usage/%s/' % usage_id)
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND._value_)
+        response = self.client.get('/carbon_usage/usage/')
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(sum(UsageDailyRollup.objects.filter(
+            user=self.user).values_list('count', flat=True)), 2)
+
+    def test_unchanged_save_is_not_a_change(self):
+        usage = self.create()
+        cursor = self.changes()['cursor']
+        Usage.objects.get(id=usage['id']).save()
+        self.assertEqual(self.changes(cursor)['results'], [])
+
+    def test_limit(self):
+        for hours in range(5):
+            self.create(hours)
+        data = self.changes(limit=2)
+        self.assertTrue(data['more'])
+        ids = [row['id'] for row in data['results']]
+        while data['more']:
+            data = self.changes(data['cursor'], limit=2)
+            ids.extend(row['id'] for row in data['results'])
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(len(set(ids)), 5)
+
+    def test_bad_cursor(self):
+        response = self.client.get('/carbon_usage/usage/changes/',
+                                   {'since': 'nope'})
+        self.assertEqual(response.status_code,
+                         HTTPStatus.BAD_REQUEST._value_)
+
+    def test_running_transaction_holds_back_later_commits(self):
+        results = {}
+
+        def in_other_connection(name, function):
+            def run():
+                try:
+                    results[name] = function()
+                finally:
+                    connection.close()
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+
+        with transaction.atomic():
+            first = Usage.objects.create(user=self.user,
+                                         usage_type=self.driving,
+                                         usage_at=self.start)
+            # Committed after first was written, but before first commits.
+            # On another day, so it waits on no rollup row locked by first
+            in_other_connection('second', lambda: Usage.objects.create(
+                user=self.user, usage_type=self.driving,
+                usage_at=self.start - timedelta(days=2)).id)
+            in_other_connection('during', lambda: usage_changes(self.user))
+
+        rows, cursor, more = results['during']
+        self.assertEqual(rows, [])
+        rows, cursor, more = usage_changes(self.user, cursor)
+        self.assertEqual(sorted(row['id'] for row in rows),
+                         sorted([first.id, results['second']]))
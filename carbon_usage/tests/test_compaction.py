@@ -0,0 +1,119 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from datetime import timedelta
+from http import HTTPStatus
+from io import StringIO
+from django.core.management import call_command
+from django.test import TransactionTestCase
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.test import APIClient
+from ..catalogue import catalogue
+from ..models import UsageType, Usage, UsageDailyRollup, UsageCompaction
+
+
+"""
+Test compacting old usages into their rollups with compact_usages
+
+Compaction commits batch by batch, and the response cache is only told
+once they commit.
+"""
+
+
+class UsageCompactionTest(TransactionTestCase):
+
+    def setUp(self):
+        catalogue.invalidate()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+        now = timezone.now()
+        self.old = [Usage.objects.create(user=self.user,
+                                         usage_type=self.driving,
+                                         usage_at=now - timedelta(days=days))
+                    for days in (1000, 1000, 900)]
+        self.old[1].delete()
+        self.recent = Usage.objects.create(user=self.user,
+                                           usage_type=self.driving,
+                                           usage_at=now - timedelta(days=10))
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+
+    def rollups(self):
+        return {(rollup.usage_type_id, rollup.day): rollup.count
+                for rollup in UsageDailyRollup.objects.filter(
+                    user=self.user, count__gt=0)}
+
+    def compact(self, *args):
+        out = StringIO()
+        call_command('compact_usages', '--days', 365, '--batch-size', 1,
+                     '--archive-dir', self.archive_dir, *args, stdout=out)
+        return out.getvalue()
+
+    def test_compact(self):
+        rollups = self.rollups()
+        response = self.client.get('/carbon_usage/usage/')
+        self.assertEqual(response.data['count'], 3)
+
+        self.assertIn('Compacted 3 usages in total', self.compact())
+
+        # Only the recent usage is left, the totals are all kept
+        self.assertEqual(list(Usage.all_objects.values_list('id', flat=True)),
+                         [self.recent.id])
+        self.assertEqual(self.rollups(), rollups)
+        response = self.client.get('/carbon_usage/usage/')
+        self.assertEqual(response.data['count'], 1)
+
+        # Rebuilding does not lose the compacted days
+        call_command('rebuild_usage_rollups', stdout=StringIO())
+        self.assertEqual(self.rollups(), rollups)
+
+        compaction = UsageCompaction.objects.get()
+        self.assertEqual(compaction.compacted, 3)
+        self.assertIsNotNone(compaction.finished_at)
+        with gzip.open(compaction.archive) as archive:
+            rows = [json.loads(line) for line in archive]
+        self.assertEqual(sorted(row['id'] for row in rows),
+                         sorted(usage.id for usage in self.old))
+        self.assertEqual(rows[0]['user'], self.user.id)
+        self.assertEqual(
+            [row['deleted_at'] is not None for row in rows
+             if row['id'] == self.old[1].id], [True])
+
+    def test_compact_again_resumes(self):
+        self.compact()
+        self.assertIn('Compacted 0 usages in total',
+                      self.compact('--no-archive'))
+        self.assertEqual(len(os.listdir(self.archive_dir)), 1)
+        self.assertEqual(Usage.all_objects.count(), 1)
+
+    def test_summary_after_compaction(self):
+        self.compact()
+        url = '/carbon_usage/usage/summary/'
+        # Read from the rollups, which still count the compacted days
+        response = self.client.get(url)
+        self.assertEqual(sum(response.data['series'][0]['counts']), 3)
+
+        unaligned = (timezone.now() - timedelta(days=2000)).isoformat()
+        for params in [{'tz': 'UTC'}, {'timerange_start': unaligned}]:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code,
+                             HTTPStatus.BAD_REQUEST._value_, params)
+            self.assertIn('compacted',
+                          response.data['non_field_errors'][0])
+
+        # Ranges after the compacted days are still counted from usages
+        response = self.client.get(url, {
+            'tz': 'UTC', 'timerange_start': (
+                timezone.now() - timedelta(days=30)).isoformat()})
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        self.assertEqual(response.data['series'][0]['counts'], [1])
@@ -0,0 +1,142 @@
+import csv
+import gzip
+import io
+import json
+import msgpack
+
+from datetime import timedelta
+from http import HTTPStatus
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.fields import DateTimeField
+from rest_framework.test import APIClient
+from ..export import keyset_chunks
+from ..models import UsageType, Usage
+from ..serializers import EPOCH
+
+
+"""
+Test the streaming export at /carbon_usage/usage/export/
+"""
+
+
+class UsageExportTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        other = User.objects.create_user(
+            username='otheruser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+
+        driving = UsageType.objects.create(name="driving", unit="kilometers")
+        flying = UsageType.objects.create(name="flying", unit="kilometers")
+
+        self.start = timezone.now() - timedelta(days=10)
+        for i in range(12):
+            Usage.objects.create(
+                user=self.user, usage_type=driving if i % 2 else flying,
+                usage_at=self.start + timedelta(hours=i))
+        Usage.objects.create(user=other, usage_type=driving,
+                             usage_at=self.start)
+
+    def listed(self, params=None):
+        # What the paginated list route returns for the same query
+        response = self.client.get('/carbon_usage/usage/', params)
+        results = response.data['results']
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            results.extend(response.data['results'])
+        return [dict(row) for row in results]
+
+    def test_ndjson(self):
+        response = self.client.get(
+            '/carbon_usage/usage/export/?format=ndjson&ordering=-usage_at')
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        self.assertTrue(response.streaming)
+        self.assertTrue(response['Content-Type'].startswith(
+            'application/x-ndjson'))
+
+        body = b''.join(response.streaming_content).decode()
+        rows = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(rows, self.listed({'ordering': '-usage_at'}))
+
+    def test_csv(self):
+        response = self.client.get('/carbon_usage/usage/export/?format=csv')
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        body = b''.join(response.streaming_content).decode()
+        rows = list(csv.DictReader(io.StringIO(body)))
+
+        expected = sorted(self.listed(), key=lambda row: row['usage_at'])
+        self.assertEqual(len(rows), 12)
+        self.assertEqual([int(row['id']) for row in rows],
+                         [row['id'] for row in expected])
+        self.assertEqual(rows[0]['usage_at'], expected[0]['usage_at'])
+        self.assertEqual(rows[0]['user'], 'testuser')
+
+    def test_timerange_and_gzip(self):
+        timerange_end = (self.start + timedelta(hours=2)).isoformat()
+        response = self.client.get(
+            '/carbon_usage/usage/export/',
+            {'format': 'ndjson', 'timerange_end': timerange_end},
+            HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        body = gzip.decompress(b''.join(response.streaming_content))
+        self.assertEqual(len(body.decode().splitlines()), 3)
+
+    def test_empty_csv_has_header(self):
+        response = self.client.get(
+            '/carbon_usage/usage/export/?format=csv&timerange_end=2000-01-01')
+        body = b''.join(response.streaming_content).decode()
+        self.assertEqual(body.splitlines(),
+                         ['user,usage_type,usage_at,id'])
+
+    def from_columns(self, data):
+        # Rows as the JSON routes return them, from a columnar chunk
+        usage_at = DateTimeField()
+        columns = data['columns']
+        return [{
+            'user': data['user'],
+            'usage_type': usage_type,
+            'usage_at': usage_at.to_representation(
+                EPOCH + timedelta(microseconds=at)),
+            'id': pk,
+        } for usage_type, at, pk in zip(columns['usage_type'],
+                                        columns['usage_at'], columns['id'])]
+
+    def test_msgpack(self):
+        response = self.client.get('/carbon_usage/usage/export/',
+                                   HTTP_ACCEPT='application/x-msgpack')
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        self.assertEqual(response['Content-Type'], 'application/x-msgpack')
+
+        unpacker = msgpack.Unpacker()
+        unpacker.feed(b''.join(response.streaming_content))
+        rows = [row for chunk in unpacker for row in self.from_columns(chunk)]
+        self.assertEqual(
+            rows, sorted(self.listed(), key=lambda row: row['usage_at']))
+
+    def test_msgpack_list(self):
+        response = self.client.get('/carbon_usage/usage/?format=msgpack')
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        data = msgpack.unpackb(response.content)
+        self.assertEqual(data['count'], 12)
+        self.assertEqual(self.from_columns(data['results']),
+                         self.listed()[:10])
+
+    def test_chunks(self):
+        for ordering in [['usage_at'], ['-usage_at'], ['usage_type'],
+                         ['-usage_type', 'usage_at']]:
+            queryset = Usage.objects.filter(user=self.user).order_by(
+                *ordering)
+            chunks = list(keyset_chunks(queryset, ['id'], chunk_size=5))
+            self.assertEqual([len(chunk) for chunk in chunks], [5, 5, 2])
+            # Ties are broken by id, in the leading field's direction
+            tie = '-id' if ordering[0].startswith('-') else 'id'
+            ids = [row[0] for chunk in chunks for row in chunk]
+            self.assertEqual(ids, list(queryset.order_by(*ordering, tie)
+                                       .values_list('id', flat=True)))
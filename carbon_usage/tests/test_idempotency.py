@@ -0,0 +1,164 @@
+import json
+
+from http import HTTPStatus
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from rest_framework.test import APIClient
+from ..models import UsageType, Usage, UsageDailyRollup, UsageIdempotencyKey
+
+
+"""
+Test retried usage creations with idempotency keys are only created once
+"""
+
+
+class UsageIdempotencyTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+        self.flying = UsageType.objects.create(
+            name="flying", unit="kilometers")
+
+    def post(self, data, url='/carbon_usage/usage/', **headers):
+        return self.client.post(url, data=json.dumps(data),
+                                content_type='application/json', **headers)
+
+    def counted(self):
+        return sum(UsageDailyRollup.objects.filter(
+            user=self.user).values_list('count', flat=True))
+
+    def test_retry_returns_the_original(self):
+        usage = {'usage_type': self.driving.id,
+                 'usage_at': '2021-04-05T10:00:00Z'}
+        first = self.post(usage, HTTP_IDEMPOTENCY_KEY='reading-1')
+        self.assertEqual(first.status_code, HTTPStatus.CREATED._value_)
+        self.assertNotIn('Idempotent-Replayed', first)
+
+        retry = self.post(usage, HTTP_IDEMPOTENCY_KEY='reading-1')
+        self.assertEqual(retry.status_code, HTTPStatus.CREATED._value_)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(first.data['usage_type'], self.driving.id)
+        self.assertEqual(first.data['user'], 'testuser')
+        self.assertEqual(Usage.objects.count(), 1)
+        self.assertEqual(self.counted(), 1)
+
+        # The key in the body
+        retry = self.post(dict(usage, idempotency_key='reading-1'))
+        self.assertEqual(retry.data['id'], first.data['id'])
+        self.assertNotIn('idempotency_key', retry.data)
+
+    def test_key_claimed_on_insert(self):
+        usage = {'usage_type': self.driving.id,
+                 'usage_at': '2021-04-05T10:00:00Z',
+                 'idempotency_key': 'reading-1'}
+        with CaptureQueriesContext(connection) as context:
+            created = self.post(usage)
+        # No lookup before inserting, the key is claimed by the insert
+        sqls = [query['sql'] for query in context.captured_queries]
+        keyed = [sql for sql in sqls if 'idempotency' in sql]
+        self.assertEqual(len(keyed), 2)
+        self.assertIn('ON CONFLICT', keyed[0])
+        self.assertTrue(keyed[1].startswith('INSERT INTO "carbon_usage_usage"'))
+        self.assertEqual(
+            list(UsageIdempotencyKey.objects.values_list('key', 'usage_id')),
+            [('reading-1', created.data['id'])])
+
+    def test_key_reused_for_another_usage(self):
+        usage = {'usage_type': self.driving.id,
+                 'usage_at': '2021-04-05T10:00:00Z',
+                 'idempotency_key': 'reading-1'}
+        self.post(usage)
+        for changed in [{'usage_at': '2021-04-05T11:00:00Z'},
+                        {'usage_type': self.flying.id}]:
+            response = self.post(dict(usage, **changed))
+            self.assertEqual(response.status_code,
+                             HTTPStatus.UNPROCESSABLE_ENTITY._value_)
+        self.assertEqual(Usage.objects.count(), 1)
+        self.assertEqual(self.counted(), 1)
+
+        # Keys are per user
+        other = User.objects.create_user(username='other')
+        self.client.force_authenticate(user=other)
+        response = self.post(usage)
+        self.assertEqual(response.status_code, HTTPStatus.CREATED._value_)
+        self.assertEqual(Usage.objects.count(), 2)
+
+    def test_key_of_deleted_usage(self):
+        usage = {'usage_type': self.driving.id,
+                 'usage_at': '2021-04-05T10:00:00Z',
+                 'idempotency_key': 'reading-1'}
+        created = self.post(usage)
+        self.client.delete('/carbon_usage/usage/%s/' % created.data['id'])
+        response = self.post(usage)
+        self.assertEqual(response.status_code, HTTPStatus.GONE._value_)
+        self.assertEqual(Usage.objects.count(), 0)
+
+        response = self.post([usage], url='/carbon_usage/usage/bulk/')
+        self.assertEqual(response.status_code,
+                         HTTPStatus.BAD_REQUEST._value_)
+        self.assertEqual(response.data['ids'], [None])
+        self.assertIn('idempotency_key', response.data['errors'][0]['errors'])
+
+    def test_without_key(self):
+        usage = {'usage_type': self.driving.id,
+                 'usage_at': '2021-04-05T10:00:00Z'}
+        self.post(usage)
+        self.post(usage)
+        self.assertEqual(Usage.objects.count(), 2)
+
+    def test_bulk(self):
+        rows = [
+            {'usage_type': self.driving.id,
+             'usage_at': '2021-04-05T10:00:00Z', 'idempotency_key': 'a'},
+            {'usage_type': self.flying.id,
+             'usage_at': '2021-04-05T10:00:00Z'},
+            # Repeats the first row
+            {'usage_type': self.driving.id,
+             'usage_at': '2021-04-05T10:00:00Z', 'idempotency_key': 'a'},
+            {'usage_type': self.driving.id,
+             'usage_at': '2021-04-06T10:00:00Z', 'idempotency_key': 'b'},
+            # Reuses the first row's key for another usage
+            {'usage_type': self.flying.id,
+             'usage_at': '2021-04-05T10:00:00Z', 'idempotency_key': 'a'},
+        ]
+        first = self.post(rows, url='/carbon_usage/usage/bulk/')
+        self.assertEqual(first.status_code, HTTPStatus.CREATED._value_)
+        ids = first.data['ids']
+        self.assertEqual(ids[0], ids[2])
+        self.assertIsNone(ids[4])
+        self.assertEqual([error['index'] for error in first.data['errors']],
+                         [4])
+        self.assertEqual(len(set(ids[:4])), 3)
+        self.assertEqual(self.counted(), 3)
+
+        retry = self.post(rows, url='/carbon_usage/usage/bulk/')
+        retry_ids = retry.data['ids']
+        self.assertEqual([retry_ids[0], retry_ids[2], retry_ids[3]],
+                         [ids[0], ids[2], ids[3]])
+        # Without a key, created again
+        self.assertNotEqual(retry_ids[1], ids[1])
+        self.assertEqual(Usage.objects.count(), 4)
+        self.assertEqual(self.counted(), 4)
+
+    def test_bulk_request_key(self):
+        rows = [{'usage_type': self.driving.id,
+                 'usage_at': '2021-04-05T1%s:00:00Z' % i} for i in range(3)]
+        first = self.post(rows, url='/carbon_usage/usage/bulk/',
+                          HTTP_IDEMPOTENCY_KEY='upload-1')
+        retry = self.post(rows, url='/carbon_usage/usage/bulk/',
+                          HTTP_IDEMPOTENCY_KEY='upload-1')
+        self.assertEqual(retry.data['ids'], first.data['ids'])
+        self.assertEqual(Usage.objects.count(), 3)
+        self.assertEqual(
+            sorted(Usage.objects.values_list('idempotency_key', flat=True)),
+            ['upload-1:0', 'upload-1:1', 'upload-1:2'])
@@ -0,0 +1,98 @@
+import gzip
+import json
+import os
+import tempfile
+
+from io import StringIO
+from django.core.management import call_command
+from django.test import TestCase
+from django.contrib.auth.models import User
+from ..models import UsageType, Usage, UsageDailyRollup
+
+
+"""
+Test importing usages with the import_usage command
+"""
+
+
+class ImportUsageTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, content, opener=open):
+        path = os.path.join(self.directory.name, name)
+        with opener(path, 'wt') as file:
+            file.write(content)
+        return path
+
+    def run_import(self, path, *args):
+        out, err = StringIO(), StringIO()
+        call_command('import_usage', path, '--user', 'testuser',
+                     '--chunk-size', 2, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_csv(self):
+        path = self.write('usages.csv', (
+            'usage_type,usage_at\n'
+            'driving,2021-04-05T10:00:00Z\n'
+            'driving,2021-04-05T11:00:00Z\n'
+            'flying,2021-04-05T12:00:00Z\n'
+            'driving,not a date\n'
+            'driving,2021-04-06T10:00:00Z\n'))
+        out, err = self.run_import(path)
+        self.assertIn('Imported 3 usages, skipped 0 already there, '
+                      'rejected 2', out)
+        self.assertIn('Line 4: Unknown usage type', err)
+        self.assertIn('Line 5: usage_at', err)
+        self.assertEqual(Usage.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(
+            dict(UsageDailyRollup.objects.filter(user=self.user)
+                 .values_list('day', 'count')),
+            {Usage.objects.order_by('id')[0].usage_at.date(): 2,
+             Usage.objects.order_by('id')[2].usage_at.date(): 1})
+
+        # Importing again skips what is already there
+        out, err = self.run_import(path)
+        self.assertIn('Imported 0 usages, skipped 3', out)
+        self.assertEqual(Usage.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(sum(UsageDailyRollup.objects.filter(
+            user=self.user).values_list('count', flat=True)), 3)
+
+    def test_duplicates_are_skipped(self):
+        # With chunks of 2, lines 2 and 3 are one chunk, line 4 the next
+        path = self.write('usages.csv', (
+            'usage_type,usage_at\n'
+            'driving,2021-04-05T10:00:00Z\n'
+            'driving,2021-04-05T10:00:00Z\n'
+            'driving,2021-04-05T10:00:00Z\n'
+            'driving,2021-04-05T11:00:00Z\n'))
+        out, err = self.run_import(path)
+        self.assertIn('Imported 2 usages, skipped 2 already there', out)
+        self.assertEqual(Usage.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(sum(UsageDailyRollup.objects.filter(
+            user=self.user).values_list('count', flat=True)), 2)
+
+    def test_gzipped_ndjson_creating_types(self):
+        path = self.write('usages.ndjson.gz', '\n'.join([
+            json.dumps({'usage_type': 'flying',
+                        'usage_at': '2021-04-05T10:00:00Z'}),
+            '',
+            json.dumps({'usage_type': 'driving',
+                        'usage_at': '2021-04-05T11:00:00Z'}),
+            '{"usage_type":',
+        ]), opener=gzip.open)
+        out, err = self.run_import(path, '--create-types', '--unit', 'km')
+        self.assertIn('Imported 2 usages', out)
+        self.assertIn('Line 4: Invalid JSON', err)
+        flying = UsageType.objects.get(name='flying')
+        self.assertEqual(flying.unit, 'km')
+        self.assertEqual(
+            sorted(Usage.objects.values_list('usage_type', flat=True)),
+            sorted([flying.id, self.driving.id]))
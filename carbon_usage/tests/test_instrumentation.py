@@ -0,0 +1,129 @@
+import json
+
+from io import StringIO
+from http import HTTPStatus
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.test import APIClient
+from ..instrumentation import (registry, RollingHistogram, MILLISECONDS,
+                               summarize, PROCESSES_KEY)
+from ..models import UsageType, Usage
+
+
+"""
+Test the Server-Timing headers and the request timing histograms
+"""
+
+
+def server_timing(response):
+    entries = {}
+    for entry in response['Server-Timing'].split(', '):
+        name, *params = entry.split(';')
+        entries[name] = dict(param.split('=', 1) for param in params)
+    return entries
+
+
+# Cached list responses would not run any query
+@override_settings(USAGE_RESPONSE_CACHE=None)
+class ServerTimingTest(TestCase):
+
+    def setUp(self):
+        registry.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+
+        driving = UsageType.objects.create(name="driving", unit="kilometers")
+        Usage.objects.create(user=self.user, usage_type=driving,
+                             usage_at=timezone.now())
+
+    def test_header(self):
+        with override_settings(SERVER_TIMING=dict(
+                settings.SERVER_TIMING, HEADER=True)):
+            response = self.client.get('/carbon_usage/usage/')
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        entries = server_timing(response)
+        self.assertEqual(
+            set(entries), {'total', 'db', 'auth', 'serialize', 'render'})
+        # The page and the count
+        self.assertEqual(entries['db']['desc'], '"2 queries"')
+        for entry in entries.values():
+            self.assertGreaterEqual(float(entry['dur']), 0)
+
+    def test_header_off_by_default(self):
+        response = self.client.get('/carbon_usage/usage/')
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        self.assertNotIn('Server-Timing', response)
+        # Still measured for the histograms
+        summary = summarize(registry.snapshot())
+        self.assertEqual(summary['usage-list-list']['total']['count'], 1)
+
+    def test_header_for_staff(self):
+        with override_settings(SERVER_TIMING=dict(
+                settings.SERVER_TIMING, HEADER='staff')):
+            response = self.client.get('/carbon_usage/usage/')
+            self.assertNotIn('Server-Timing', response)
+
+            self.user.is_staff = True
+            self.user.save()
+            response = self.client.get('/carbon_usage/usage/')
+        self.assertIn('db', server_timing(response))
+
+    def test_histograms(self):
+        for _ in range(3):
+            self.client.get('/carbon_usage/usage/')
+        self.client.get('/carbon_usage/usage_type/')
+
+        summary = summarize(registry.snapshot())
+        self.assertEqual(summary['usage-list-list']['total']['count'], 3)
+        self.assertEqual(summary['usage-list-list']['queries']['p50'], 2)
+        self.assertEqual(summary['usagetype-list']['total']['count'], 1)
+
+    def test_timings_route_is_for_admins(self):
+        response = self.client.get('/carbon_usage/timings/')
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN._value_)
+
+        self.user.is_staff = True
+        self.user.save()
+        self.client.get('/carbon_usage/usage/')
+        response = self.client.get('/carbon_usage/timings/')
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        self.assertEqual(response.data['usage-list-list']['total']['count'], 1)
+
+    def test_sampling_off(self):
+        with override_settings(SERVER_TIMING=dict(
+                settings.SERVER_TIMING, SAMPLE_RATE=0)):
+            response = self.client.get('/carbon_usage/usage/')
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(registry.snapshot(), {})
+
+    def test_command(self):
+        cache.delete(PROCESSES_KEY)
+        with override_settings(SERVER_TIMING=dict(
+                settings.SERVER_TIMING, SHARED_CACHE='default',
+                PUBLISH_INTERVAL=0)):
+            self.client.get('/carbon_usage/usage/')
+            out = StringIO()
+            call_command('request_timings', '--json', stdout=out)
+        summary = json.loads(out.getvalue())
+        self.assertEqual(summary['usage-list-list']['total']['count'], 1)
+
+
+class RollingHistogramTest(TestCase):
+
+    def test_percentiles(self):
+        histogram = RollingHistogram(MILLISECONDS, window=60)
+        for value in [1] * 90 + [40] * 9 + [3000]:
+            histogram.record(value)
+        summary = summarize({'route': {'total': histogram.snapshot()}})
+        self.assertEqual(summary['route']['total']['count'], 100)
+        self.assertEqual(summary['route']['total']['p50'], 1)
+        self.assertEqual(summary['route']['total']['p95'], 50)
+        self.assertEqual(summary['route']['total']['p99'], 50)
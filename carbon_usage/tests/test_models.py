@@ -39,12 +39,13 @@ class UsageTest(TestCase):
         planetly = User.objects.get(username='planetly')
         driving = UsageType.objects.get(name='driving')
 
-        Usage.objects.create(user=planetly, usage_type=driving,
-                             usage_at=timezone.now())
+        self.usage = Usage.objects.create(user=planetly, usage_type=driving,
+                                          usage_at=timezone.now())
 
     def test_usage(self):
         # Check that usages store expected information
-        first_usage = Usage.objects.get(id=1)
+        # (ids are not reset between test cases, so look it up by ours)
+        first_usage = Usage.objects.get(id=self.usage.id)
         self.assertEqual(
             first_usage.user.username, "planetly")
         self.assertEqual(
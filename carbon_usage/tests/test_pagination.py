@@ -0,0 +1,94 @@
+from datetime import timedelta
+from http import HTTPStatus
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.test import APIClient
+from ..models import UsageType, Usage
+
+
+"""
+Test the opt in keyset (cursor) pagination on the usage api
+"""
+
+
+class UsageKeysetPaginationTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        other = User.objects.create_user(
+            username='otheruser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+        self.flying = UsageType.objects.create(
+            name="flying", unit="kilometers")
+
+        # 25 usages, with some duplicate timestamps to exercise the
+        # id tie breaker
+        self.start = timezone.now() - timedelta(days=30)
+        for i in range(25):
+            Usage.objects.create(
+                user=self.user,
+                usage_type=self.driving if i % 3 else self.flying,
+                usage_at=self.start + timedelta(hours=i // 2))
+        Usage.objects.create(user=other, usage_type=self.driving,
+                             usage_at=self.start)
+
+    def walk(self, url, link='next'):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+            self.assertNotIn('count', response.data)
+            ids.extend(row['id'] for row in response.data['results'])
+            url = response.data[link]
+        return ids
+
+    def test_walk_forward_and_back(self):
+        expected = list(Usage.objects.filter(user=self.user)
+                        .order_by('usage_at', 'id')
+                        .values_list('id', flat=True))
+        ids = self.walk('/carbon_usage/usage/?paginate=cursor')
+        self.assertEqual(ids, expected)
+
+        # Walk back from the last page using previous links
+        response = self.client.get('/carbon_usage/usage/?paginate=cursor')
+        response = self.client.get(response.data['next'])
+        response = self.client.get(response.data['next'])
+        self.assertIsNone(response.data['next'])
+        last_page = [row['id'] for row in response.data['results']]
+        previous = self.walk(response.data['previous'], link='previous')
+        # Pages come back newest first, rows within a page oldest first
+        self.assertEqual(sorted(previous + last_page), sorted(expected))
+        self.assertEqual(previous[:10], expected[10:20])
+
+    def test_ordering_with_ties(self):
+        expected = list(Usage.objects.filter(user=self.user)
+                        .order_by('-usage_type', '-id')
+                        .values_list('id', flat=True))
+        ids = self.walk(
+            '/carbon_usage/usage/?paginate=cursor&ordering=-usage_type')
+        self.assertEqual(ids, expected)
+
+    def test_timerange_filter(self):
+        timerange_end = (self.start + timedelta(hours=4)).isoformat()
+        response = self.client.get(
+            '/carbon_usage/usage/', {'paginate': 'cursor',
+                                     'timerange_end': timerange_end})
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertIsNone(response.data['next'])
+        self.assertIsNone(response.data['previous'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/carbon_usage/usage/?cursor=garbage')
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND._value_)
+
+    def test_page_number_pagination_is_default(self):
+        response = self.client.get('/carbon_usage/usage/')
+        self.assertEqual(response.data['count'], 25)
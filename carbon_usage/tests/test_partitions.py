@@ -0,0 +1,82 @@
+from datetime import timedelta
+from io import StringIO
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.test import APIClient
+from ..models import UsageType, Usage
+from ..partitions import (add_months, month_of, partition_name, partitions,
+                          create_partitions)
+
+
+"""
+Test the monthly partitions of the usage table
+"""
+
+
+def partition_of(usage):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT tableoid::regclass::text FROM '
+                       'carbon_usage_usage WHERE id = %s', [usage.id])
+        return cursor.fetchone()[0]
+
+
+class UsagePartitionTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+        self.this_month = month_of(timezone.now())
+
+    def test_usages_land_in_their_month(self):
+        usage = Usage.objects.create(user=self.user, usage_type=self.driving,
+                                     usage_at=timezone.now())
+        self.assertEqual(partition_of(usage),
+                         partition_name(self.this_month))
+
+    def test_timerange_prunes_partitions(self):
+        Usage.objects.create(user=self.user, usage_type=self.driving,
+                             usage_at=timezone.now())
+        start = self.this_month + timedelta(days=1)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/carbon_usage/usage/', {
+                'timerange_start': start.isoformat(),
+                'timerange_end': (start + timedelta(days=1)).isoformat()})
+        self.assertEqual(response.status_code, 200)
+
+        queries = [query['sql'] for query in context.captured_queries
+                   if 'carbon_usage_usage' in query['sql']]
+        self.assertTrue(queries)
+        for sql in queries:
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN ' + sql)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+            scanned = {name for name in partitions() if name in plan}
+            self.assertEqual(scanned, {partition_name(self.this_month)},
+                             plan)
+
+    def test_create_partitions_moves_default_rows(self):
+        ahead = add_months(self.this_month, 12)
+        usage = Usage.objects.create(user=self.user, usage_type=self.driving,
+                                     usage_at=ahead + timedelta(days=3))
+        self.assertEqual(partition_of(usage), 'carbon_usage_usage_default')
+        change_xid = Usage.objects.get(id=usage.id).change_xid
+
+        out = StringIO()
+        call_command('create_usage_partitions', '--months-ahead', 12,
+                     stdout=out)
+        self.assertIn(partition_name(ahead), out.getvalue())
+        self.assertEqual(partition_of(usage), partition_name(ahead))
+        # Moved, not changed
+        self.assertEqual(Usage.objects.get(id=usage.id).change_xid,
+                         change_xid)
+
+        self.assertEqual(create_partitions(12), [])
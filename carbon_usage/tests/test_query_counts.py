@@ -0,0 +1,84 @@
+from datetime import timedelta
+from django.db import connection
+from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.test import APIClient, force_authenticate
+from ..models import UsageType, Usage
+from ..serializers import UsageSerializer
+from ..views import UserList
+
+
+"""
+Test the list and retrieve routes run a fixed number of queries,
+however many rows are on the page
+"""
+
+
+class QueryCountTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+
+    def add_usages(self, count):
+        start = timezone.now()
+        for i in range(count):
+            Usage.objects.create(user=self.user, usage_type=self.driving,
+                                 usage_at=start + timedelta(minutes=i))
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_usage_list(self):
+        self.add_usages(1)
+        one_row = self.count_queries('/carbon_usage/usage/')
+        self.add_usages(30)
+        self.assertEqual(self.count_queries('/carbon_usage/usage/'), one_row)
+        self.assertEqual(
+            self.count_queries('/carbon_usage/usage/?paginate=cursor'), 1)
+
+    def test_usage_retrieve(self):
+        self.add_usages(1)
+        usage = Usage.objects.get(user=self.user)
+        self.assertEqual(
+            self.count_queries('/carbon_usage/usage/%s/' % usage.id), 1)
+
+    def test_usage_type_list(self):
+        one_row = self.count_queries('/carbon_usage/usage_type/')
+        for i in range(20):
+            UsageType.objects.create(name='type %s' % i, unit='kilometers')
+        self.assertEqual(self.count_queries('/carbon_usage/usage_type/'),
+                         one_row)
+
+    def test_user_list(self):
+        self.add_usages(3)
+        for i in range(5):
+            User.objects.create_user(username='user%s' % i)
+
+        self.user.is_staff = True
+        request = RequestFactory().get('/users/')
+        force_authenticate(request, user=self.user)
+        # Count, one page of users, and their usage counts
+        with self.assertNumQueries(3):
+            response = UserList.as_view()(request)
+        self.assertEqual(response.data['results'][0]['usage_count'], 3)
+        self.assertEqual(response.data['results'][1]['usage_count'], 0)
+
+    def test_fast_path_matches_serializer(self):
+        self.add_usages(12)
+        usages = Usage.objects.filter(user=self.user).order_by('id')
+        expected = UsageSerializer(usages, many=True).data
+        self.assertEqual(
+            UsageSerializer.to_representation_fast(
+                usages.values(*UsageSerializer.fast_values), self.user),
+            [dict(row) for row in expected])
@@ -0,0 +1,105 @@
+from datetime import timedelta
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.test import APIClient
+from ..models import UsageType, Usage
+from ..partitions import create_partitions
+
+
+"""
+Query plan regression tests for the usage api
+
+Seed a table of a realistic shape (many users, a heavy user with a long
+history), then run every query the usage endpoints issue through EXPLAIN
+and fail if postgres falls back to a sequential scan of a usage
+partition holding rows. Empty partitions are always scanned sequentially.
+"""
+
+USERS = 50
+ROWS_PER_USER = 1000
+
+
+class UsageQueryPlanTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        usage_types = UsageType.objects.bulk_create([
+            UsageType(name='type %s' % i, unit='kilometers')
+            for i in range(10)])
+        users = User.objects.bulk_create([
+            User(username='user%s' % i) for i in range(USERS)])
+
+        start = timezone.now() - timedelta(days=365)
+        for user in users:
+            Usage.objects.bulk_create([
+                Usage(user=user,
+                      usage_type=usage_types[i % len(usage_types)],
+                      usage_at=start + timedelta(minutes=7 * i))
+                for i in range(ROWS_PER_USER)])
+        cls.user = users[0]
+        cls.usage_type = usage_types[0]
+        cls.start = start
+
+        # Move the history out of the default partition
+        create_partitions(since=start)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE carbon_usage_usage')
+            cursor.execute(
+                "SELECT relname FROM pg_class WHERE relname LIKE "
+                "'carbon_usage_usage%%' AND relkind = 'r' AND reltuples > 0")
+            cls.filled = [row[0] for row in cursor.fetchall()]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def assertIndexOnly(self, url, params=None):
+        """
+        Request url and check the plan of every usage query it ran
+        """
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+
+        queries = [query['sql'] for query in context.captured_queries
+                   if 'carbon_usage_usage' in query['sql']]
+        self.assertTrue(queries)
+        for sql in queries:
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN ' + sql)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+            for table in self.filled:
+                self.assertNotIn('Seq Scan on %s ' % table, plan,
+                                 '%s\n%s' % (sql, plan))
+        return response
+
+    def test_list(self):
+        self.assertIndexOnly('/carbon_usage/usage/')
+        self.assertIndexOnly('/carbon_usage/usage/', {'page': 50})
+
+    def test_ordering(self):
+        for ordering in ['usage_at', '-usage_at',
+                         'usage_type', '-usage_type']:
+            self.assertIndexOnly('/carbon_usage/usage/',
+                                 {'ordering': ordering})
+
+    def test_timerange(self):
+        middle = self.start + timedelta(days=3)
+        self.assertIndexOnly('/carbon_usage/usage/', {
+            'timerange_start': self.start.isoformat(),
+            'timerange_end': middle.isoformat(),
+            'ordering': '-usage_at'})
+
+    def test_keyset_pagination(self):
+        for ordering in ['-usage_at', 'usage_type']:
+            response = self.assertIndexOnly('/carbon_usage/usage/', {
+                'paginate': 'cursor', 'ordering': ordering})
+            response = self.assertIndexOnly(response.data['next'])
+            self.assertIndexOnly(response.data['previous'])
+
+    def test_retrieve(self):
+        usage = Usage.objects.filter(user=self.user).first()
+        self.assertIndexOnly('/carbon_usage/usage/%s/' % usage.id)
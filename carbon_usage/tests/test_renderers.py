@@ -0,0 +1,81 @@
+import io
+
+from collections import OrderedDict
+from datetime import date, datetime, time
+from decimal import Decimal
+from django.test import TestCase
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.serializer_helpers import ReturnList
+from ..parsers import ORJSONParser
+from ..renderers import ORJSONRenderer
+
+
+"""
+Test the orjson renderer and parser match DRF's JSON renderer and parser
+"""
+
+
+class ORJSONRendererTest(TestCase):
+
+    def assertSameRendering(self, data, accepted_media_type=None):
+        self.assertEqual(
+            ORJSONRenderer().render(data, accepted_media_type),
+            JSONRenderer().render(data, accepted_media_type))
+
+    def test_same_bytes(self):
+        now = timezone.now()
+        self.assertSameRendering({
+            'count': 2,
+            'next': None,
+            'results': ReturnList([
+                OrderedDict([('user', 'zoë'), ('usage_type', 1),
+                             ('usage_at', '2021-04-05T18:55:06.212829+02:00'),
+                             ('id', 1)]),
+                OrderedDict([('user', 'line\u2028separator'),
+                             ('usage_type', 2), ('usage_at', now),
+                             ('id', 2)]),
+            ], serializer=None),
+        })
+
+    def test_same_bytes_for_other_types(self):
+        self.assertSameRendering({
+            'utc': timezone.now(),
+            'local': timezone.localtime(timezone.now()),
+            'naive': datetime(2021, 4, 5, 18, 55),
+            'date': date(2021, 4, 5),
+            'time': time(18, 55, 6, 212829),
+            'decimal': Decimal('1.5'),
+            'lazy': gettext_lazy('Not found.'),
+            1: True,
+            'huge': 2 ** 70,
+        })
+
+    def test_indent_and_empty(self):
+        self.assertSameRendering({'a': [1, 2]}, 'application/json; indent=4')
+        self.assertEqual(ORJSONRenderer().render(None), b'')
+
+
+class ORJSONParserTest(TestCase):
+
+    def parse(self, parser, body):
+        return parser.parse(io.BytesIO(body), 'application/json', {})
+
+    def test_same_data(self):
+        body = ('{"usage_type": 1, "usage_at": "2021-04-05T18:55:06Z", '
+                '"name": "zo\\u00eb ✓", "nested": [1.5, null, true], '
+                '"huge": %s}' % 2 ** 70).encode()
+        self.assertEqual(self.parse(ORJSONParser(), body),
+                         self.parse(JSONParser(), body))
+
+    def test_same_errors(self):
+        for body in [b'{"usage_type": }', b'[NaN]']:
+            with self.assertRaises(ParseError) as expected:
+                self.parse(JSONParser(), body)
+            with self.assertRaises(ParseError) as raised:
+                self.parse(ORJSONParser(), body)
+            self.assertEqual(str(raised.exception),
+                             str(expected.exception))
@@ -0,0 +1,115 @@
+import json
+
+from http import HTTPStatus
+from django.conf import settings
+from django.db import connections
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from rest_framework.test import APIClient
+from ..catalogue import catalogue
+from ..models import UsageType, Usage
+from ..replicas import reading_from
+
+
+"""
+Test reads of the usage api are routed to the replica, except for users
+who just wrote
+
+The replica alias is a mirror of default in tests, so queries are told
+apart by the connection they run on.
+"""
+
+
+@override_settings(USAGE_READ_REPLICAS=dict(
+    settings.USAGE_READ_REPLICAS, ALIASES=['replica']))
+class ReplicaRoutingTest(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        catalogue.invalidate()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+        Usage.objects.create(user=self.user, usage_type=self.driving,
+                             usage_at='2021-04-05T10:00:00Z')
+
+    def get(self, url):
+        """
+        Return the response and the number of queries on default and on
+        the replica
+        """
+        with CaptureQueriesContext(connections['default']) as default, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.get(url)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        return response, len(default), len(replica)
+
+    def test_reads_use_the_replica(self):
+        for url in ['/carbon_usage/usage/', '/carbon_usage/usage/summary/',
+                    '/carbon_usage/usage/export/?format=ndjson']:
+            response, default, replica = self.get(url)
+            self.assertEqual(default, 0, url)
+            self.assertGreater(replica, 0, url)
+        # Usage types are served from the catalogue, loaded from default
+        response, _, replica = self.get('/carbon_usage/usage_type/')
+        self.assertEqual(replica, 0)
+        self.assertEqual(response.data['count'], 1)
+
+    def test_writer_reads_own_writes(self):
+        response = self.client.post('/carbon_usage/usage/', data=json.dumps({
+            'usage_type': self.driving.id,
+            'usage_at': '2021-04-06T10:00:00Z'}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED._value_)
+
+        response, default, replica = self.get('/carbon_usage/usage/')
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(replica, 0)
+        self.assertGreater(default, 0)
+
+        # Other users still read from the replica
+        other = User.objects.create_user(username='other')
+        self.client.force_authenticate(user=other)
+        _, default, replica = self.get('/carbon_usage/usage/')
+        self.assertEqual(default, 0)
+
+    @override_settings(USAGE_READ_REPLICAS=dict(
+        settings.USAGE_READ_REPLICAS, ALIASES=['replica'], PIN_SECONDS=0))
+    def test_pin_expires(self):
+        self.client.delete('/carbon_usage/usage/%s/' % Usage.objects.get().id)
+        _, default, replica = self.get('/carbon_usage/usage/')
+        self.assertEqual(default, 0)
+
+    def test_catalogue_loads_from_default(self):
+        response = self.client.post('/carbon_usage/usage_type/', data={
+            'name': 'flying', 'unit': 'kilometers'})
+        self.assertEqual(response.status_code, HTTPStatus.CREATED._value_)
+
+        # Another user's replica read reloads the shared catalogue
+        other = User.objects.create_user(username='other')
+        self.client.force_authenticate(user=other)
+        with CaptureQueriesContext(connections['replica']) as replica:
+            self.get('/carbon_usage/usage_type/?ordering=name')
+        self.assertFalse([query for query in replica.captured_queries
+                          if 'carbon_usage_usagetype' in query['sql']])
+
+        self.client.force_authenticate(user=self.user)
+        response, _, _ = self.get('/carbon_usage/usage_type/?ordering=name')
+        self.assertEqual([row['name'] for row in response.data['results']],
+                         ['driving', 'flying'])
+
+    def test_writes_use_default(self):
+        with reading_from('replica'):
+            usage = Usage.objects.get()
+            self.assertEqual(usage._state.db, 'replica')
+            usage.usage_type = UsageType.objects.create(name="flying",
+                                                        unit="kilometers")
+            usage.save()
+        self.assertEqual(Usage.objects.get().usage_type.name, 'flying')
@@ -0,0 +1,104 @@
+import json
+
+from datetime import timedelta
+from http import HTTPStatus
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.test import APIClient
+from ..models import UsageType, Usage
+from ..response_cache import response_cache
+
+
+"""
+Test usage list responses are cached, and never served after a write
+"""
+
+
+class UsageResponseCacheTest(TestCase):
+
+    def setUp(self):
+        response_cache().clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+        self.other = User.objects.create_user(
+            username='otheruser',
+            password='verysecure')
+
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+        self.start = timezone.now() - timedelta(days=1)
+        self.usage = Usage.objects.create(
+            user=self.user, usage_type=self.driving, usage_at=self.start)
+
+    def get(self, params=None):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/carbon_usage/usage/', params,
+                                       format='json')
+        usage_queries = [query for query in context.captured_queries
+                         if 'carbon_usage_usage' in query['sql']]
+        return json.loads(response.content), len(usage_queries)
+
+    def test_repeated_reads_are_cached(self):
+        data, queries = self.get({'ordering': '-usage_at'})
+        self.assertEqual(data['count'], 1)
+        self.assertEqual(queries, 2)
+
+        cached, queries = self.get({'ordering': '-usage_at'})
+        self.assertEqual(cached, data)
+        self.assertEqual(queries, 0)
+
+        # Other parameters are another entry
+        _, queries = self.get({'ordering': 'usage_at'})
+        self.assertEqual(queries, 2)
+
+    def test_writes_invalidate(self):
+        self.get()
+        response = self.client.post('/carbon_usage/usage/', {
+            'usage_type': self.driving.id,
+            'usage_at': self.start.isoformat()})
+        self.assertEqual(response.status_code, HTTPStatus.CREATED._value_)
+        data, _ = self.get()
+        self.assertEqual(data['count'], 2)
+
+        response = self.client.patch(
+            '/carbon_usage/usage/%s/' % self.usage.id,
+            {'usage_at': (self.start + timedelta(hours=1)).isoformat()})
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        data, queries = self.get()
+        self.assertEqual(queries, 2)
+
+        response = self.client.delete('/carbon_usage/usage/%s/'
+                                      % self.usage.id)
+        self.assertEqual(response.status_code,
+                         HTTPStatus.NO_CONTENT._value_)
+        data, _ = self.get()
+        self.assertEqual(data['count'], 1)
+
+    def test_bulk_invalidates(self):
+        self.get()
+        response = self.client.post('/carbon_usage/usage/bulk/', [{
+            'usage_type': self.driving.id,
+            'usage_at': self.start.isoformat()}] * 3, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED._value_)
+        data, _ = self.get()
+        self.assertEqual(data['count'], 4)
+
+    def test_moved_usage_invalidates_both_users(self):
+        self.get()
+        usage = Usage.objects.get(id=self.usage.id)
+        usage.user = self.other
+        usage.save()
+        data, _ = self.get()
+        self.assertEqual(data['count'], 0)
+
+    def test_per_user(self):
+        self.get()
+        self.client.force_authenticate(user=self.other)
+        data, _ = self.get()
+        self.assertEqual(data['count'], 0)
@@ -0,0 +1,131 @@
+import json
+
+from datetime import datetime, timedelta
+from io import StringIO
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.test import APIClient
+from ..models import UsageType, Usage, UsageDailyRollup
+from ..summary import summarize, summarize_rollups
+
+import pytz
+
+
+"""
+Test the daily usage rollups are kept up to date and used for summaries
+"""
+
+
+class UsageRollupTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+        self.flying = UsageType.objects.create(
+            name="flying", unit="kilometers")
+        self.tz = timezone.get_default_timezone()
+        self.day = datetime(2021, 4, 5, 12, 0, tzinfo=pytz.utc)
+
+    def rollups(self):
+        return {(rollup.usage_type_id, rollup.day): rollup.count
+                for rollup in UsageDailyRollup.objects.filter(
+                    user=self.user, count__gt=0)}
+
+    def assertRollupsMatchRebuild(self):
+        counted = self.rollups()
+        call_command('rebuild_usage_rollups', stdout=StringIO())
+        self.assertEqual(counted, self.rollups())
+
+    def test_crud_keeps_rollups_up_to_date(self):
+        response = self.client.post('/carbon_usage/usage/', data=json.dumps({
+            "usage_type": self.driving.id,
+            "usage_at": self.day.isoformat()
+        }), content_type='application/json')
+        usage_id = response.data['id']
+        self.assertEqual(self.rollups(),
+                         {(self.driving.id, self.day.date()): 1})
+
+        # Move the usage to another type and day
+        self.client.put('/carbon_usage/usage/%s/' % usage_id, data=json.dumps({
+            "usage_type": self.flying.id,
+            "usage_at": (self.day + timedelta(days=1)).isoformat()
+        }), content_type='application/json')
+        self.assertEqual(self.rollups(), {
+            (self.flying.id, self.day.date() + timedelta(days=1)): 1})
+        self.assertRollupsMatchRebuild()
+
+        self.client.delete('/carbon_usage/usage/%s/' % usage_id)
+        self.assertEqual(self.rollups(), {})
+
+    def test_bulk_and_orm_writes(self):
+        rows = [{"usage_type": self.driving.id,
+                 "usage_at": (self.day + timedelta(hours=i)).isoformat()}
+                for i in range(30)]
+        self.client.post('/carbon_usage/usage/bulk/', data=json.dumps(rows),
+                         content_type='application/json')
+        usage = Usage.objects.create(user=self.user, usage_type=self.flying,
+                                     usage_at=self.day)
+        usage.usage_type = self.driving
+        usage.save()
+        self.assertEqual(sum(self.rollups().values()), 31)
+        self.assertRollupsMatchRebuild()
+
+        # Deleting in bulk goes through the delete signals
+        Usage.objects.filter(user=self.user,
+                             usage_at__gte=self.day + timedelta(hours=20)
+                             ).delete()
+        self.assertRollupsMatchRebuild()
+
+    def test_rebuild_repairs_unsignalled_writes(self):
+        Usage.objects.create(user=self.user, usage_type=self.flying,
+                             usage_at=self.day)
+        Usage.objects.filter(user=self.user).update(usage_type=self.driving)
+        self.assertEqual(self.rollups(), {(self.flying.id, self.day.date()): 1})
+        call_command('rebuild_usage_rollups', user=[self.user.id],
+                     stdout=StringIO())
+        self.assertEqual(self.rollups(), {(self.driving.id, self.day.date()): 1})
+
+    def test_summary_served_from_rollups(self):
+        for i in range(40):
+            Usage.objects.create(
+                user=self.user,
+                usage_type=self.driving if i % 3 else self.flying,
+                usage_at=self.day + timedelta(hours=9 * i))
+
+        for bucket in ['day', 'week', 'month']:
+            raw = summarize(Usage.objects.filter(user=self.user),
+                            bucket, self.tz, 'usage_type')
+            rolled_up = summarize_rollups(self.user, bucket, self.tz,
+                                          'usage_type')
+            self.assertEqual(raw, rolled_up)
+
+        # The default time zone with day aligned bounds never reads usages
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/carbon_usage/usage/summary/', {
+                'timerange_start': '2021-04-06T00:00:00',
+                'timerange_end': '2021-04-08T23:59:59.999999'})
+        self.assertFalse(any('"carbon_usage_usage"' in query['sql']
+                             for query in context.captured_queries))
+        self.assertEqual(sum(response.data['series'][0]['counts']),
+                         Usage.objects.filter(
+                             usage_at__gte=self.tz.localize(
+                                 datetime(2021, 4, 6)),
+                             usage_at__lt=self.tz.localize(
+                                 datetime(2021, 4, 9))).count())
+
+        # Anything else falls back to the usage table
+        with CaptureQueriesContext(connection) as context:
+            self.client.get('/carbon_usage/usage/summary/', {
+                'timerange_start': '2021-04-06T10:00:00'})
+        self.assertTrue(any('"carbon_usage_usage"' in query['sql']
+                            for query in context.captured_queries))
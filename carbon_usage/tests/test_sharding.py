@@ -0,0 +1,277 @@
+import json
+
+from datetime import datetime
+from io import StringIO
+from http import HTTPStatus
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import TransactionTestCase, override_settings
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.test import APIClient
+from ..catalogue import catalogue
+from ..models import (UsageType, Usage, UsageDailyRollup, UsageCompaction,
+                      UsageIdempotencyKey)
+from .. import sharding
+
+
+"""
+Test usages are kept on their user's shard, and moved with
+move_user_shard
+
+shard1 is a database of its own in tests.
+"""
+
+
+@override_settings(USAGE_SHARDS=dict(settings.USAGE_SHARDS,
+                                     ALIASES=['default', 'shard1']))
+class UsageShardingTest(TransactionTestCase):
+    databases = {'default', 'shard1'}
+
+    def setUp(self):
+        catalogue.invalidate()
+        caches[settings.USAGE_SHARDS['CACHE']].clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+
+    def post(self, usage_at, url='/carbon_usage/usage/', **extra):
+        data = {'usage_type': self.driving.id, 'usage_at': usage_at}
+        response = self.client.post(url, data=json.dumps(data),
+                                    content_type='application/json', **extra)
+        return response
+
+    def usages(self, alias):
+        return sorted(Usage.all_objects.using(alias).filter(
+            user_id=self.user.id).values_list('id', 'usage_at'))
+
+    def test_new_users_are_spread(self):
+        other = User.objects.create_user(username='other')
+        self.assertEqual(
+            {sharding.placement(self.user.id).alias,
+             sharding.placement(other.id).alias}, {'default', 'shard1'})
+
+    def test_crud_on_shard(self):
+        sharding.place(self.user.id, 'shard1')
+        created = self.post('2021-04-05T10:00:00Z')
+        self.assertEqual(created.status_code, HTTPStatus.CREATED._value_)
+        self.assertEqual(created.data['user'], 'testuser')
+        self.assertEqual(len(self.usages('shard1')), 1)
+        self.assertEqual(self.usages('default'), [])
+
+        url = '/carbon_usage/usage/%s/' % created.data['id']
+        response = self.client.get(url)
+        self.assertEqual(response.data, created.data)
+        updated = self.client.patch(url, data=json.dumps(
+            {'usage_at': '2021-04-06T10:00:00Z'}),
+            content_type='application/json')
+        self.assertEqual(updated.status_code, HTTPStatus.OK._value_)
+
+        response = self.client.get('/carbon_usage/usage/')
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response.data['results'][0]['usage_at'],
+                         updated.data['usage_at'])
+        response = self.client.get('/carbon_usage/usage/summary/')
+        self.assertEqual(response.data['series'][0]['counts'], [1])
+        response = self.client.get('/carbon_usage/usage/export/',
+                                   {'format': 'ndjson'})
+        self.assertEqual(len(b''.join(response.streaming_content)
+                             .splitlines()), 1)
+
+        self.assertEqual(
+            self.client.delete(url).status_code,
+            HTTPStatus.NO_CONTENT._value_)
+        response = self.client.get('/carbon_usage/usage/changes/')
+        self.assertIsNotNone(response.data['results'][0]['deleted_at'])
+        self.assertEqual(UsageDailyRollup.objects.using('shard1').filter(
+            user_id=self.user.id, count__gt=0).count(), 0)
+
+    def test_bulk_on_shard(self):
+        sharding.place(self.user.id, 'shard1')
+        rows = [{'usage_type': self.driving.id,
+                 'usage_at': '2021-04-05T1%s:00:00Z' % i} for i in range(3)]
+        response = self.client.post('/carbon_usage/usage/bulk/',
+                                    data=json.dumps(rows),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED._value_)
+        self.assertEqual(len(self.usages('shard1')), 3)
+
+    def test_batch_on_shard(self):
+        sharding.place(self.user.id, 'shard1')
+        operations = [
+            {'method': 'POST', 'path': '/carbon_usage/usage_type/',
+             'body': {'name': 'cycling', 'unit': 'kilometers'}},
+            {'method': 'POST', 'path': '/carbon_usage/usage/',
+             'body': {'usage_type': '${0.id}',
+                      'usage_at': '2021-04-05T10:00:00Z'}},
+        ]
+        response = self.client.post('/carbon_usage/batch/',
+                                    data=json.dumps(operations),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        self.assertEqual(len(self.usages('shard1')), 1)
+
+        # A failure rolls back both databases
+        operations[1]['body']['usage_type'] = 999
+        response = self.client.post('/carbon_usage/batch/',
+                                    data=json.dumps(operations),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST._value_)
+        self.assertEqual(UsageType.objects.filter(name='cycling').count(), 1)
+        self.assertEqual(len(self.usages('shard1')), 1)
+
+    def test_user_list_counts_every_shard(self):
+        sharding.place(self.user.id, 'shard1')
+        self.post('2021-04-05T10:00:00Z')
+        self.post('2021-04-06T10:00:00Z')
+        admin = User.objects.create_user(username='admin', is_staff=True)
+        sharding.place(admin.id, 'default')
+        self.client.force_authenticate(user=admin)
+        response = self.client.get('/carbon_usage/users/')
+        self.assertEqual(
+            {row['username']: row['usage_count']
+             for row in response.data['results']},
+            {'testuser': 2, 'admin': 0})
+
+    def test_compact_shard(self):
+        sharding.place(self.user.id, 'shard1')
+        self.post('2020-04-05T10:00:00Z')
+        recent = self.post(timezone.now().isoformat()).data['id']
+        out = StringIO()
+        call_command('compact_usages', '--days', 365, '--no-archive',
+                     '--database', 'shard1', stdout=out)
+        self.assertIn('Compacted 1 usages in total', out.getvalue())
+        self.assertEqual([pk for pk, _ in self.usages('shard1')], [recent])
+
+        # The run is recorded on the shard it compacted
+        run = UsageCompaction.objects.using('shard1').get()
+        self.assertEqual(run.compacted, 1)
+        self.assertIsNotNone(run.finished_at)
+        self.assertFalse(UsageCompaction.objects.using('default').exists())
+
+    def test_writes_refused_while_moving(self):
+        sharding.place(self.user.id, 'default', moving=True)
+        response = self.post('2021-04-05T10:00:00Z')
+        self.assertEqual(response.status_code,
+                         HTTPStatus.SERVICE_UNAVAILABLE._value_)
+        self.assertIn('Retry-After', response)
+        response = self.client.get('/carbon_usage/usage/')
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+
+    def test_move(self):
+        sharding.place(self.user.id, 'default')
+        for day in range(1, 6):
+            self.post('2021-04-0%sT10:00:00Z' % day)
+        deleted = self.post('2021-04-09T10:00:00Z').data['id']
+        self.client.delete('/carbon_usage/usage/%s/' % deleted)
+        listed = self.client.get('/carbon_usage/usage/').data
+        summary = self.client.get('/carbon_usage/usage/summary/').data
+        changes = self.client.get('/carbon_usage/usage/changes/').data
+        before = self.usages('default')
+
+        out = StringIO()
+        call_command('move_user_shard', '--user', 'testuser',
+                     '--to', 'shard1', '--grace', 0, '--batch-size', 2,
+                     stdout=out)
+        self.assertIn('Moved testuser to shard1', out.getvalue())
+
+        self.assertEqual(self.usages('shard1'), before)
+        self.assertEqual(self.usages('default'), [])
+        self.assertEqual(sharding.placement(self.user.id),
+                         ('shard1', False, 1))
+        self.assertEqual(self.client.get('/carbon_usage/usage/').data,
+                         listed)
+        self.assertEqual(
+            self.client.get('/carbon_usage/usage/summary/').data, summary)
+
+        # A cursor from before the move starts over
+        response = self.client.get('/carbon_usage/usage/changes/',
+                                   {'since': changes['cursor']})
+        self.assertEqual(len(response.data['results']), 6)
+        self.assertTrue(response.data['cursor'].endswith('.1'))
+
+        # New usages do not reuse the moved ids
+        created = self.post('2021-04-10T10:00:00Z').data['id']
+        self.assertGreater(created, max(pk for pk, _ in before))
+
+    def other_usage(self, **fields):
+        other = User.objects.create_user(username='otheruser')
+        sharding.place(other.id, 'shard1')
+        return Usage.objects.using('shard1').create(
+            user=other, usage_type=self.driving,
+            usage_at=datetime(2021, 3, 1, 10, tzinfo=timezone.utc), **fields)
+
+    def patch_and_delete(self, pk):
+        url = '/carbon_usage/usage/%s/' % pk
+        response = self.client.patch(url, data=json.dumps(
+            {'usage_at': '2021-04-20T10:00:00Z'}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        response = self.client.delete(url)
+        self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT._value_)
+
+    def assertUntouched(self, usage):
+        found = Usage.all_objects.using('shard1').get(user=usage.user)
+        self.assertEqual((found.id, found.usage_at, found.deleted_at),
+                         (usage.id, usage.usage_at, None))
+
+    def test_move_keeps_ids_apart(self):
+        other = self.other_usage()
+        sharding.place(self.user.id, 'default')
+        created = self.post('2021-04-05T10:00:00Z').data['id']
+        # Each shard gives out ids of its own
+        self.assertNotEqual(created % 64, other.id % 64)
+
+        call_command('move_user_shard', '--user', 'testuser',
+                     '--to', 'shard1', '--grace', 0, stdout=StringIO())
+        self.patch_and_delete(created)
+        self.assertUntouched(other)
+
+    def test_move_refused_on_taken_ids(self):
+        sharding.place(self.user.id, 'default')
+        created = self.post('2021-04-05T10:00:00Z').data['id']
+        # From before the shards gave out ids of their own
+        other = self.other_usage(id=created)
+
+        with self.assertRaisesMessage(Exception, 'Not moved'):
+            call_command('move_user_shard', '--user', 'testuser',
+                         '--to', 'shard1', '--grace', 0, stdout=StringIO())
+        self.assertEqual(sharding.placement(self.user.id),
+                         ('default', False, 0))
+        self.assertEqual(self.usages('shard1'), [])
+        self.assertEqual(len(self.usages('default')), 1)
+
+        self.patch_and_delete(created)
+        self.assertUntouched(other)
+
+    def test_move_keeps_idempotency_keys(self):
+        sharding.place(self.user.id, 'default')
+        created = self.post('2021-04-05T10:00:00Z',
+                            HTTP_IDEMPOTENCY_KEY='reading-1').data['id']
+        call_command('move_user_shard', '--user', 'testuser',
+                     '--to', 'shard1', '--grace', 0, stdout=StringIO())
+
+        retry = self.post('2021-04-05T10:00:00Z',
+                          HTTP_IDEMPOTENCY_KEY='reading-1')
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.data['id'], created)
+        self.assertEqual(len(self.usages('shard1')), 1)
+        self.assertFalse(UsageIdempotencyKey.objects.using('default').exists())
+
+    def test_move_to_same_shard(self):
+        sharding.place(self.user.id, 'shard1')
+        with self.assertRaisesMessage(Exception, 'already on shard1'):
+            call_command('move_user_shard', '--user', 'testuser',
+                         '--to', 'shard1', stdout=StringIO())
+
+    def test_delete_user(self):
+        sharding.place(self.user.id, 'shard1')
+        self.post('2021-04-05T10:00:00Z')
+        self.user.delete()
+        self.assertEqual(self.usages('shard1'), [])
+        self.assertFalse(UsageDailyRollup.objects.using('shard1').exists())
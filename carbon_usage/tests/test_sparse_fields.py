@@ -0,0 +1,131 @@
+import csv
+import io
+import json
+import msgpack
+
+from datetime import timedelta
+from http import HTTPStatus
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.test import APIClient
+from ..catalogue import catalogue
+from ..models import UsageType, Usage
+
+
+"""
+Test ?fields= trims usage and usage type responses, and the columns read
+for them
+"""
+
+
+class SparseFieldsTest(TestCase):
+
+    def setUp(self):
+        catalogue.invalidate()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+        self.driving = UsageType.objects.create(name="driving",
+                                                unit="kilometers")
+        flying = UsageType.objects.create(name="flying", unit="kilometers")
+        start = timezone.now() - timedelta(days=10)
+        self.usages = [Usage.objects.create(
+            user=self.user, usage_type=self.driving if i % 2 else flying,
+            usage_at=start + timedelta(hours=i)) for i in range(5)]
+
+    def get(self, url, params=None, **extra):
+        """
+        Return the response and the SQL of the usage queries it made
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params, **extra)
+            if response.streaming:
+                response.body = b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        return response, [query['sql'] for query in queries
+                          if 'FROM "carbon_usage_usage"' in query['sql']]
+
+    def test_list(self):
+        full, _ = self.get('/carbon_usage/usage/')
+        response, sql = self.get('/carbon_usage/usage/',
+                                 {'fields': 'usage_at,id'})
+        self.assertEqual(response.data['results'], [
+            {'usage_at': row['usage_at'], 'id': row['id']}
+            for row in full.data['results']])
+        self.assertNotIn('usage_type_id', sql[-1])
+
+        response, _ = self.get('/carbon_usage/usage/', {'fields': 'user'})
+        self.assertEqual(response.data['results'][0], {'user': 'testuser'})
+
+    def test_keyset_pages(self):
+        params = {'fields': 'id', 'paginate': 'cursor', 'page_size': 2,
+                  'ordering': 'usage_type'}
+        response, _ = self.get('/carbon_usage/usage/', params)
+        ids = [row['id'] for row in response.data['results']]
+        while response.data['next']:
+            response, _ = self.get(response.data['next'])
+            self.assertEqual(list(response.data['results'][0]), ['id'])
+            ids.extend(row['id'] for row in response.data['results'])
+        self.assertEqual(sorted(ids), sorted(usage.id for usage in self.usages))
+
+    def test_retrieve(self):
+        usage = self.usages[0]
+        response, sql = self.get('/carbon_usage/usage/%s/' % usage.id,
+                                 {'fields': 'id,usage_type'})
+        self.assertEqual(response.data, {'usage_type': usage.usage_type_id,
+                                         'id': usage.id})
+        self.assertEqual(len(sql), 1)
+        self.assertNotIn('"usage_at"', sql[0].split('FROM')[0])
+
+    def test_create(self):
+        response = self.client.post(
+            '/carbon_usage/usage/?fields=id', data=json.dumps({
+                'usage_type': self.driving.id,
+                'usage_at': '2021-04-05T10:00:00Z'}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED._value_)
+        self.assertEqual(list(response.data), ['id'])
+
+    def test_msgpack(self):
+        response, _ = self.get('/carbon_usage/usage/', {'fields': 'id'},
+                               HTTP_ACCEPT='application/x-msgpack')
+        data = msgpack.unpackb(response.content)
+        self.assertEqual(data['results'], {'columns': {
+            'id': [usage.id for usage in self.usages]}})
+
+    def test_export(self):
+        response, sql = self.get('/carbon_usage/usage/export/',
+                                 {'format': 'csv', 'fields': 'usage_at,id'})
+        rows = list(csv.reader(io.StringIO(response.body.decode())))
+        self.assertEqual(rows[0], ['usage_at', 'id'])
+        self.assertEqual([int(row[1]) for row in rows[1:]],
+                         [usage.id for usage in self.usages])
+        self.assertNotIn('usage_type_id', sql[0])
+
+        response, _ = self.get('/carbon_usage/usage/export/',
+                               {'format': 'msgpack', 'fields': 'user,id'})
+        [chunk] = msgpack.Unpacker(io.BytesIO(response.body))
+        self.assertEqual(chunk, {'user': 'testuser', 'columns': {
+            'id': [usage.id for usage in self.usages]}})
+
+    def test_unknown_field(self):
+        response = self.client.get('/carbon_usage/usage/',
+                                   {'fields': 'id,password'})
+        self.assertEqual(response.status_code,
+                         HTTPStatus.BAD_REQUEST._value_)
+        self.assertIn('password', response.data['fields'][0])
+
+    def test_usage_types(self):
+        response, _ = self.get('/carbon_usage/usage_type/', {'fields': 'name'})
+        self.assertEqual(response.data['results'],
+                         [{'name': 'driving'}, {'name': 'flying'}])
+        response, _ = self.get(
+            '/carbon_usage/usage_type/%s/' % self.driving.id,
+            {'fields': 'id,unit'})
+        self.assertEqual(response.data, {'unit': 'kilometers',
+                                         'id': self.driving.id})
@@ -0,0 +1,114 @@
+from datetime import datetime
+from http import HTTPStatus
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from rest_framework.test import APIClient
+from ..models import UsageType, Usage
+
+import pytz
+
+
+"""
+Test the time bucketed usage summary at /carbon_usage/usage/summary/
+"""
+
+
+class UsageSummaryTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        other = User.objects.create_user(
+            username='otheruser',
+            password='verysecure')
+        self.client.force_authenticate(user=self.user)
+
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+        self.flying = UsageType.objects.create(
+            name="flying", unit="kilometers")
+
+        utc = pytz.utc
+        # 23:30 UTC on the 5th is already the 6th in Berlin
+        for usage_type, usage_at in [
+                (self.driving, datetime(2021, 4, 5, 10, 0, tzinfo=utc)),
+                (self.driving, datetime(2021, 4, 5, 23, 30, tzinfo=utc)),
+                (self.flying, datetime(2021, 4, 5, 12, 0, tzinfo=utc)),
+                (self.flying, datetime(2021, 5, 1, 12, 0, tzinfo=utc))]:
+            Usage.objects.create(user=self.user, usage_type=usage_type,
+                                 usage_at=usage_at)
+        Usage.objects.create(user=other, usage_type=self.driving,
+                             usage_at=datetime(2021, 4, 5, 10, 0, tzinfo=utc))
+
+    def test_daily_totals_in_utc(self):
+        response = self.client.get('/carbon_usage/usage/summary/?tz=UTC')
+        self.assertEqual(response.status_code, HTTPStatus.OK._value_)
+        self.assertEqual(response.data['series'], [{
+            'buckets': ['2021-04-05T00:00:00Z', '2021-05-01T00:00:00Z'],
+            'counts': [3, 1],
+        }])
+
+    def test_daily_per_usage_type_in_berlin(self):
+        response = self.client.get(
+            '/carbon_usage/usage/summary/',
+            {'group_by': 'usage_type', 'tz': 'Europe/Berlin'})
+        self.assertEqual(response.data['tz'], 'Europe/Berlin')
+        self.assertEqual(response.data['series'], [{
+            'usage_type': self.driving.id,
+            'buckets': ['2021-04-05T00:00:00+02:00',
+                        '2021-04-06T00:00:00+02:00'],
+            'counts': [1, 1],
+        }, {
+            'usage_type': self.flying.id,
+            'buckets': ['2021-04-05T00:00:00+02:00',
+                        '2021-05-01T00:00:00+02:00'],
+            'counts': [1, 1],
+        }])
+
+    def test_month_buckets_with_timerange(self):
+        response = self.client.get(
+            '/carbon_usage/usage/summary/',
+            {'bucket': 'month', 'tz': 'UTC',
+             'timerange_start': '2021-04-05T11:00:00+00:00'})
+        self.assertEqual(response.data['series'], [{
+            'buckets': ['2021-04-01T00:00:00Z', '2021-05-01T00:00:00Z'],
+            'counts': [2, 1],
+        }])
+
+    def test_week_buckets_default_time_zone(self):
+        response = self.client.get('/carbon_usage/usage/summary/?bucket=week')
+        self.assertEqual(response.data['tz'], 'CET')
+        self.assertEqual(response.data['series'][0]['counts'], [3, 1])
+
+    def test_invalid_parameters(self):
+        for params in [{'tz': 'Mars/Olympus'}, {'bucket': 'hour'},
+                       {'group_by': 'user'}]:
+            response = self.client.get('/carbon_usage/usage/summary/', params)
+            self.assertEqual(response.status_code,
+                             HTTPStatus.BAD_REQUEST._value_)
+
+    def test_dst_in_default_time_zone(self):
+        # 22:30 UTC in April is already the next day in CET, as daylight
+        # saving time applies (postgres reads AT TIME ZONE 'CET' as +01:00)
+        Usage.objects.create(
+            user=self.user, usage_type=self.driving,
+            usage_at=datetime(2021, 4, 6, 22, 30, tzinfo=pytz.utc))
+        response = self.client.get('/carbon_usage/usage/summary/', {
+            'timerange_start': '2021-04-06T12:00:00+00:00'})
+        self.assertEqual(response.data['series'], [{
+            'buckets': ['2021-04-07T00:00:00+02:00',
+                        '2021-05-01T00:00:00+02:00'],
+            'counts': [1, 1],
+        }])
+
+    def test_single_query(self):
+        with CaptureQueriesContext(connection) as context:
+            self.client.get('/carbon_usage/usage/summary/?group_by=usage_type'
+                            '&timerange_start=2021-01-01T12:00:00')
+        self.assertEqual(len([query for query in context.captured_queries
+                              if 'FROM "carbon_usage_usage"' in query['sql']]),
+                         1)
@@ -312,9 +312,11 @@ class UsageTest(TestCase):
         self.assertEqual(response.data, {
             "user": "testuser",
             "usage_type": self.driving.id,
-            "id": self.test_usage.id+1,  # TODO unideal
+            "id": new_usage['id'],
             "usage_at": datetime_string
         })
+        # Ids go up in steps, see migration 0009
+        self.assertGreater(new_usage['id'], self.test_usage.id)
 
         ###
         # Test partial update usage
@@ -335,7 +337,7 @@ class UsageTest(TestCase):
             "user": "testuser",
             "usage_type": self.flying.id,
             "usage_at": datetime_string,  # Same as above
-            "id": self.test_usage.id+1,   # TODO unideal
+            "id": new_usage['id'],
         })
 
         ###
@@ -358,14 +360,14 @@ class UsageTest(TestCase):
             "user": "testuser",
             "usage_type": self.driving.id,
             "usage_at": datetime_string,  # same as earlier
-            "id": self.test_usage.id+1,   # TODO unideal
+            "id": new_usage['id'],
         })
 
         ###
         # Test GET single usage
         ###
         response = self.client.get('/carbon_usage/usage/%s/'
-                                   % str(self.test_usage.id+1))
+                                   % new_usage['id'])
         # Check you get a 200 back:
         self.assertEqual(response.status_code, HTTPStatus.OK._value_)
         # Compare directly against return value of update call above
@@ -375,7 +377,7 @@ class UsageTest(TestCase):
         # Test delete
         ###
         response = self.client.delete('/carbon_usage/usage/%s/'
-                                      % str(self.test_usage.id+1),
+                                      % new_usage['id'],
                                       content_type='application/json')
         # Check you get a 204 back, indicating
         # deletion was successful and no content to return
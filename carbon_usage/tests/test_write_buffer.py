@@ -0,0 +1,130 @@
+import json
+import threading
+
+from http import HTTPStatus
+from unittest import mock
+from django.conf import settings
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.contrib.auth.models import User
+from rest_framework.test import APIClient
+from ..catalogue import catalogue
+from ..models import UsageType, Usage, UsageDailyRollup
+from ..write_buffer import WriteBuffer, write_buffer
+
+
+"""
+Test buffering single usage creations into batched inserts
+
+The buffer inserts from a thread of its own, with its own connection,
+so these tests commit their data.
+"""
+
+
+def buffer_settings(**config):
+    return override_settings(USAGE_WRITE_BUFFER=dict(
+        settings.USAGE_WRITE_BUFFER, ENABLED=True, **config))
+
+
+class WriteBufferTest(TransactionTestCase):
+
+    def setUp(self):
+        catalogue.invalidate()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='verysecure')
+        self.driving = UsageType.objects.create(
+            name="driving", unit="kilometers")
+
+    def post(self, hour, **headers):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        try:
+            return client.post('/carbon_usage/usage/', data=json.dumps({
+                'usage_type': self.driving.id,
+                'usage_at': '2021-04-05T%02d:00:00Z' % hour,
+            }), content_type='application/json', **headers)
+        finally:
+            connection.close()
+
+    def counted(self):
+        return sum(UsageDailyRollup.objects.filter(
+            user=self.user).values_list('count', flat=True))
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(write_buffer())
+
+    def test_concurrent_creates_are_batched(self):
+        responses = []
+        with buffer_settings(MAX_ROWS=5, MAX_DELAY_MS=1000):
+            threads = [threading.Thread(
+                target=lambda hour=hour: responses.append(self.post(hour)))
+                for hour in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([response.status_code for response in responses],
+                         [HTTPStatus.CREATED._value_] * 5)
+        self.assertEqual(sorted(response.data['id'] for response in responses),
+                         sorted(Usage.objects.values_list('id', flat=True)))
+        self.assertEqual(self.counted(), 5)
+        # All inserted by one transaction
+        self.assertEqual(
+            len(set(Usage.objects.values_list('change_xid', flat=True))), 1)
+
+    def test_idempotency_key(self):
+        with buffer_settings(MAX_DELAY_MS=1):
+            first = self.post(1, HTTP_IDEMPOTENCY_KEY='reading-1')
+            retry = self.post(1, HTTP_IDEMPOTENCY_KEY='reading-1')
+            reused = self.post(2, HTTP_IDEMPOTENCY_KEY='reading-1')
+        self.assertEqual(retry.data['id'], first.data['id'])
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(reused.status_code,
+                         HTTPStatus.UNPROCESSABLE_ENTITY._value_)
+        self.assertEqual(self.counted(), 1)
+
+    def test_flush_timeout(self):
+        flush = WriteBuffer.flush
+        release = threading.Event()
+
+        def blocked_flush(buffer, batch):
+            release.wait(10)
+            flush(buffer, batch)
+
+        with buffer_settings(MAX_DELAY_MS=1, TIMEOUT=0.1), \
+                mock.patch.object(WriteBuffer, 'flush', blocked_flush):
+            response = self.post(1, HTTP_IDEMPOTENCY_KEY='reading-1')
+            self.assertEqual(response.status_code,
+                             HTTPStatus.SERVICE_UNAVAILABLE._value_)
+            self.assertEqual(response['Retry-After'], '1')
+            self.assertIn('idempotency key', response.data['detail'])
+
+            # Committed once the flush goes through, a retry replays it
+            release.set()
+            write_buffer().close()
+        self.assertEqual(Usage.objects.count(), 1)
+        with buffer_settings(MAX_DELAY_MS=1):
+            retry = self.post(1, HTTP_IDEMPOTENCY_KEY='reading-1')
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+
+    def test_ack_after_enqueue(self):
+        with buffer_settings(ACK='enqueue', MAX_DELAY_MS=1):
+            response = self.post(1)
+            self.assertEqual(response.status_code,
+                             HTTPStatus.ACCEPTED._value_)
+            self.assertIsNone(response.data['id'])
+            self.assertEqual(response.data['user'], 'testuser')
+            # Closing flushes what is still buffered
+            write_buffer().close()
+        self.assertEqual(Usage.objects.count(), 1)
+
+    def test_failed_flush(self):
+        buffer = WriteBuffer(max_rows=1)
+        with self.assertLogs('carbon_usage.write_buffer', 'ERROR'):
+            future = buffer.submit(self.user, {'usage_type': 0,
+                                               'usage_at': 'not a date'})
+            with self.assertRaises(Exception):
+                future.result(10)
+            buffer.close()
@@ -14,4 +14,10 @@ router.register(r'usage', views.UsageViewSet, 'usage-list')
 urlpatterns = [
     # Include router urls
     path('', include(router.urls)),
+    # Several usage and usage type writes in one transaction
+    path('batch/', views.UsageBatch.as_view(), name='batch'),
+    # Users and their usage counts, for admins
+    path('users/', views.UserList.as_view(), name='users'),
+    # Request timings, for admins
+    path('timings/', views.TimingList.as_view(), name='timings'),
 ]
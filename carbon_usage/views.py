@@ -1,31 +1,98 @@
+import hashlib
+
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from django.db import transaction
+from django.http import Http404
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
 from django.shortcuts import render, redirect
 from .models import UsageType, Usage
 from carbon_usage.permissions import IsOwner
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework import viewsets
 from .serializers import UsageSerializer, UsageTypeSerializer, UserSerializer
+from .serializers import UsageSummaryQuerySerializer
+from .serializers import UsageChangesQuerySerializer
+from .serializers import BatchOperationSerializer
 from rest_framework import generics
 from django.contrib.auth.models import User
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.forms import UserCreationForm
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework import filters
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.views import APIView
+from django.conf import settings
+from .batch import run_batch
+from .catalogue import catalogue
+from .changes import usage_changes, encode_cursor
+from .export import usage_chunks, usage_column_chunks, streaming_response
+from .instrumentation import ServerTimingMixin, timed
+from .response_cache import cached_response
+from . import instrumentation
+from .ingest import validate_usage_rows, create_usages
+from .export import FIELDS as EXPORT_FIELDS
+from .pagination import KeysetPagination
+from .parsers import ORJSONParser, NDJSONParser
+from .renderers import CSVRenderer, NDJSONRenderer, MessagePackRenderer
+from .replicas import ReplicaReadMixin
+from .sharding import UserShardMixin, current_shard, placement
+from .sparse_fields import SparseFieldsViewMixin
+from .summary import summarize, summarize_rollups
+from .write_buffer import WriteTimedOut, write_buffer
+from . import rollups
 
 
-class UserList(generics.ListAPIView):
-    queryset = User.objects.all()
+class UserList(ServerTimingMixin, generics.ListAPIView):
+    """
+    Users and how many usages each has, for admins
+    """
+    permission_classes = [IsAdminUser]
+    queryset = User.objects.order_by('id')
     serializer_class = UserSerializer
 
+    def list(self, request, *args, **kwargs):
+        page = self.paginate_queryset(self.get_queryset())
+        users = list(self.get_queryset()) if page is None else page
+        # One query per shard for the whole page, see rollups.py
+        counts = rollups.usage_counts(users)
+        for user in users:
+            user.usage_count = counts.get(user.id, 0)
+        serializer = self.get_serializer(users, many=True)
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
+
 
-class UsageViewSet(viewsets.ModelViewSet):
+class UsageViewSet(UserShardMixin, ReplicaReadMixin, ServerTimingMixin,
+                   SparseFieldsViewMixin, viewsets.ModelViewSet):
 
     permission_classes = [IsAuthenticated, IsOwner]
     serializer_class = UsageSerializer
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [
+        MessagePackRenderer]
     ordering_fields = ['usage_at', 'usage_type']
     filter_backends = [filters.OrderingFilter]
 
+    @property
+    def paginator(self):
+        # Keyset pagination is opt in, via ?paginate=cursor for the first
+        # page, after which the next/previous links carry a cursor
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            if params.get('paginate') == 'cursor' or 'cursor' in params:
+                self._paginator = KeysetPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
     def get_queryset(self):
-        # Filter by user
+        # Filter by user, the user is set on the usages in get_object(),
+        # users not being on the usages' shard, see sharding.py
         user = self.request.user
         queryset = Usage.objects.filter(user=user)
 
@@ -40,13 +107,237 @@ class UsageViewSet(viewsets.ModelViewSet):
         if timerange_end is not None:
             queryset = queryset.filter(usage_at__lte=timerange_end)
 
+        # Only read the columns of ?fields=, and user_id for IsOwner
+        if self.action == 'retrieve' and self.requested_fields:
+            queryset = queryset.only('user_id', *UsageSerializer
+                                     .fast_values_for(self.requested_fields))
+
         return queryset
 
+    def get_object(self):
+        usage = super().get_object()
+        usage.user = self.request.user
+        return usage
+
+    def list(self, request, *args, **kwargs):
+        # Repeated polls of the same list are answered from the cache,
+        # see response_cache.py
+        return cached_response(request, self.list_response)
+
+    def list_response(self):
+        # Read only fast path, plain dicts instead of model
+        # and serializer instances, see UsageSerializer
+        request = self.request
+        fields = self.requested_fields
+        queryset = self.filter_queryset(self.get_queryset())
+        rows = queryset.values(*UsageSerializer.fast_values_for(fields))
+        page = self.paginate_queryset(rows)
+        with timed(request, 'serialize'):
+            if getattr(request.accepted_renderer, 'columnar', False):
+                data = UsageSerializer.to_columns(
+                    rows if page is None else page, request.user, fields)
+            else:
+                data = UsageSerializer.to_representation_fast(
+                    rows if page is None else page, request.user, fields)
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+    def create(self, request, *args, **kwargs):
+        # A retry, carrying the idempotency key of an earlier create, is
+        # answered with the usage that one created, see ingest.py
+        data = request.data
+        key = request.headers.get('Idempotency-Key')
+        if key is not None and isinstance(data, dict) \
+                and 'idempotency_key' not in data:
+            data = data.copy()
+            data['idempotency_key'] = key
+        serializer = self.get_serializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        validated = serializer.validated_data
+        row = {'usage_type': validated['usage_type'].id,
+               'usage_at': validated['usage_at']}
+        if 'idempotency_key' in validated:
+            row['idempotency_key'] = validated['idempotency_key']
+
+        buffer = write_buffer()
+        if buffer is not None and \
+                transaction.get_connection(current_shard()).in_atomic_block:
+            # The buffer commits on its own, creates in a transaction,
+            # those of a batch, are made in it
+            buffer = None
+        if buffer is not None:
+            # Inserted along with other requests' usages, see write_buffer.py
+            future = buffer.submit(request.user, row)
+            if settings.USAGE_WRITE_BUFFER['ACK'] == 'enqueue':
+                usage = Usage(user=request.user,
+                              usage_type_id=row['usage_type'],
+                              usage_at=row['usage_at'])
+                return Response(self.get_serializer(usage).data,
+                                status=status.HTTP_202_ACCEPTED)
+            try:
+                # Raises the APIException refusing a reused key
+                usage, created = future.result(
+                    settings.USAGE_WRITE_BUFFER['TIMEOUT'])
+            except FutureTimeoutError:
+                raise WriteTimedOut()
+        elif 'idempotency_key' not in row:
+            self.perform_create(serializer)
+            return Response(serializer.data, status=status.HTTP_201_CREATED,
+                            headers=self.get_success_headers(serializer.data))
+        else:
+            [result] = create_usages(request.user, [row])
+            if isinstance(result, APIException):
+                raise result
+            usage, created = result
+
+        headers = {} if created else {'Idempotent-Replayed': 'true'}
+        return Response(self.get_serializer(usage).data,
+                        status=status.HTTP_201_CREATED, headers=headers)
+
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    @action(detail=False, methods=['post'],
+            parser_classes=[ORJSONParser, NDJSONParser])
+    def bulk(self, request):
+        """
+        Create many usages from a JSON array or NDJSON body
+
+        Invalid rows are reported by index and do not stop the valid rows
+        from being created. ids lines up with the input, null for rows
+        that were not created.
+
+        Rows may carry an idempotency_key, an Idempotency-Key header
+        gives the rows without one <key>:<index>. Rows retried with the
+        same key get the id of the usage created the first time, rows
+        reusing a key for another usage or a deleted one are reported.
+        """
+        rows = request.data
+        if not isinstance(rows, list):
+            raise ValidationError(
+                {'non_field_errors': ['Expected a list of usages.']})
+        if len(rows) > settings.USAGE_BULK_MAX_ROWS:
+            raise ValidationError({'non_field_errors': [
+                'At most %s usages can be created at once.'
+                % settings.USAGE_BULK_MAX_ROWS]})
+
+        key = request.headers.get('Idempotency-Key')
+        if key is not None and len('%s:%s' % (key, len(rows))) > 255:
+            raise ValidationError({'non_field_errors': [
+                'The Idempotency-Key header is too long.']})
+
+        valid, errors = validate_usage_rows(rows)
+        if key is not None:
+            for index, data in valid:
+                data.setdefault('idempotency_key', '%s:%s' % (key, index))
+        created = create_usages(request.user, [data for _, data in valid])
+
+        ids = [None] * len(rows)
+        for (index, _), result in zip(valid, created):
+            if isinstance(result, APIException):
+                errors.append({'index': index, 'errors': {
+                    'idempotency_key': [result.detail]}})
+            else:
+                ids[index] = result[0].id
+        errors.sort(key=lambda error: error['index'])
+
+        if errors and not any(pk is not None for pk in ids):
+            response_status = status.HTTP_400_BAD_REQUEST
+        else:
+            response_status = status.HTTP_201_CREATED
+        return Response({'ids': ids, 'errors': errors},
+                        status=response_status)
+
+    @action(detail=False, renderer_classes=[CSVRenderer, NDJSONRenderer,
+                                            MessagePackRenderer])
+    def export(self, request):
+        """
+        Stream every matching usage as CSV, NDJSON or columnar MessagePack,
+        unpaginated
+
+        Takes the same filtering, ordering and fields parameters as the
+        list route, pick the format with ?format=csv|ndjson|msgpack or the
+        Accept header.
+        """
+        fields = self.requested_fields or EXPORT_FIELDS
+        queryset = self.filter_queryset(self.get_queryset())
+        if not queryset.ordered:
+            queryset = queryset.order_by('usage_at', 'id')
+        if getattr(request.accepted_renderer, 'columnar', False):
+            chunks = usage_column_chunks(queryset, request.user, fields)
+        else:
+            chunks = usage_chunks(queryset, request.user, fields)
+        return streaming_response(request, request.accepted_renderer,
+                                  chunks, 'usage', fields)
+
+    @action(detail=False)
+    def changes(self, request):
+        """
+        Usages created, updated or deleted since a cursor, for syncing
+
+        ?since=<cursor from the previous call>&limit=1000, start without
+        since. Deleted usages come with deleted_at set. Call again with the
+        returned cursor while more is true, and later on to sync again.
+        """
+        params = UsageChangesQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        since, epoch = params.validated_data['since']
+        user_placement = placement(request.user.id)
+        if epoch != user_placement.epoch:
+            # Given before the user moved shard, start over
+            since = (0, 0)
+        rows, cursor, more = usage_changes(request.user, since,
+                                           params.validated_data['limit'],
+                                           using=current_shard())
+        with timed(request, 'serialize'):
+            results = UsageSerializer.to_representation_changes(
+                rows, request.user)
+        return Response({'results': results,
+                         'cursor': encode_cursor(cursor, user_placement.epoch),
+                         'more': more})
+
+    @action(detail=False)
+    def summary(self, request):
+        """
+        Usage counts per day, week or month, optionally per usage type
 
-class UsageTypeViewSet(viewsets.ModelViewSet):
+        ?bucket=day|week|month&group_by=usage_type&tz=Europe/Berlin,
+        plus the timerange filters of the list route.
+        """
+        params = UsageSummaryQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        bucket = params.validated_data['bucket']
+        tz = params.validated_data['tz']
+        group_by = params.validated_data['group_by']
+
+        try:
+            first_day, last_day = rollups.day_range(
+                tz, request.query_params.get('timerange_start'),
+                request.query_params.get('timerange_end'))
+        except ValueError as exc:
+            # Raw usages are gone before the last compaction, only the
+            # rollups still count them, see compaction.py
+            before = rollups.compacted_before(current_shard())
+            if before is not None and rollups.starts_before(
+                    request.query_params.get('timerange_start'), before):
+                raise ValidationError({'non_field_errors': [
+                    '%s. Usages before %s were compacted into daily totals, '
+                    'summarize those in %s with timerange_start at midnight '
+                    'and timerange_end at the end of a day, or start the '
+                    'range after them.' % (
+                        exc, before.isoformat(),
+                        rollups.rollup_timezone().zone)]})
+            series = summarize(self.get_queryset(), bucket, tz, group_by)
+        else:
+            series = summarize_rollups(request.user, bucket, tz, group_by,
+                                       first_day, last_day)
+        return Response({'bucket': bucket, 'tz': tz.zone,
+                         'group_by': group_by or None, 'series': series})
+
+
+class UsageTypeViewSet(ReplicaReadMixin, ServerTimingMixin,
+                       SparseFieldsViewMixin, viewsets.ModelViewSet):
 
     permission_classes = [IsAuthenticated]
     ordering_fields = ['unit', 'name']
@@ -54,6 +345,114 @@ class UsageTypeViewSet(viewsets.ModelViewSet):
     queryset = UsageType.objects.all().order_by('id')
     serializer_class = UsageTypeSerializer
 
+    def catalogue_response(self, request, represent):
+        """
+        Answer a read from the usage type catalogue, with a strong ETag
+
+        The ETag covers the catalogue content and everything else the
+        response depends on, so a matching If-None-Match gets a 304
+        without the database being touched.
+        """
+        etag = '"%s"' % hashlib.sha1('\n'.join([
+            catalogue.digest(),
+            request.get_host(),
+            request.path,
+            repr(sorted(request.query_params.lists())),
+            request.accepted_media_type,
+        ]).encode()).hexdigest()
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            # If-None-Match uses the weak comparison
+            etags = [tag[2:] if tag.startswith('W/') else tag
+                     for tag in parse_etags(if_none_match)]
+            if etag in etags or '*' in etags:
+                response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            else:
+                response = represent()
+        else:
+            response = represent()
+
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        patch_vary_headers(response, ['Accept', 'Authorization'])
+        return response
+
+    def list(self, request, *args, **kwargs):
+        # Served from the catalogue, see catalogue.py
+        def represent():
+            ordering = filters.OrderingFilter().get_ordering(
+                request, self.get_queryset(), self)
+            rows = catalogue.rows(ordering)
+            page = self.paginate_queryset(rows)
+            rows = rows if page is None else page
+            fields = self.requested_fields
+            if fields:
+                rows = [{name: row[name] for name in fields} for row in rows]
+            if page is not None:
+                return self.get_paginated_response(rows)
+            return Response(rows)
+        return self.catalogue_response(request, represent)
+
+    def retrieve(self, request, *args, **kwargs):
+        # Served from the catalogue, writes still go through get_object()
+        try:
+            usage_type = catalogue.get(int(kwargs['pk']))
+        except ValueError:
+            usage_type = None
+        if usage_type is None:
+            raise Http404
+
+        def represent():
+            return Response(self.get_serializer(usage_type).data)
+        return self.catalogue_response(request, represent)
+
+
+class UsageBatch(ServerTimingMixin, APIView):
+    """
+    Run a list of usage and usage type writes in one transaction
+
+    Each operation is {"method": ..., "path": ..., "body": ...}, the
+    response lists the status and body each got, up to the first that
+    failed, in which case none of them is kept and the batch gets its
+    status. See batch.py.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        operations = request.data
+        if not isinstance(operations, list):
+            raise ValidationError(
+                {'non_field_errors': ['Expected a list of operations.']})
+        if len(operations) > settings.USAGE_BATCH_MAX_OPERATIONS:
+            raise ValidationError({'non_field_errors': [
+                'At most %s operations can be run at once.'
+                % settings.USAGE_BATCH_MAX_OPERATIONS]})
+        serializer = BatchOperationSerializer(data=operations, many=True)
+        serializer.is_valid(raise_exception=True)
+
+        results = run_batch(request, serializer.validated_data,
+                            {UsageViewSet, UsageTypeViewSet})
+        response_status = status.HTTP_200_OK
+        if results and results[-1]['status'] >= 400:
+            response_status = results[-1]['status']
+        return Response({'results': results}, status=response_status)
+
+
+class TimingList(APIView):
+    """
+    Request timing histograms of the process answering, per route
+
+    See instrumentation.py, the request_timings command
+    shows those of every process.
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(instrumentation.summarize(
+            instrumentation.registry.snapshot()))
+
 
 # Breaking from viewsets for user signup routine, to use
 # django built in tooling, using their user model instead of
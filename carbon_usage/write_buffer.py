@@ -0,0 +1,178 @@
+import atexit
+import logging
+import threading
+import time
+
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from .ingest import create_many_usages
+from .sharding import group_by_shard
+
+"""
+Micro-batching of single usage creations
+
+With settings.USAGE_WRITE_BUFFER['ENABLED'], POST /carbon_usage/usage/
+validates the usage as usual, then hands it to an in-process buffer
+instead of inserting it in a transaction of its own. A background thread
+inserts the buffered usages, of every user, together in one transaction
+(see ingest.create_many_usages) whenever MAX_ROWS are waiting, or
+MAX_DELAY_MS after the oldest one was buffered. With several shards, in
+one transaction per shard, see sharding.py.
+
+With ACK 'flush' a request is answered once its usage is committed, with
+its id, so nothing acknowledged can be lost. With ACK 'enqueue' it is
+answered 202 as soon as the usage is buffered, without an id, and
+usages still buffered are lost if the process dies. A request with ACK
+'flush' whose usage is not committed within TIMEOUT seconds is answered
+503, the usage may still be committed afterwards.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class WriteTimedOut(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = ('Your usage was not stored in time, it may still be. '
+                      'Retry with an idempotency key to not store it twice.')
+    default_code = 'write_timed_out'
+
+    def __init__(self, detail=None, code=None, wait=1):
+        super().__init__(detail, code)
+        # Sent as Retry-After
+        self.wait = wait
+
+
+class WriteBuffer:
+
+    def __init__(self, max_rows=500, max_delay=0.005):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        # (time buffered, user, row, future)
+        self.pending = []
+        self.closed = False
+        self.worker = None
+
+    def submit(self, user, row):
+        """
+        Buffer a validated usage row of user
+
+        Returns a Future of its (usage, created) pair, see
+        ingest.create_usages(), or raising the APIException refusing it.
+        """
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('The write buffer is closed')
+            if self.worker is None:
+                self.worker = threading.Thread(
+                    target=self.run, name='usage-write-buffer', daemon=True)
+                self.worker.start()
+            self.pending.append((time.monotonic(), user, row, future))
+            if len(self.pending) == 1 or len(self.pending) >= self.max_rows:
+                self.condition.notify()
+        return future
+
+    def next_batch(self):
+        """
+        Wait until a batch is due and take it, None once closed and empty
+        """
+        with self.condition:
+            while not self.pending:
+                if self.closed:
+                    return None
+                self.condition.wait()
+            deadline = self.pending[0][0] + self.max_delay
+            while len(self.pending) < self.max_rows and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = self.pending[:self.max_rows]
+            del self.pending[:self.max_rows]
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            self.flush(batch)
+
+    def flush(self, batch):
+        try:
+            # A shard failing does not fail the usages of the others
+            try:
+                groups = list(group_by_shard(
+                    [user for _, user, _, _ in batch]).values())
+            except Exception:
+                # Then fails in flush_shard(), failing every usage
+                groups = [range(len(batch))]
+            for indexes in groups:
+                self.flush_shard([batch[i] for i in indexes])
+        finally:
+            close_old_connections()
+
+    def flush_shard(self, batch):
+        try:
+            results = create_many_usages(
+                [(user, row) for _, user, row, _ in batch])
+        except Exception as exc:
+            logger.exception('Could not insert %s buffered usages',
+                             len(batch))
+            for *_, future in batch:
+                future.set_exception(exc)
+        else:
+            for (*_, future), result in zip(batch, results):
+                if isinstance(result, APIException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def close(self, timeout=None):
+        """
+        Insert what is still buffered and stop the background thread
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+            worker = self.worker
+        if worker is not None:
+            worker.join(timeout)
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def write_buffer():
+    """
+    Return the process' write buffer, None when buffering is disabled
+    """
+    global _buffer
+    config = settings.USAGE_WRITE_BUFFER
+    if not config['ENABLED']:
+        return None
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = WriteBuffer(config['MAX_ROWS'],
+                                  config['MAX_DELAY_MS'] / 1000)
+            atexit.register(_buffer.close, config['TIMEOUT'])
+        return _buffer
+
+
+@receiver(setting_changed)
+def reset_write_buffer(setting, **kwargs):
+    global _buffer
+    if setting == 'USAGE_WRITE_BUFFER':
+        with _buffer_lock:
+            if _buffer is not None:
+                _buffer.close()
+            _buffer = None
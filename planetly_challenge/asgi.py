@@ -3,14 +3,21 @@ ASGI config for planetly_challenge project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The usage list, summary and export endpoints are served asynchronously,
+see carbon_usage/async_views.py.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 """
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'planetly_challenge.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+from carbon_usage.async_views import ReadPoolASGIHandler  # noqa: E402
+
+application = ReadPoolASGIHandler(urlconf='planetly_challenge.asgi_urls')
@@ -0,0 +1,13 @@
+from django.urls import include, path
+from .urls import urlpatterns as wsgi_urlpatterns
+
+"""
+Project wide routes when served through ASGI, see asgi.py
+
+The usage read endpoints are served asynchronously, matched before the
+routes of urls.py, which serve everything else as under WSGI.
+"""
+
+urlpatterns = [
+    path('carbon_usage/', include('carbon_usage.async_urls')),
+] + wsgi_urlpatterns
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+import os
+
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -55,17 +57,143 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,
     'TEST_REQUEST_DEFAULT_FORMAT': 'json',
+    # Same output and input as DRF's JSON renderer and parser, faster
+    'DEFAULT_RENDERER_CLASSES': [
+        'carbon_usage.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'carbon_usage.parsers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'DEFAULT_PERMISSION_CLASSES': ["rest_framework.permissions.IsAuthenticated"],
     'DEFAULT_AUTHENTICATION_CLASSES': [
         # TODO Understand does my authentication break if
         # SessionAuthentication is not included?
-        'rest_framework.authentication.TokenAuthentication',
+        'carbon_usage.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
         'rest_framework.authentication.BasicAuthentication',
        ],
 }
 
+# CARBON USAGE SETTINGS
+
+# Maximum number of rows accepted by POST /carbon_usage/usage/bulk/
+USAGE_BULK_MAX_ROWS = 50000
+# Maximum number of operations accepted by POST /carbon_usage/batch/
+USAGE_BATCH_MAX_OPERATIONS = 1000
+# Most changes returned by one request to the usage changes feed
+USAGE_CHANGES_MAX_LIMIT = 1000
+
+# Batched inserts of single usage creations, see
+# carbon_usage/write_buffer.py
+USAGE_WRITE_BUFFER = {
+    'ENABLED': False,
+    # Usages inserted together at most
+    'MAX_ROWS': 500,
+    # Longest a usage waits for others to be inserted with
+    'MAX_DELAY_MS': 5,
+    # 'flush' answers once the usage is committed, 'enqueue' as soon as
+    # it is buffered, losing it if the process dies before it is inserted
+    'ACK': 'flush',
+    # Seconds a request waits for its usage to be inserted
+    'TIMEOUT': 10,
+}
+
+# Databases usages are spread over by user, see carbon_usage/sharding.py
+USAGE_SHARDS = {
+    # Aliases from DATABASES holding usages. Users are placed by id when
+    # they sign up, and stay there unless moved with move_user_shard.
+    # Users from before sharding are on the first one
+    'ALIASES': ['default'],
+    # Alias from CACHES of the user to shard map, shared by all processes
+    # when running several
+    'CACHE': 'default',
+    'CACHE_TTL': 300,
+}
+
+# Reads of the usage api from replicas, see carbon_usage/replicas.py
+USAGE_READ_REPLICAS = {
+    # Aliases from DATABASES the reads are spread over, none reads default
+    'ALIASES': ['replica'] if os.environ.get('POSTGRES_REPLICA_HOST') else [],
+    # Seconds a user reads from default after writing, has to be longer
+    # than the replicas lag behind
+    'PIN_SECONDS': 5,
+    # Alias from CACHES keeping the pins, shared by all processes when
+    # running several
+    'CACHE': 'default',
+}
+
+# Usage reads served asynchronously under ASGI, see
+# carbon_usage/async_views.py
+ASYNC_READS = {
+    # Threads running the reads, each with its own database connection
+    'THREADS': 16,
+}
+
+# Raw usages kept, see carbon_usage/compaction.py
+USAGE_RETENTION = {
+    # Usages older than this many days are compacted into their rollups
+    'DAYS': 730,
+    # Directory compacted usages are archived to, None to not keep them
+    'ARCHIVE_DIR': None,
+}
+
+# Token authentication cache, see carbon_usage/authentication.py
+TOKEN_AUTH_CACHE = {
+    'MAX_SIZE': 10000,
+    # Seconds another process may keep accepting a revoked token
+    'TTL': 30,
+    # Optional alias from CACHES shared by all processes
+    'SHARED_CACHE': None,
+    'SHARED_TTL': 300,
+}
+
+USAGE_TYPE_CATALOGUE = {
+    # Seconds another process may serve usage types from before a change,
+    # when there is no shared cache to tell it about the change sooner
+    'TTL': 60,
+    # Optional alias from CACHES shared by all processes
+    'SHARED_CACHE': None,
+}
+
+# Rendered usage lists, see carbon_usage/response_cache.py. None disables it
+USAGE_RESPONSE_CACHE = 'usage_responses'
+
+SERVER_TIMING = {
+    # Fraction of requests measured, 0 turns the measuring off
+    'SAMPLE_RATE': 1.0,
+    # Send the measures to clients in a Server-Timing header: False, 'staff'
+    # for staff users only, or True for everyone. They tell how long each
+    # request spends in the database, admins read them from the histograms
+    'HEADER': False,
+    # Seconds of history kept in the per route histograms
+    'WINDOW': 300,
+    # Optional alias from CACHES shared by all processes, where each
+    # process publishes its histograms for the request_timings command
+    'SHARED_CACHE': None,
+    'PUBLISH_INTERVAL': 10,
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Each process only sees its own writes with a local memory backend,
+    # switch to e.g. django.core.cache.backends.filebased.FileBasedCache
+    # when running several processes
+    'usage_responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'usage_responses',
+        'TIMEOUT': 300,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
 MIDDLEWARE = [
+    # First, so the total covers the other middleware too
+    'carbon_usage.instrumentation.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -110,6 +238,30 @@ DATABASES = {
     }
 }
 
+# A read replica of default, see USAGE_READ_REPLICAS. Without
+# POSTGRES_REPLICA_HOST, a second connection to the same server, enough to
+# try the routing out
+DATABASES['replica'] = dict(
+    DATABASES['default'],
+    HOST=os.environ.get('POSTGRES_REPLICA_HOST', DATABASES['default']['HOST']),
+    TEST={'MIRROR': 'default'},
+)
+
+# A second shard for usages, see USAGE_SHARDS. Set POSTGRES_SHARD1_NAME
+# to a created database, then migrate it with `migrate --database shard1`.
+# Without, it is the default database again, except in tests
+DATABASES['shard1'] = dict(
+    DATABASES['default'],
+    NAME=os.environ.get('POSTGRES_SHARD1_NAME', DATABASES['default']['NAME']),
+    HOST=os.environ.get('POSTGRES_SHARD1_HOST', DATABASES['default']['HOST']),
+    TEST={'NAME': 'test_postgres_shard1'},
+)
+
+DATABASE_ROUTERS = [
+    'carbon_usage.sharding.ShardRouter',
+    'carbon_usage.replicas.ReplicaRouter',
+]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators